@@ -0,0 +1,258 @@
+"""
+Author-work index of a slice, for the questions the notebooks ask of works_authors over and over:
+the authors of a set of works, the works of a set of authors in [T - 5, T), the works of a year.
+The author and work IDs are remapped to dense integers, the works ordered by publication year, so the works of a year
+are a contiguous range of dense IDs. The incidences are kept both ways as CSR arrays
+    work_ptr, work_authors: the dense authors of work w are work_authors[work_ptr[w]: work_ptr[w + 1]]
+    author_ptr, author_works: the dense works of author a, in year order, are author_works[author_ptr[a]: ...]
+and the rows of the works of years [start, end) are work_ptr[year_ptr[start]: year_ptr[end] + 1], a CSR matrix of
+their own. The arrays are saved as .npy files and memory-mapped on load, so the index opens at once and is shared
+between processes through the page cache.
+    author_index = AuthorWorkIndex.load_or_build(works_authors, datapath / 'author_index')
+    author_ids = set(author_index.authors_of_works(work_ids))
+    work_ids = author_index.works_of_authors(author_ids, start=T - 5, end=T)
+"""
+import json
+import shutil
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+INDEX_ARRAYS = ['work_ids', 'work_order', 'author_ids', 'year_ptr', 'work_ptr', 'work_authors', 'author_ptr',
+                'author_works']
+
+
+def gather_rows(ptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Concatenated entries of the rows of a CSR matrix, without a loop over the rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts, lengths = ptr[rows], ptr[rows + 1] - ptr[rows]
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=indices.dtype)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(lengths.sum())]
+
+
+def as_ids(ids) -> np.ndarray:
+    """
+    Sorted distinct IDs of a set, list, Series or array
+    """
+    if isinstance(ids, (set, frozenset)):
+        ids = np.fromiter(ids, dtype=np.int64, count=len(ids))
+    return np.unique(np.asarray(ids, dtype=np.int64))
+
+
+def get_source_key(works_authors: pd.DataFrame, work_col: str, author_col: str, year_col: str) -> dict:
+    """
+    Cheap fingerprint of the works_authors an index was built from, to tell when it is stale
+    """
+    return {
+        'num_rows': int(len(works_authors)),
+        'work_id_sum': int(works_authors[work_col].sum()),
+        'author_id_sum': int(works_authors[author_col].sum()),
+        'year_sum': int(works_authors[year_col].sum()),
+    }
+
+
+class AuthorWorkIndex:
+    """
+    Dense, year-ordered incidence of the authors and works of a slice, see the module docstring.
+    The lookups take sets or arrays of the original OpenAlex IDs and return sorted arrays of them, unknown IDs are
+    ignored.
+    """
+    def __init__(self, arrays: dict, meta: dict):
+        for name in INDEX_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.meta = meta
+        self.first_year = meta['first_year']
+        self.num_works, self.num_authors = len(self.work_ids), len(self.author_ids)
+
+    def __repr__(self):
+        return (f'AuthorWorkIndex({self.num_works:,} works, {self.num_authors:,} authors, '
+                f'{len(self.work_authors):,} authorships, {self.first_year}-{self.last_year})')
+
+    @property
+    def last_year(self) -> int:
+        return self.first_year + len(self.year_ptr) - 2
+
+    @classmethod
+    def build(cls, works_authors: pd.DataFrame, path=None, work_col: str = 'work_id', author_col: str = 'author_id',
+              year_col: str = 'publication_year') -> 'AuthorWorkIndex':
+        """
+        Index the (work, author, year) rows of works_authors, repeated pairs count once and rows with a missing
+        value are left out. Saved to the directory path if given.
+        """
+        df = works_authors[[work_col, author_col, year_col]].dropna()
+        works = df[work_col].to_numpy(dtype=np.int64)
+        authors = df[author_col].to_numpy(dtype=np.int64)
+        years = df[year_col].to_numpy(dtype=np.int64)
+
+        # dense works ordered by year and ID, so each year is a contiguous range
+        sorted_work_ids, first_rows = np.unique(works, return_index=True)
+        work_years = years[first_rows]
+        order = np.lexsort((sorted_work_ids, work_years))
+        work_ids, work_years = sorted_work_ids[order], work_years[order]
+        work_order = np.empty(len(order), dtype=np.int64)  # dense ID of sorted_work_ids[i]
+        work_order[order] = np.arange(len(order))
+
+        first_year = int(work_years[0]) if len(work_years) > 0 else 0
+        last_year = int(work_years[-1]) if len(work_years) > 0 else -1
+        year_ptr = np.searchsorted(work_years, np.arange(first_year, last_year + 2)).astype(np.int64)
+
+        author_ids = np.unique(authors)
+        rows = work_order[np.searchsorted(sorted_work_ids, works)]
+        cols = np.searchsorted(author_ids, authors)
+        pairs = np.unique(rows * max(len(author_ids), 1) + cols)  # sorted by work, then author
+        rows, cols = pairs // max(len(author_ids), 1), pairs % max(len(author_ids), 1)
+
+        by_author = np.lexsort((rows, cols))
+        arrays = {
+            'work_ids': work_ids, 'work_order': work_order, 'author_ids': author_ids, 'year_ptr': year_ptr,
+            'work_ptr': np.searchsorted(rows, np.arange(len(work_ids) + 1)).astype(np.int64),
+            'work_authors': cols.astype(np.int32 if len(author_ids) < 2 ** 31 else np.int64),
+            'author_ptr': np.searchsorted(cols[by_author], np.arange(len(author_ids) + 1)).astype(np.int64),
+            'author_works': rows[by_author].astype(np.int32 if len(work_ids) < 2 ** 31 else np.int64),
+        }
+        meta = {'first_year': first_year, 'source': get_source_key(works_authors, work_col, author_col, year_col)}
+        index = cls(arrays, meta)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def save(self, path):
+        """
+        Write the arrays as .npy files in the directory path, replacing it once complete
+        """
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+        temp_path.mkdir(parents=True)
+        for name in INDEX_ARRAYS:
+            np.save(temp_path / f'{name}.npy', np.asarray(getattr(self, name)))
+        with open(temp_path / 'meta.json', 'w') as writer:
+            json.dump(self.meta, writer)
+        if path.exists():
+            shutil.rmtree(path)
+        temp_path.rename(path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap_mode: Optional[str] = 'r') -> 'AuthorWorkIndex':
+        path = Path(path)
+        with open(path / 'meta.json') as reader:
+            meta = json.load(reader)
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode=mmap_mode) for name in INDEX_ARRAYS}
+        return cls(arrays, meta)
+
+    @classmethod
+    def load_or_build(cls, works_authors: pd.DataFrame, path, work_col: str = 'work_id',
+                      author_col: str = 'author_id', year_col: str = 'publication_year') -> 'AuthorWorkIndex':
+        """
+        The index saved at path, rebuilt if it is missing or was built from a different works_authors
+        """
+        path = Path(path)
+        if (path / 'meta.json').exists():
+            index = cls.load(path)
+            if index.meta['source'] == get_source_key(works_authors, work_col, author_col, year_col):
+                return index
+            print(f'Rebuilding the stale author index at {str(path)!r}')
+        return cls.build(works_authors, path=path, work_col=work_col, author_col=author_col, year_col=year_col)
+
+    # ID mapping
+    @property
+    def sorted_work_ids(self) -> np.ndarray:
+        if not hasattr(self, '_sorted_work_ids'):  # work_order maps them back to dense IDs
+            self._sorted_work_ids = self.work_ids[self.work_order]
+        return self._sorted_work_ids
+
+    def dense_works(self, work_ids) -> np.ndarray:
+        work_ids = as_ids(work_ids)
+        sorted_ids = self.sorted_work_ids
+        positions = np.searchsorted(sorted_ids, work_ids).clip(max=max(self.num_works - 1, 0))
+        found = sorted_ids[positions] == work_ids if self.num_works > 0 else np.zeros(len(work_ids), dtype=bool)
+        return np.sort(self.work_order[positions[found]])
+
+    def dense_authors(self, author_ids) -> np.ndarray:
+        author_ids = as_ids(author_ids)
+        positions = np.searchsorted(self.author_ids, author_ids).clip(max=max(self.num_authors - 1, 0))
+        found = self.author_ids[positions] == author_ids if self.num_authors > 0 else np.zeros(len(author_ids), bool)
+        return positions[found]
+
+    def year_range(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple:
+        """
+        Dense work IDs [lo, hi) of the works published in [start, end), all years if None
+        """
+        num_years = len(self.year_ptr) - 1
+        start = 0 if start is None else min(max(start - self.first_year, 0), num_years)
+        end = num_years if end is None else min(max(end - self.first_year, start), num_years)
+        return int(self.year_ptr[start]), int(self.year_ptr[end])
+
+    # lookups
+    def works_in_years(self, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """
+        IDs of the works published in [start, end)
+        """
+        lo, hi = self.year_range(start, end)
+        return np.asarray(self.work_ids[lo: hi])
+
+    def authors_in_years(self, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """
+        IDs of the authors of any work published in [start, end)
+        """
+        lo, hi = self.year_range(start, end)
+        dense = np.unique(self.work_authors[self.work_ptr[lo]: self.work_ptr[hi]])
+        return self.author_ids[dense]
+
+    def authors_of_works(self, work_ids) -> np.ndarray:
+        """
+        IDs of the authors of any of work_ids, like works_authors.query('work_id.isin(@work_ids)').author_id.unique()
+        """
+        dense = gather_rows(self.work_ptr, self.work_authors, self.dense_works(work_ids))
+        return self.author_ids[np.unique(dense)]
+
+    def edges_of_works(self, work_ids) -> pd.DataFrame:
+        """
+        (work_id, author_id) rows of the authors of work_ids, like
+        works_authors.query('work_id.isin(@work_ids)')[['work_id', 'author_id']] without its repeated pairs
+        """
+        dense = self.dense_works(work_ids)
+        lengths = self.work_ptr[dense + 1] - self.work_ptr[dense]
+        authors = gather_rows(self.work_ptr, self.work_authors, dense)
+        return pd.DataFrame({'work_id': np.repeat(np.asarray(self.work_ids)[dense], lengths),
+                             'author_id': np.asarray(self.author_ids)[authors]})
+
+    def works_of_authors(self, author_ids, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """
+        IDs of the works by any of author_ids published in [start, end)
+        """
+        dense = gather_rows(self.author_ptr, self.author_works, self.dense_authors(author_ids))
+        lo, hi = self.year_range(start, end)
+        dense = dense[(dense >= lo) & (dense < hi)]
+        return np.sort(self.work_ids[np.unique(dense)])
+
+    def coauthors_of_authors(self, author_ids, start: Optional[int] = None, end: Optional[int] = None) \
+            -> np.ndarray:
+        """
+        IDs of everyone who wrote a work published in [start, end) with any of author_ids, themselves included
+        """
+        dense_works = gather_rows(self.author_ptr, self.author_works, self.dense_authors(author_ids))
+        lo, hi = self.year_range(start, end)
+        dense_works = np.unique(dense_works[(dense_works >= lo) & (dense_works < hi)])
+        return self.author_ids[np.unique(gather_rows(self.work_ptr, self.work_authors, dense_works))]
+
+    def incidence(self, start: Optional[int] = None, end: Optional[int] = None):
+        """
+        scipy CSR matrix of the works published in [start, end) by all the authors, 1 where an author wrote a work.
+        Row i is the work works_in_years(start, end)[i], column j the author author_ids[j].
+        """
+        from scipy import sparse
+
+        lo, hi = self.year_range(start, end)
+        ptr = np.asarray(self.work_ptr[lo: hi + 1])
+        indices = np.asarray(self.work_authors[ptr[0]: ptr[-1]])
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, ptr - ptr[0]),
+                                 shape=(hi - lo, self.num_authors))
@@ -0,0 +1,250 @@
+"""
+Co-authorship projections of the works and authors of a window as sparse matrices, in place of networkx bipartite
+graphs and their projections.
+With B the works x authors incidence matrix of the works of a subset of the authors, C = B^T B counts the works
+written by every pair of authors, the weights of nx.bipartite.weighted_projected_graph, and only the pairs that
+wrote together are stored. The dicts of networkx are only built when asked for with to_networkx.
+    coauthors = CoauthorGraph.from_edges(works_authors_collab, nodes=author_ids_supp)
+    coauthors.counts  # CSR matrix of the works written together, rows and columns in the order of coauthors.authors
+    support_graph_ = coauthors.to_networkx()  # same graph as weighted_projected_graph(bip_g, nodes=author_ids_supp)
+    dict_final, dict_final_high1, dict_final_low1 = exposure_classes(coauthors, inactive_authors, active_authors_start,
+                                                                     high_active_authors1, low_active_authors1)
+Unlike nx.from_pandas_edgelist, the work and author IDs live apart, so a work and an author with the same number are
+not merged into one node.
+"""
+import copy
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from author_index import as_ids
+
+
+def incidence_from_edges(edges: pd.DataFrame, work_col: str = 'work_id', author_col: str = 'author_id') -> tuple:
+    """
+    Works x authors CSR matrix of the (work, author) rows of edges, 1 for every distinct pair, with the sorted
+    work and author IDs of its rows and columns
+    """
+    edges = edges[[work_col, author_col]].dropna()
+    work_ids, rows = np.unique(edges[work_col].to_numpy(dtype=np.int64), return_inverse=True)
+    author_ids, cols = np.unique(edges[author_col].to_numpy(dtype=np.int64), return_inverse=True)
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                  shape=(len(work_ids), len(author_ids)))
+    incidence.data[:] = 1  # repeated pairs were summed
+    return incidence, work_ids, author_ids
+
+
+class CoauthorGraph:
+    """
+    Co-authorship projection of a works x authors incidence matrix onto a subset of its authors, the nodes.
+    Like the projections of networkx, the pairs of a node and any of its coauthors are kept, so the coauthors outside
+    the nodes are in the graph too, but not the pairs of two of them. With induced, only the pairs of two nodes are.
+    authors: sorted IDs of the authors, the rows and columns of counts
+    is_node: mask of the authors that are nodes
+    work_ids: IDs of the works, the rows of incidence
+    incidence: works x authors CSR matrix of the works of the nodes
+    counts: authors x authors CSR matrix of the number of works written together, with an empty diagonal
+    """
+    def __init__(self, incidence: sparse.spmatrix, work_ids: np.ndarray, author_ids: np.ndarray, nodes=None,
+                 induced: bool = False):
+        incidence = sparse.csr_matrix(incidence)
+        work_ids, author_ids = np.asarray(work_ids), np.asarray(author_ids)
+        is_node = np.ones(len(author_ids), dtype=bool) if nodes is None else np.isin(author_ids, as_ids(nodes))
+        if nodes is not None and not induced:
+            rows = np.flatnonzero(incidence[:, np.flatnonzero(is_node)].getnnz(axis=1) > 0)
+            incidence, work_ids = incidence[rows], work_ids[rows]
+        elif nodes is not None:
+            incidence = incidence[:, np.flatnonzero(is_node)]
+            author_ids, is_node = author_ids[is_node], is_node[is_node]
+        cols = np.flatnonzero(incidence.getnnz(axis=0) > 0)  # only the authors with works, like networkx
+        self.incidence = incidence[:, cols]
+        self.authors, self.is_node, self.work_ids = author_ids[cols], is_node[cols], work_ids
+
+        shared = self.incidence[np.flatnonzero(self.incidence.getnnz(axis=1) > 1)]  # single authors add no pairs
+        counts = (shared.T @ shared).tocoo()
+        keep = (counts.row != counts.col) & (self.is_node[counts.row] | self.is_node[counts.col])
+        self.counts = sparse.csr_matrix((counts.data[keep], (counts.row[keep], counts.col[keep])),
+                                        shape=counts.shape)
+        self._works_by_author = None
+
+    def __repr__(self):
+        return f'CoauthorGraph({len(self.authors):,} authors, {self.number_of_edges():,} coauthor pairs)'
+
+    def __len__(self):
+        return len(self.authors)
+
+    @classmethod
+    def from_edges(cls, edges: pd.DataFrame, nodes=None, induced: bool = False, work_col: str = 'work_id',
+                   author_col: str = 'author_id') -> 'CoauthorGraph':
+        """
+        Projection of the (work, author) rows of edges onto nodes, all the authors if None
+        """
+        incidence, work_ids, author_ids = incidence_from_edges(edges, work_col=work_col, author_col=author_col)
+        return cls(incidence, work_ids, author_ids, nodes=nodes, induced=induced)
+
+    @classmethod
+    def from_index(cls, author_index, start: Optional[int] = None, end: Optional[int] = None, nodes=None,
+                   induced: bool = False) -> 'CoauthorGraph':
+        """
+        Projection of the works published in [start, end) of an AuthorWorkIndex onto nodes, all the authors if None
+        """
+        incidence = author_index.incidence(start, end)
+        return cls(incidence, author_index.works_in_years(start, end), np.asarray(author_index.author_ids),
+                   nodes=nodes, induced=induced)
+
+    def positions(self, author_ids) -> np.ndarray:
+        """
+        Rows of author_ids in counts, the ones not in the graph are left out
+        """
+        author_ids = as_ids(author_ids)
+        positions = np.searchsorted(self.authors, author_ids).clip(max=max(len(self.authors) - 1, 0))
+        found = self.authors[positions] == author_ids if len(self.authors) > 0 else np.zeros(len(author_ids), bool)
+        return positions[found]
+
+    def number_of_edges(self) -> int:
+        return self.counts.nnz // 2
+
+    def neighbors(self, author_id) -> np.ndarray:
+        row = self.positions([author_id])
+        if len(row) == 0:
+            return np.zeros(0, dtype=self.authors.dtype)
+        return self.authors[self.counts.indices[self.counts.indptr[row[0]]: self.counts.indptr[row[0] + 1]]]
+
+    def degrees(self, weighted: bool = True) -> pd.Series:
+        """
+        Number of works written with coauthors (summed over them) or of coauthors of every author
+        """
+        degrees = self.counts.sum(axis=1).A1 if weighted else self.counts.getnnz(axis=1)
+        return pd.Series(degrees, index=pd.Index(self.authors, name='author_id'))
+
+    def works_of(self, col: int) -> np.ndarray:
+        """
+        Rows of incidence of the works of the author in column col
+        """
+        if self._works_by_author is None:
+            self._works_by_author = self.incidence.tocsc()
+            self._works_by_author.sort_indices()
+        return self._works_by_author.indices[self._works_by_author.indptr[col]: self._works_by_author.indptr[col + 1]]
+
+    def shared_works(self, u, v) -> set:
+        """
+        IDs of the works written by both u and v, the weights of list_works
+        """
+        cols = self.positions([u, v])
+        if len(cols) < 2:
+            return set()
+        return set(self.work_ids[np.intersect1d(self.works_of(cols[0]), self.works_of(cols[1]))].tolist())
+
+    def exposure(self, sources, distinct_works: bool = False) -> np.ndarray:
+        """
+        Exposure of every author to the authors of sources, in the order of authors: the number of works written with
+        each of them, summed over them (the weighted degree towards sources), or with distinct_works the number of
+        works written with any of them
+        """
+        is_source = np.isin(self.authors, as_ids(sources))
+        if not distinct_works:
+            return self.counts @ is_source.astype(np.int64)
+
+        by_author = self.incidence.T.tocsr()
+        exposure = np.zeros(len(self.authors), dtype=np.int64)
+        # the authors that are not nodes only count the sources that are, and nobody counts themselves
+        for is_author, weights in ((self.is_node, is_source), (~self.is_node, is_source & self.is_node)):
+            sources_per_work = self.incidence @ weights.astype(np.int64)
+            for is_self, min_sources in ((False, 1), (True, 2)):
+                rows = np.flatnonzero(is_author & (weights == is_self))
+                exposure[rows] = by_author[rows] @ (sources_per_work >= min_sources).astype(np.int64)
+        return exposure
+
+    def connected_components(self) -> list:
+        """
+        IDs of the authors of every connected component, largest first
+        """
+        if len(self.authors) == 0:
+            return []
+        num_components, labels = csgraph.connected_components(self.counts, directed=False)
+        order = np.argsort(labels, kind='stable')
+        components = np.split(self.authors[order], np.cumsum(np.bincount(labels, minlength=num_components))[:-1])
+        return sorted(components, key=len, reverse=True)
+
+    def average_clustering(self) -> float:
+        """
+        Unweighted average clustering coefficient over all the authors, like nx.average_clustering(G)
+        """
+        if len(self.authors) == 0:
+            return 0.0
+        adjacency = (self.counts > 0).astype(np.int64)
+        triangles = (adjacency @ adjacency).multiply(adjacency).sum(axis=1).A1 / 2
+        degrees = adjacency.getnnz(axis=1)
+        pairs = degrees * (degrees - 1) / 2
+        return float(np.divide(triangles, pairs, out=np.zeros(len(pairs)), where=pairs > 0).mean())
+
+    def subgraph(self, author_ids) -> 'CoauthorGraph':
+        """
+        Graph of the pairs of author_ids only, like G.subgraph(author_ids)
+        """
+        cols = self.positions(author_ids)
+        graph = copy.copy(self)
+        graph.authors, graph.is_node = self.authors[cols], self.is_node[cols]
+        graph.incidence, graph.counts = self.incidence[:, cols], self.counts[cols][:, cols]
+        graph._works_by_author = None
+        return graph
+
+    def to_networkx(self, weight: Optional[str] = 'count'):
+        """
+        networkx Graph of the projection, with every author in it
+        weight: 'count' for the number of works written together as in weighted_projected_graph, 'works' for the sets
+            of those works as in generic_weighted_projected_graph with list_works, None for no weights as in
+            projected_graph
+        """
+        import networkx as nx
+
+        assert weight in ('count', 'works', None), f'weight must be count, works or None, not {weight!r}'
+        graph = nx.Graph()
+        graph.add_nodes_from(self.authors.tolist())
+        upper = sparse.triu(self.counts, k=1).tocoo()
+        sources, targets = self.authors[upper.row].tolist(), self.authors[upper.col].tolist()
+        if weight is None:
+            graph.add_edges_from(zip(sources, targets))
+        elif weight == 'count':
+            graph.add_weighted_edges_from(zip(sources, targets, upper.data.tolist()), weight='weight')
+        else:
+            for source, target, row, col in zip(sources, targets, upper.row, upper.col):
+                works = np.intersect1d(self.works_of(row), self.works_of(col), assume_unique=True)
+                graph.add_edge(source, target, weight=set(self.work_ids[works].tolist()))
+        return graph
+
+
+def group_by_exposure(author_ids: np.ndarray, exposure: np.ndarray) -> dict:
+    """
+    {k: [IDs of the authors with exposure k]}, by increasing k and ID
+    """
+    order = np.lexsort((author_ids, exposure))
+    ks, starts = np.unique(exposure[order], return_index=True)
+    return {int(k): ids.tolist() for k, ids in zip(ks, np.split(author_ids[order], starts[1:]))}
+
+
+def exposure_classes(graph: CoauthorGraph, author_ids, active_authors, high_active_authors, low_active_authors,
+                     distinct_works: bool = False) -> tuple:
+    """
+    Classes {k: [author IDs]} of the author_ids in the graph by their exposure k to the active authors, class 0 for
+    no active coauthors, and of the ones with high but no low active coauthors, or the other way round, by their
+    exposure to those, for all the authors at once instead of one ego graph each.
+    k is the number of works written with every active coauthor, summed over them, or with distinct_works the number
+    of works written with any of them.
+    """
+    cols = graph.positions(author_ids)
+    author_ids = graph.authors[cols]
+    active_authors = as_ids(active_authors)
+    high_active_authors, low_active_authors = as_ids(high_active_authors), as_ids(low_active_authors)
+
+    classes = [group_by_exposure(author_ids, graph.exposure(active_authors, distinct_works=distinct_works)[cols])]
+    has_high = graph.exposure(high_active_authors)[cols] > 0
+    has_low = graph.exposure(low_active_authors)[cols] > 0
+    for exposed, others, sources in ((has_high, has_low, high_active_authors), (has_low, has_high, low_active_authors)):
+        only = exposed & ~others  # their exposures to the active ones among sources
+        exposure = graph.exposure(np.intersect1d(sources, active_authors), distinct_works=distinct_works)[cols]
+        classes.append(group_by_exposure(author_ids[only], exposure[only]))
+    return tuple(classes)
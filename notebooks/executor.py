@@ -0,0 +1,353 @@
+"""
+Process pool executor for the experiments of the notebooks, so every topic, window and variant of a discipline runs
+in one job instead of one after the other in a single kernel.
+The base tables are saved once as uncompressed Arrow IPC files and memory-mapped, the numeric columns of the frames
+read back point into the mapped files, so the kernel and all the workers share one copy of them through the page
+cache instead of each holding its own.
+    shared_tables = SharedTables.save_or_load({'works': works, 'works_authors': works_authors}, datapath / 'shared')
+    works, works_authors = shared_tables['works'], shared_tables['works_authors']
+    tasks = [Task((topic, 'info'), info, topic=topic, my_path=my_path) for topic in topic_list]
+    tasks += [Task((topic, 'Exp1_ver1'), Exp1_ver1, after=[(topic, 'info')], topic=topic, ...) for topic in topic_list]
+    results = run_tasks(tasks, num_workers=16, results_dir=resultspath / 'tasks', tables=shared_tables,
+                        settings={'EW_YEARS': EW_YEARS, 'OW_YEARS': OW_YEARS})
+run_tasks starts each task once the tasks it comes after succeeded, largest first, seeds random and np.random from
+its key so its result does not depend on the order or the worker it ran on, and returns the results in the order of
+the tasks. A worker dying (out of memory, a segfault) breaks the pool: the tasks it was running are retried alone on a
+new pool, and a task that keeps killing its worker is reported as a TaskFailure instead of taking the run down.
+Finished results are pickled to results_dir, so a rerun of an interrupted job only runs what is left. The pickles are
+named after a fingerprint of the task (the source of its function, its arguments, the settings, the shared tables and
+the fingerprints of the tasks it comes after), so changing any of them runs the task again instead of reusing a stale
+result. The helpers its function calls and the files it reads from outside of the tasks are not part of it, clear
+results_dir after changing them.
+The pool forks, so the tasks can be functions defined in the notebook.
+"""
+import inspect
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import shutil
+import time
+import traceback
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+_LOADED_TABLES = {}  # {(path, name): frame} of the tables mapped by this process
+
+
+def get_table_key(df: pd.DataFrame) -> dict:
+    """
+    Cheap fingerprint of a table, to tell when the saved copy is stale
+    """
+    numeric = df.select_dtypes(include=['integer', 'bool'])
+    return {
+        'num_rows': int(len(df)),
+        'columns': [str(col) for col in df.columns],
+        'index': [str(name) for name in df.index.names],
+        'sums': {str(col): int(numeric[col].sum()) for col in numeric.columns},
+    }
+
+
+class SharedTables:
+    """
+    DataFrames saved as Arrow IPC files in a directory and memory-mapped on access, see the module docstring.
+    The frames are cached per process, so the tasks of a worker share them too. Treat them as read-only, the numeric
+    columns are views of the read-only mapped files.
+    """
+    def __init__(self, path, meta: dict):
+        self.path = Path(path)
+        self.meta = meta
+
+    def __repr__(self):
+        return f'SharedTables({str(self.path)!r}, {self.names})'
+
+    @property
+    def names(self) -> list:
+        return list(self.meta['tables'])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.meta['tables']
+
+    def __getitem__(self, name: str) -> pd.DataFrame:
+        if name not in self:
+            raise KeyError(f'No table {name!r} in {self!r}')
+        cache_key = (str(self.path), name)
+        if cache_key not in _LOADED_TABLES:
+            table = ipc.open_file(pa.memory_map(str(self.path / f'{name}.arrow'))).read_all()
+            _LOADED_TABLES[cache_key] = table.to_pandas(split_blocks=True)  # no copy of the numeric columns
+        return _LOADED_TABLES[cache_key]
+
+    @classmethod
+    def save(cls, tables: dict, path) -> 'SharedTables':
+        """
+        Write the {name: DataFrame} tables to the directory path, replacing it once complete. The indexes are kept.
+        """
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+        temp_path.mkdir(parents=True)
+        for name, df in tables.items():
+            table = pa.Table.from_pandas(df)
+            with pa.OSFile(str(temp_path / f'{name}.arrow'), 'wb') as sink:
+                with ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table, max_chunksize=None)  # one contiguous chunk per column
+        meta = {'tables': {name: get_table_key(df) for name, df in tables.items()}}
+        with open(temp_path / 'meta.json', 'w') as writer:
+            json.dump(meta, writer)
+        if path.exists():
+            shutil.rmtree(path)
+        temp_path.rename(path)
+        for cache_key in [cache_key for cache_key in _LOADED_TABLES if cache_key[0] == str(path)]:
+            del _LOADED_TABLES[cache_key]
+        return cls(path, meta)
+
+    @classmethod
+    def load(cls, path) -> 'SharedTables':
+        path = Path(path)
+        with open(path / 'meta.json') as reader:
+            meta = json.load(reader)
+        return cls(path, meta)
+
+    @classmethod
+    def save_or_load(cls, tables: dict, path) -> 'SharedTables':
+        """
+        The tables saved at path, saved again if they are missing or any of them changed
+        """
+        path = Path(path)
+        if (path / 'meta.json').exists():
+            shared_tables = cls.load(path)
+            if shared_tables.meta['tables'] == {name: get_table_key(df) for name, df in tables.items()}:
+                return shared_tables
+            print(f'Saving the stale shared tables at {str(path)!r}')
+        return cls.save(tables, path)
+
+
+class Task:
+    """
+    A call func(**kwargs) of run_tasks, key names it (e.g. (topic, variant) or (topic, T_0, metric, variant)) and
+    must be unique and picklable. size orders the ready tasks, largest first. after lists the keys of the tasks whose
+    outputs it reads, it starts once all of them succeeded.
+    """
+    def __init__(self, key, func, *, size: float = 1, after=(), **kwargs):
+        self.key, self.func, self.kwargs = key, func, kwargs
+        self.size, self.after = size, list(after)
+
+    def __repr__(self):
+        return f'Task({self.key!r}, {getattr(self.func, "__name__", self.func)})'
+
+
+class TaskFailure:
+    """
+    Result of a task that raised, kept killing its worker or came after a failed task
+    """
+    def __init__(self, key, reason: str):
+        self.key, self.reason = key, reason
+
+    def __repr__(self):
+        return f'TaskFailure({self.key!r}, {self.reason.strip().splitlines()[-1]!r})'
+
+
+def get_task_seed(key, seed: int = 0) -> int:
+    return (zlib.crc32(repr(key).encode()) + seed) % 2 ** 32
+
+
+def get_func_source(func) -> str:
+    """
+    Source of a task function, its qualified name if the source is not available
+    """
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", repr(func))}'
+
+
+def get_task_fingerprints(tasks_by_key: dict, tables: Optional[SharedTables] = None,
+                          settings: Optional[dict] = None) -> dict:
+    """
+    {key: fingerprint} of the tasks, a hash of the source of the function, the arguments, the settings, the meta of
+    the tables and the fingerprints of the tasks a task comes after, so a change upstream reruns the tasks downstream
+    """
+    base = repr((sorted((str(name), repr(value)) for name, value in (settings or {}).items()),
+                 tables.meta if tables is not None else None))
+    fingerprints = {}
+
+    def fingerprint(key, path=()):
+        if key not in fingerprints:
+            task = tasks_by_key[key]
+            if key in path:  # comes after itself, it fails anyway
+                return ''
+            after = [fingerprint(dep, path + (key,)) for dep in task.after]
+            kwargs = sorted((name, repr(value)) for name, value in task.kwargs.items())
+            fingerprints[key] = f'{zlib.crc32(repr((get_func_source(task.func), kwargs, base, after)).encode()):08x}'
+        return fingerprints[key]
+
+    for key in tasks_by_key:
+        fingerprint(key)
+    return fingerprints
+
+
+def get_result_path(results_dir: Path, key, fingerprint: str = '') -> Path:
+    """
+    Pickle of the result of a task, named after its key plus a hash so that different keys never share a file,
+    and the fingerprint of the task
+    """
+    name = re.sub(r'[^\w.-]+', '_', '-'.join(map(str, key)) if isinstance(key, tuple) else str(key))[: 150]
+    return results_dir / f'{name}-{zlib.crc32(repr(key).encode()):08x}-{fingerprint}.pkl'
+
+
+def _init_worker(tables_path: Optional[str]):
+    if tables_path is not None:  # the globals of the notebook functions point to the mapped tables
+        import __main__
+
+        shared_tables = SharedTables.load(tables_path)
+        for name in shared_tables.names:
+            setattr(__main__, name, shared_tables[name])
+    return
+
+
+def _run_task(func, kwargs: dict, task_seed: int):
+    random.seed(task_seed)
+    np.random.seed(task_seed)
+    start_time = time.perf_counter()
+    try:
+        return True, func(**kwargs), time.perf_counter() - start_time
+    except Exception:
+        return False, traceback.format_exc(), time.perf_counter() - start_time
+
+
+def run_tasks(tasks: list, num_workers: int = 1, results_dir=None, tables: Optional[SharedTables] = None,
+              max_attempts: int = 2, seed: int = 0, settings: Optional[dict] = None) -> list:
+    """
+    Run the tasks on a pool of num_workers forked processes, see the module docstring.
+    tables are mapped into the globals of __main__ of each worker under their names, like the frames of the kernel.
+    settings are the values of the globals the tasks read besides the tables, e.g. the window lengths, only their
+    fingerprint is used: the workers fork with the globals of the kernel.
+    A task whose worker dies is retried alone up to max_attempts in total. Exceptions raised by a task are not
+    retried. Returns the result of each task, in the order of tasks, or a TaskFailure with the reason.
+    """
+    tasks_by_key = {task.key: task for task in tasks}
+    if len(tasks_by_key) < len(tasks):
+        raise ValueError('The keys of the tasks are not unique')
+    unknown_keys = {key for task in tasks for key in task.after} - set(tasks_by_key)
+    if len(unknown_keys) > 0:
+        raise ValueError(f'Tasks come after unknown tasks {sorted(map(repr, unknown_keys))}')
+
+    results = {}
+    fingerprints = get_task_fingerprints(tasks_by_key, tables=tables, settings=settings)
+    if results_dir is not None:
+        results_dir = Path(results_dir)
+        results_dir.mkdir(parents=True, exist_ok=True)
+        for key in tasks_by_key:
+            if get_result_path(results_dir, key, fingerprints[key]).exists():
+                with open(get_result_path(results_dir, key, fingerprints[key]), 'rb') as reader:
+                    results[key] = pickle.load(reader)
+        if len(results) > 0:
+            print(f'Loaded the results of {len(results):,} of {len(tasks):,} tasks from {str(results_dir)!r}')
+
+    def finish(key, result):
+        if results_dir is not None and not isinstance(result, TaskFailure):
+            result_path = get_result_path(results_dir, key, fingerprints[key])
+            with open(result_path.with_name(result_path.name + '.tmp'), 'wb') as writer:
+                pickle.dump(result, writer)
+            os.replace(result_path.with_name(result_path.name + '.tmp'), result_path)
+            for stale_path in results_dir.glob(get_result_path(results_dir, key, '*').name):
+                if stale_path != result_path:  # the results of older versions of the task
+                    stale_path.unlink()
+        results[key] = result
+        return
+
+    pending = {task.key: task for task in tasks if task.key not in results}
+    attempts, suspects = {}, set()  # suspects were running when a worker died, they are retried one at a time
+    total_size = sum(task.size for task in pending.values())
+    done_size, num_done, num_total = 0, 0, len(pending)
+    start_time = time.perf_counter()
+    context = multiprocessing.get_context('fork')
+    tables_path = str(tables.path) if tables is not None else None
+
+    while len(pending) > 0:
+        running = {}  # {future: key}
+        pool = ProcessPoolExecutor(num_workers, mp_context=context, initializer=_init_worker, initargs=(tables_path,))
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for key, task in list(pending.items()):  # nothing to wait for after a failure
+                    failed = [dep for dep in task.after if isinstance(results.get(dep), TaskFailure)]
+                    if len(failed) > 0:
+                        finish(key, TaskFailure(key, f'came after the failed task {failed[0]!r}'))
+                        del pending[key]
+                        num_done, done_size = num_done + 1, done_size + task.size
+                        print(f'[{num_done}/{num_total}] {key!r}: skipped, {failed[0]!r} failed', flush=True)
+
+                ready = [task for task in pending.values() if all(dep in results for dep in task.after)]
+                ready.sort(key=lambda task: (task.key not in suspects, -task.size))  # stable, ties in task order
+                for task in ready:
+                    if len(running) >= num_workers or any(key in suspects for key in running.values()):
+                        break
+                    if task.key in suspects and len(running) > 0:
+                        break
+                    future = pool.submit(_run_task, task.func, task.kwargs, get_task_seed(task.key, seed))
+                    running[future] = task.key
+                    del pending[task.key]
+                if len(running) == 0:  # what is left comes after itself
+                    for key, task in list(pending.items()):
+                        finish(key, TaskFailure(key, 'comes after itself through the tasks it comes after'))
+                        del pending[key]
+                    break
+
+                done_futures, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    key = running.pop(future)
+                    task = tasks_by_key[key]
+                    try:
+                        succeeded, result, elapsed = future.result()
+                    except BrokenProcessPool:
+                        running[future] = key
+                        raise
+                    except Exception:  # the result could not be sent back
+                        succeeded, result, elapsed = False, traceback.format_exc(), float('nan')
+                    finish(key, result if succeeded else TaskFailure(key, result))
+                    suspects.discard(key)
+                    num_done, done_size = num_done + 1, done_size + task.size
+
+                    wall_time = time.perf_counter() - start_time
+                    rate = done_size / wall_time
+                    eta = timedelta(seconds=round((total_size - done_size) / rate)) if rate > 0 else 'unknown'
+                    outcome = f'done in {elapsed:,.1f}s' if succeeded else f'failed, {results[key]!r}'
+                    print(f'[{num_done}/{num_total}] {key!r}: {outcome} | overall {done_size:,}/{total_size:,}, '
+                          f'ETA {eta}', flush=True)
+        except BrokenProcessPool:
+            for future, key in running.items():
+                task = tasks_by_key[key]
+                if future.done() and future.exception() is None:  # finished before the pool broke
+                    succeeded, result, elapsed = future.result()
+                    finish(key, result if succeeded else TaskFailure(key, result))
+                    suspects.discard(key)
+                    num_done, done_size = num_done + 1, done_size + task.size
+                    continue
+                attempts[key] = attempts.get(key, 0) + 1
+                if attempts[key] >= max_attempts:
+                    finish(key, TaskFailure(key, f'its worker died {attempts[key]} times'))
+                    suspects.discard(key)
+                    num_done, done_size = num_done + 1, done_size + task.size
+                    print(f'[{num_done}/{num_total}] {key!r}: failed, its worker died {attempts[key]} times',
+                          flush=True)
+                else:
+                    pending[key] = task
+                    suspects.add(key)
+            retry = f' to retry {len(suspects):,} tasks one at a time' if len(suspects) > 0 else ''
+            print(f'A worker died, restarting the pool{retry}', flush=True)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    return [results[task.key] for task in tasks]
@@ -0,0 +1,151 @@
+"""
+Windows of years over the per-year sets of IDs of the experiments, such as the works and authors of a topic.
+The experiments slide an exposure window (EW) [T_0 - 5, T_0) and an observation window (OW) [T_0, T_0 + 5) over
+T_0 = 1995 ... 2017, window_starts(1990, 2022), and take the unions of the sets of their years, although consecutive
+windows share 4 of them.
+Here the (ID, year) pairs are indexed once, sorted by year, along with the year of the previous occurrence of each ID:
+    - the distinct IDs of [start, end) are the pairs of its years whose previous occurrence is before start, a slice of
+      the index with no set unions,
+    - their number, and the number of IDs seen for the first time in [start, end), are prefix sums over
+      (year, previous year), so any window length costs the same and lengths can be swept for sensitivity analyses.
+    topic_works = YearWindows.from_lists(work_ids_list, first_year=1990)
+    prior_work_ids_5yr = set(topic_works.ids(T_0 - 5, T_0))  # set().union(*work_ids_list[w:w + 5])
+    windows_cond = [topic_works.count(*ew) >= N and topic_works.count(*ow) >= N
+                    for T_0, ew, ow in sliding_windows(1995, 2018, ew_years=7, ow_years=3)]
+Windows are clipped to the indexed years.
+"""
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from author_index import as_ids
+
+
+def window_starts(first_year: int, end_year: int, ew_years: int = 5, ow_years: int = 5) -> range:
+    """
+    T_0 of every pair of windows [T_0 - ew_years, T_0), [T_0, T_0 + ow_years) within the years [first_year, end_year)
+    """
+    return range(first_year + ew_years, end_year - ow_years + 1)
+
+
+def sliding_windows(first_start: int, last_start: int, ew_years: int = 5, ow_years: int = 5, step: int = 1) -> list:
+    """
+    (T_0, (T_0 - ew_years, T_0), (T_0, T_0 + ow_years)) of the exposure and observation windows of every T_0 in
+    [first_start, last_start)
+    """
+    return [(T_0, (T_0 - ew_years, T_0), (T_0, T_0 + ow_years)) for T_0 in range(first_start, last_start, step)]
+
+
+class YearWindows:
+    """
+    Index of the IDs of every year for the unions and sizes of windows of years, see the module docstring.
+    pair_ids, pair_years: the distinct (ID, year) pairs sorted by year and ID
+    prev_years: year of the previous pair of the same ID, first_year - 1 for its first one
+    year_ptr: the pairs of year y are pair_ids[year_ptr[y - first_year]: year_ptr[y - first_year + 1]]
+    """
+    def __init__(self, ids: np.ndarray, years: np.ndarray, first_year: Optional[int] = None,
+                 last_year: Optional[int] = None):
+        ids, years = np.asarray(ids, dtype=np.int64), np.asarray(years, dtype=np.int64)
+        if first_year is None:
+            first_year = int(years.min()) if len(years) > 0 else 0
+        if last_year is None:
+            last_year = int(years.max()) if len(years) > 0 else first_year - 1
+        self.first_year, self.last_year = first_year, last_year
+        in_years = (years >= first_year) & (years <= last_year)
+        ids, years = ids[in_years], years[in_years]
+
+        order = np.lexsort((years, ids))  # by ID then year, to find the previous year of every ID
+        ids, years = ids[order], years[order]
+        distinct = np.append(True, (ids[1:] != ids[:-1]) | (years[1:] != years[:-1])) if len(ids) > 0 \
+            else np.zeros(0, dtype=bool)
+        ids, years = ids[distinct], years[distinct]
+        prev_years = np.full(len(ids), first_year - 1, dtype=np.int64)
+        if len(ids) > 1:
+            same_id = ids[1:] == ids[:-1]
+            prev_years[1:][same_id] = years[:-1][same_id]
+
+        order = np.lexsort((ids, years))
+        self.pair_ids, self.pair_years, self.prev_years = ids[order], years[order], prev_years[order]
+        num_years = self.num_years
+        self.year_ptr = np.searchsorted(self.pair_years, np.arange(self.first_year, self.first_year + num_years + 1))
+
+        # pairs[y, p]: pairs of year index y whose previous occurrence has index p - 1, p = 0 for none
+        pairs = np.zeros((num_years, num_years + 1), dtype=np.int64)
+        np.add.at(pairs, (self.pair_years - self.first_year, self.prev_years - self.first_year + 1), 1)
+        # distinct_prefix[b, a]: pairs of the years before index b whose previous occurrence is before index a
+        self.distinct_prefix = np.vstack([np.zeros((1, num_years + 1), dtype=np.int64),
+                                          np.cumsum(np.cumsum(pairs, axis=1), axis=0)])
+        self.new_prefix = np.append(0, np.cumsum(pairs[:, 0]))  # first occurrences before index b
+
+    def __repr__(self):
+        return f'YearWindows({len(self.pair_ids):,} (ID, year) pairs, {self.first_year}-{self.last_year})'
+
+    @property
+    def num_years(self) -> int:
+        return max(self.last_year - self.first_year + 1, 0)
+
+    @classmethod
+    def from_lists(cls, ids_by_year: list, first_year: int) -> 'YearWindows':
+        """
+        Index of ids_by_year[i], the sets, lists or Index of IDs of year first_year + i
+        """
+        ids_by_year = [as_ids(ids) for ids in ids_by_year]
+        ids = np.concatenate(ids_by_year) if len(ids_by_year) > 0 else np.zeros(0, dtype=np.int64)
+        years = np.repeat(np.arange(first_year, first_year + len(ids_by_year)), [len(ids) for ids in ids_by_year])
+        return cls(ids, years, first_year=first_year, last_year=first_year + len(ids_by_year) - 1)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, id_col: str, year_col: str = 'publication_year') -> 'YearWindows':
+        """
+        Index of the (ID, year) rows of df, rows with a missing value are left out
+        """
+        df = df[[id_col, year_col]].dropna()
+        return cls(df[id_col].to_numpy(dtype=np.int64), df[year_col].to_numpy(dtype=np.int64))
+
+    def year_range(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple:
+        """
+        Year indices [a, b) of the years [start, end) clipped to the indexed years, all years if None
+        """
+        a, b = self.year_ranges([start], [end])
+        return int(a[0]), int(b[0])
+
+    def year_ranges(self, starts, ends) -> tuple:
+        num_years = self.num_years
+        starts = np.array([self.first_year if start is None else start for start in starts], dtype=np.int64)
+        ends = np.array([self.first_year + num_years if end is None else end for end in ends], dtype=np.int64)
+        a = np.clip(starts - self.first_year, 0, num_years)
+        return a, np.clip(ends - self.first_year, a, num_years)
+
+    def ids(self, start: Optional[int] = None, end: Optional[int] = None, new: bool = False) -> np.ndarray:
+        """
+        Sorted distinct IDs of the years [start, end), like set().union(*ids_by_year[a: b]), or with new only the ones
+        not seen before start
+        """
+        a, b = self.year_range(start, end)
+        lo, hi = self.year_ptr[a], self.year_ptr[b]
+        prev_years = self.prev_years[lo: hi]
+        first_in_window = prev_years < (self.first_year if new else self.first_year + a)
+        return np.sort(self.pair_ids[lo: hi][first_in_window])
+
+    def count(self, start: Optional[int] = None, end: Optional[int] = None, new: bool = False) -> int:
+        """
+        Number of ids(start, end, new) in O(1)
+        """
+        return int(self.counts([(start, end)], new=new)[0])
+
+    def counts(self, windows: list, new: bool = False) -> np.ndarray:
+        """
+        count of every (start, end) of windows at once
+        """
+        starts, ends = zip(*windows) if len(windows) > 0 else ((), ())
+        a, b = self.year_ranges(starts, ends)
+        if new:
+            return self.new_prefix[b] - self.new_prefix[a]
+        return self.distinct_prefix[b, a] - self.distinct_prefix[a, a]
+
+    def before(self, year: int) -> np.ndarray:
+        """
+        Sorted distinct IDs of all the years before year
+        """
+        return self.ids(None, year)
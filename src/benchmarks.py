@@ -0,0 +1,323 @@
+"""
+Benchmarks for the hot spots of the flattening pipeline.
+Micro-benchmarks compare the scalar and vectorized versions of single functions, and bench_pipeline times the
+functions of the flattener and the whole pipeline on synthetic snapshots of a few sizes, in rows/s and MB/s.
+Every run is appended to results/benchmarks/benchmarks.jsonl and compared with the last run on the same machine,
+so a regression shows up before a production run.
+Run with python -m src.benchmarks [--scales 1000 10000 100000] from the root of the repo.
+"""
+import argparse
+import contextlib
+import gzip
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+from typing import Optional
+
+import orjson
+import pyarrow as pa
+
+sys.path.extend(['../', './'])
+import src.flatten_openalex as flatten_openalex
+from src.checkpoint import CompletionLog, append_json_lines
+from src.synthetic import generate_snapshot
+from src.utils import convert_openalex_id_to_int, convert_openalex_ids_to_int, reconstruct_abstract, \
+    reconstruct_abstracts, iter_jsonl_lines, gzip_backend, IdFilter
+
+RESULTS_PATH = Path('results') / 'benchmarks' / 'benchmarks.jsonl'
+
+
+def make_openalex_ids(num_ids: int, prefix: str = 'W', seed: int = 0) -> list:
+    random.seed(seed)
+    return [f'https://openalex.org/{prefix}{random.randint(1, 4_400_000_000)}' for _ in range(num_ids)]
+
+
+def best_time(func, repeat: int = 5) -> float:
+    """
+    Best time per call in seconds, running func enough times for each measurement to take about 0.2s
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench_id_parsing(sizes=(1, 10, 40, 200, 10_000, 1_000_000)):
+    """
+    Compare the scalar and the vectorized OpenAlex ID parsing, from a list of strings and from an Arrow array.
+    A work has about 40 references on average, a whole partition has millions of them, and the fixed cost of a
+    vectorized call only pays off at the column sizes that ArrowTableBuilder converts.
+    """
+    print(f'{"num_ids":>10} {"scalar":>12} {"vectorized":>12} {"speedup":>8} {"from arrow":>12} {"speedup":>8}')
+    results = []
+    for size in sizes:
+        openalex_ids = make_openalex_ids(size)
+
+        scalar_time = best_time(lambda: [convert_openalex_id_to_int(id_) for id_ in openalex_ids])
+        vector_time = best_time(lambda: convert_openalex_ids_to_int(openalex_ids))
+        arrow_ids = pa.array(openalex_ids, type=pa.string())
+        arrow_time = best_time(lambda: convert_openalex_ids_to_int(arrow_ids))
+
+        ids, null_mask = convert_openalex_ids_to_int(openalex_ids)
+        assert ids.tolist() == [convert_openalex_id_to_int(id_) for id_ in openalex_ids] and not null_mask.any()
+
+        print(f'{size:>10,} {scalar_time * 1e6:>10,.1f}us {vector_time * 1e6:>10,.1f}us '
+              f'{scalar_time / vector_time:>7.1f}x {arrow_time * 1e6:>10,.1f}us {scalar_time / arrow_time:>7.1f}x')
+        results.append({'num_ids': size, 'scalar_s': scalar_time, 'vectorized_s': vector_time,
+                        'vectorized_arrow_s': arrow_time})
+    return results
+
+
+def make_inverted_indexes(num_abstracts: int, num_words: int = 180, seed: int = 0) -> list:
+    """
+    Inverted indexes of abstracts of num_words words, drawn from a vocabulary of as many words so that some repeat
+    """
+    random.seed(seed)
+    inv_abstracts = []
+    for _ in range(num_abstracts):
+        inv_abstract = {}
+        for position in range(num_words):
+            inv_abstract.setdefault(f'word{random.randrange(num_words)}', []).append(position)
+        inv_abstracts.append(inv_abstract)
+    return inv_abstracts
+
+
+def bench_abstracts(num_abstracts: int = 10_000):
+    """
+    Compare reconstructing abstracts one at a time by sorting a dict with the batched, preallocated version
+    """
+    inv_abstracts = make_inverted_indexes(num_abstracts)
+    assert reconstruct_abstracts(inv_abstracts) == [reconstruct_abstract(inv) for inv in inv_abstracts]
+
+    scalar_time = best_time(lambda: [reconstruct_abstract(inv) for inv in inv_abstracts], repeat=3)
+    batch_time = best_time(lambda: reconstruct_abstracts(inv_abstracts), repeat=3)
+    print(f'{num_abstracts:,} abstracts: {scalar_time * 1e3:,.1f}ms one at a time, {batch_time * 1e3:,.1f}ms batched, '
+          f'{scalar_time / batch_time:.1f}x')
+    return {'num_abstracts': num_abstracts, 'scalar_s': scalar_time, 'batched_s': batch_time}
+
+
+def bench_jsonl_reading(num_lines: int = 20_000):
+    """
+    Compare reading and parsing a gzipped JSON lines file in one thread with gzip.open against iter_jsonl_lines,
+    which inflates on a reader thread with the fastest gzip backend installed while the lines are parsed
+    """
+    openalex_ids, inv_abstracts = make_openalex_ids(num_lines), make_inverted_indexes(num_lines)
+    works = [{'id': openalex_id, 'referenced_works': make_openalex_ids(40, seed=i), 'abstract_inverted_index': inv}
+             for i, (openalex_id, inv) in enumerate(zip(openalex_ids, inv_abstracts))]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        jsonl_file_name = Path(temp_dir) / 'part_000.gz'
+        with gzip.open(jsonl_file_name, 'wb') as writer:
+            writer.writelines(orjson.dumps(work) + b'\n' for work in works)
+
+        def read_serial():
+            with gzip.open(jsonl_file_name, 'r') as jsonl:
+                return sum(1 for line in jsonl if line.strip() and orjson.loads(line))
+
+        def read_pipelined():
+            return sum(1 for line in iter_jsonl_lines(jsonl_file_name) if orjson.loads(line))
+
+        assert read_serial() == read_pipelined() == num_lines
+        size = jsonl_file_name.stat().st_size
+        serial_time = best_time(read_serial, repeat=3)
+        pipelined_time = best_time(read_pipelined, repeat=3)
+
+    print(f'{num_lines:,} lines, {size / 2 ** 20:,.1f} MB gzipped: {serial_time * 1e3:,.1f}ms with gzip.open, '
+          f'{pipelined_time * 1e3:,.1f}ms pipelined with {gzip_backend.__name__}, {serial_time / pipelined_time:.1f}x')
+    return {'num_lines': num_lines, 'bytes': size, 'backend': gzip_backend.__name__, 'serial_s': serial_time,
+            'pipelined_s': pipelined_time}
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the prints and progress bars of the flatteners
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def quiet_call(func, *args, **kwargs):
+    with quiet():
+        return func(*args, **kwargs)
+
+
+def timed(func) -> tuple:
+    start_time = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start_time, result
+
+
+def throughput(name: str, scale: int, seconds: float, rows: int, num_bytes: int) -> dict:
+    """
+    Result of one benchmark, bytes are the input read or the output written, whichever the function is about
+    """
+    record = {'name': name, 'scale': scale, 'seconds': seconds, 'rows': rows, 'bytes': num_bytes,
+              'rows_per_s': rows / seconds, 'mb_per_s': num_bytes / 2 ** 20 / seconds}
+    print(f'{name:>34} {scale:>10,} {seconds:>9.3f}s {record["rows_per_s"]:>14,.0f} rows/s '
+          f'{record["mb_per_s"]:>9.2f} MB/s')
+    return record
+
+
+def bench_pipeline(scales=(1_000, 10_000), threads: int = 1, seed: int = 0) -> list:
+    """
+    Time the functions of the works flattener and the whole pipeline on a synthetic snapshot of every scale
+    (number of works, see synthetic.generate_snapshot), each measured once:
+    get_skip_ids building the merged IDs cache, convert_openalex_id_to_int(s) and reconstruct_abstract(s) over the
+    IDs and abstracts of the snapshot, process_work_json over every file, write_to_csv_and_parquet for every kind
+    of the parsed rows, and flatten_works and flatten_authors_parquet on threads processes.
+    """
+    old_config = flatten_openalex.CONFIG
+    print(f'{"function":>34} {"scale":>10} {"time":>10} {"rows/s":>21} {"MB/s":>14}')
+    results = []
+    try:
+        for scale in scales:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                temp_dir = Path(temp_dir)
+                generate_snapshot(temp_dir / 'snapshot', num_works=scale, seed=seed)
+                # through the config, so that pool workers that do not fork get the paths too
+                flatten_openalex.configure(snapshot_dir=temp_dir / 'snapshot', parq_dir=temp_dir / 'parquet',
+                                           csv_dir=temp_dir / 'csv')
+                results.extend(bench_snapshot(scale, threads=threads))
+    finally:
+        flatten_openalex.set_config(old_config)
+    return results
+
+
+def bench_snapshot(scale: int, threads: int) -> list:
+    snapshot_dir, parq_dir = flatten_openalex.SNAPSHOT_DIR, flatten_openalex.PARQ_DIR
+    works_files = sorted((snapshot_dir / 'data' / 'works').glob('*/*.gz'))
+    works_bytes = sum(path.stat().st_size for path in works_files)
+    authors_bytes = sum(path.stat().st_size for path in (snapshot_dir / 'data' / 'authors').glob('*/*.gz'))
+    works = [orjson.loads(line) for path in works_files for line in iter_jsonl_lines(path)]
+    results = []
+
+    # the whole pipeline first, it also creates the directories of the kinds
+    seconds, _ = timed(lambda: quiet_call(flatten_openalex.flatten_works, threads=threads))
+    results.append(throughput(f'flatten_works[threads={threads}]', scale, seconds, len(works), works_bytes))
+    seconds, _ = timed(lambda: quiet_call(flatten_openalex.flatten_authors_parquet, threads=threads))
+    num_authors = sum(1 for path in (snapshot_dir / 'data' / 'authors').glob('*/*.gz') for _ in iter_jsonl_lines(path))
+    results.append(throughput(f'flatten_authors_parquet[threads={threads}]', scale, seconds, num_authors,
+                              authors_bytes))
+
+    for path in (parq_dir / 'temp').glob('merged_ids_works_*.npy'):
+        path.unlink()  # time building the cache, not loading it
+    merged_ids_files = list((snapshot_dir / 'data' / 'merged_ids' / 'works').glob('*.csv.gz'))
+    seconds, skip_ids = timed(lambda: quiet_call(flatten_openalex.get_skip_ids, 'works'))
+    results.append(throughput('get_skip_ids', scale, seconds, len(skip_ids),
+                              sum(path.stat().st_size for path in merged_ids_files)))
+
+    openalex_ids = [id_ for work in works for id_ in work['referenced_works']]
+    seconds, _ = timed(lambda: [convert_openalex_id_to_int(id_) for id_ in openalex_ids])
+    results.append(throughput('convert_openalex_id_to_int', scale, seconds, len(openalex_ids),
+                              sum(map(len, openalex_ids))))
+    seconds, _ = timed(lambda: convert_openalex_ids_to_int(openalex_ids))
+    results.append(throughput('convert_openalex_ids_to_int', scale, seconds, len(openalex_ids),
+                              sum(map(len, openalex_ids))))
+
+    inv_abstracts = [work['abstract_inverted_index'] for work in works if work['abstract_inverted_index']]
+    abstracts_bytes = sum(len(orjson.dumps(inv_abstract)) for inv_abstract in inv_abstracts)
+    seconds, _ = timed(lambda: [reconstruct_abstract(inv_abstract) for inv_abstract in inv_abstracts])
+    results.append(throughput('reconstruct_abstract', scale, seconds, len(inv_abstracts), abstracts_bytes))
+    seconds, _ = timed(lambda: reconstruct_abstracts(inv_abstracts))
+    results.append(throughput('reconstruct_abstracts', scale, seconds, len(inv_abstracts), abstracts_bytes))
+
+    completion_log = CompletionLog(path=parq_dir / 'temp' / 'benchmark_works.jsonl', root=parq_dir)
+    seconds, _ = timed(lambda: [quiet_call(flatten_openalex.process_work_json, skip_ids=skip_ids,
+                                           jsonl_file_name=str(path), completion_log=completion_log)
+                                for path in works_files])
+    results.append(throughput('process_work_json', scale, seconds, len(works), works_bytes))
+
+    rows = {kind: flatten_openalex.ArrowTableBuilder(kind) for kind in flatten_openalex.WORKS_KINDS}
+    for path in works_files:
+        for line in iter_jsonl_lines(path):
+            flatten_openalex.parse_work(orjson.loads(line), skip_ids, rows)
+    seconds, outputs = timed(lambda: [flatten_openalex.write_to_csv_and_parquet(rows=kind_rows, kind=kind,
+                                                                                 json_filename=str(works_files[0]))
+                                      for kind, kind_rows in rows.items()])
+    results.append(throughput('write_to_csv_and_parquet', scale, seconds, sum(num_rows for _, num_rows in outputs),
+                              sum(path.stat().st_size for path, _ in outputs if path is not None)))
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_machine() -> dict:
+    return {'node': platform.node(), 'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'gzip_backend': gzip_backend.__name__}
+
+
+def load_runs(results_path: Path = RESULTS_PATH) -> list:
+    if not results_path.exists():
+        return []
+    with open(results_path, 'rb') as reader:
+        return [orjson.loads(line) for line in reader if line.strip()]
+
+
+def save_run(results: list, micro: Optional[dict] = None, results_path: Path = RESULTS_PATH) -> dict:
+    """
+    Append a run with the commit and machine it ran on to results_path
+    """
+    run = {'time': time.time(), 'commit': get_commit(), 'machine': get_machine(), 'results': results,
+           'micro': micro or {}}
+    append_json_lines(results_path, run)
+    print(f'Saved the results to {str(results_path)!r}')
+    return run
+
+
+def check_regressions(results: list, runs: list, tolerance: float = 0.2) -> list:
+    """
+    Compare results with the last run in runs on the same machine, and return the benchmarks whose rows/s dropped
+    by more than tolerance. Single measurements are noisy, so rerun before trusting a small regression.
+    """
+    machine = get_machine()
+    previous_runs = [run for run in runs if run['machine'] == machine]
+    if len(previous_runs) == 0:
+        print('No earlier run on this machine to compare with')
+        return []
+
+    previous = {(result['name'], result['scale']): result for result in previous_runs[-1]['results']}
+    regressions = []
+    for result in results:
+        if (old_result := previous.get((result['name'], result['scale']))) is None:
+            continue
+        change = result['rows_per_s'] / old_result['rows_per_s'] - 1
+        if change < -tolerance:
+            regressions.append({**result, 'previous_rows_per_s': old_result['rows_per_s'], 'change': change})
+            print(f'REGRESSION {result["name"]} at {result["scale"]:,}: {result["rows_per_s"]:,.0f} rows/s, '
+                  f'{change:+.0%} since {previous_runs[-1]["commit"]}')
+    if len(regressions) == 0:
+        print(f'No regressions above {tolerance:.0%} since {previous_runs[-1]["commit"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the flattening pipeline')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1_000, 10_000],
+                        help='number of works of the synthetic snapshots')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--skip-micro', action='store_true', help='only run the pipeline benchmarks')
+    parser.add_argument('--results', type=Path, default=RESULTS_PATH)
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown reported as a regression')
+    cli_args = parser.parse_args()
+
+    micro = {}
+    if not cli_args.skip_micro:
+        micro = {'id_parsing': bench_id_parsing(), 'abstracts': bench_abstracts(),
+                 'jsonl_reading': bench_jsonl_reading()}
+    pipeline_results = bench_pipeline(scales=cli_args.scales, threads=cli_args.threads)
+
+    check_regressions(pipeline_results, load_runs(cli_args.results), tolerance=cli_args.tolerance)
+    if not cli_args.no_save:
+        save_run(pipeline_results, micro=micro, results_path=cli_args.results)
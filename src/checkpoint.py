@@ -0,0 +1,204 @@
+"""
+Append-only completion log for the flatteners.
+Every finished input file adds one JSON line with the row count, size and checksum of each Parquet it produced.
+Workers append to the same log under a file lock, and a line cut short by a crash is ignored on load,
+so the log never loses the progress of other workers and a restart only redoes missing or broken files.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from box import Box
+
+
+def file_checksum(path: Union[str, Path], block_size: int = 1 << 20) -> str:
+    """
+    SHA-256 hex digest of a file, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as reader:
+        while block := reader.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def append_json_lines(path: Union[str, Path], *records: dict):
+    """
+    Append records to a JSON lines file with a single write under an exclusive lock, then fsync them
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)  # O_APPEND alone is not enough on network file systems
+        size = os.fstat(fd).st_size
+        if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+            line = b'\n' + line  # start after a line cut short by a crash
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    return
+
+
+class CompletionLog:
+    """
+    Completion log stored as JSON lines at path, output paths are stored relative to root
+    Each record looks like
+    {"file": <input file>, "time": <unix time>, "status": "done" | "invalid" | "legacy",
+     "outputs": {<kind>: {"path": <relative path or null>, "rows": <int>, "bytes": <int>, "sha256": <str>}}}
+    The last record of a file wins.
+    """
+    def __init__(self, path: Union[str, Path], root: Union[str, Path]):
+        self.path = Path(path)
+        self.root = Path(root)
+
+    def append(self, *records: dict):
+        append_json_lines(self.path, *records)
+        return
+
+    def record(self, jsonl_file_name: Union[str, Path], outputs: dict):
+        """
+        Mark jsonl_file_name as done
+        outputs: {kind: (parquet path or None, number of rows)}
+        """
+        record_outputs = {}
+        for kind, (parq_filename, num_rows) in outputs.items():
+            if parq_filename is None:
+                record_outputs[kind] = {'path': None, 'rows': num_rows}
+                continue
+            parq_filename = Path(parq_filename)
+            record_outputs[kind] = {
+                'path': str(parq_filename.relative_to(self.root)),
+                'rows': num_rows,
+                'bytes': parq_filename.stat().st_size,
+                'sha256': file_checksum(parq_filename),
+            }
+
+        self.append({'file': str(jsonl_file_name), 'time': time.time(), 'status': 'done',
+                     'outputs': record_outputs})
+        return
+
+    def load(self) -> dict:
+        """
+        Latest record of every input file, skipping a truncated last line left behind by a crash
+        """
+        records = {}
+        if not self.path.exists():
+            return records
+
+        with open(self.path, 'rb') as reader:
+            for line in reader:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['file']] = Box(record)
+        return records
+
+    def finished_files(self, check_outputs: bool = True) -> set:
+        """
+        Input files that are done.
+        check_outputs: also check that each output still exists with its recorded size, a cheap stat per file
+        """
+        finished_files = set()
+        for filename, record in self.load().items():
+            if record.status == 'invalid':
+                continue
+            if check_outputs and record.status == 'done' and self.broken_outputs(record, checksums=False):
+                continue
+            finished_files.add(filename)
+        return finished_files
+
+    def broken_outputs(self, record: Box, checksums: bool = True) -> list:
+        """
+        Kinds of a record whose Parquet is missing, has the wrong size or, if checksums, the wrong checksum
+        """
+        broken = []
+        for kind, output in record.outputs.items():
+            if output.path is None:
+                continue
+            parq_filename = self.root / output.path
+            if not parq_filename.exists() or parq_filename.stat().st_size != output.bytes:
+                broken.append(kind)
+            elif checksums and file_checksum(parq_filename) != output.sha256:
+                broken.append(kind)
+        return broken
+
+    def verify(self, repair: bool = False, checksums: bool = True) -> list:
+        """
+        Check the outputs of every finished file against the log.
+        repair: delete the outputs of the broken files and mark them invalid, so the next run redoes them
+        Returns the broken input files
+        """
+        broken_files = []
+        num_legacy = 0
+        for filename, record in self.load().items():
+            if record.status == 'legacy':
+                num_legacy += 1
+                continue
+            if record.status != 'done':
+                continue
+
+            broken = self.broken_outputs(record, checksums=checksums)
+            if len(broken) == 0:
+                continue
+            print(f'{filename!r} has broken outputs: {broken}')
+            broken_files.append(filename)
+
+            if repair:
+                self.invalidate(filename)
+
+        print(f'Verified {self.path.name!r}: {len(broken_files):,} broken files'
+              + (f', {num_legacy:,} legacy entries without checksums' if num_legacy > 0 else '')
+              + (' (repaired)' if repair and len(broken_files) > 0 else ''))
+        return broken_files
+
+    def invalidate(self, *filenames: Union[str, Path]):
+        """
+        Delete the recorded outputs of filenames and mark them invalid, so the next run redoes them
+        Returns the number of Parquets deleted
+        """
+        records = self.load()
+        num_deleted = 0
+        for filename in map(str, filenames):
+            record = records.get(filename)
+            for output in (record.outputs.values() if record is not None else []):
+                if output.path is not None and (self.root / output.path).exists():
+                    (self.root / output.path).unlink()
+                    num_deleted += 1
+        self.append(*[{'file': str(filename), 'time': time.time(), 'status': 'invalid', 'outputs': {}}
+                      for filename in filenames])
+        return num_deleted
+
+    def import_legacy(self, finished_files: set):
+        """
+        Carry over the files of an old finished_*.pkl checkpoint, which has no row counts or checksums
+        """
+        self.append(*[{'file': str(filename), 'time': time.time(), 'status': 'legacy', 'outputs': {}}
+                      for filename in sorted(finished_files)])
+        return
+
+
+def get_completion_log(kind: str, parq_dir: Union[str, Path], legacy_pickle_path: Optional[Path] = None):
+    """
+    Completion log of a flattener at parq_dir/temp/finished_{kind}.jsonl.
+    If there is no log yet but an old pickle checkpoint exists, its files are imported as legacy entries.
+    """
+    parq_dir = Path(parq_dir)
+    completion_log = CompletionLog(path=parq_dir / 'temp' / f'finished_{kind}.jsonl', root=parq_dir)
+
+    if not completion_log.path.exists() and legacy_pickle_path is not None and legacy_pickle_path.exists():
+        from src.utils import load_pickle  # numpy and pyarrow, only needed for the old checkpoints
+
+        legacy_files = load_pickle(legacy_pickle_path)
+        print(f'Importing {len(legacy_files):,} finished files from {legacy_pickle_path.name!r}')
+        completion_log.import_legacy(legacy_files)
+    return completion_log
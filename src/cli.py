@@ -0,0 +1,219 @@
+"""
+Command line entry point of the flatteners
+    python -m src.cli flatten works --threads 7 [--files 10] [--no-abstracts]
+    python -m src.cli flatten concepts --threads 7 --basedir /data/openalex --month mar-2023
+    python -m src.cli flatten authors --csv --csv-codec zstd --csv-level 3
+    python -m src.cli status works authors
+    python -m src.cli verify works [--repair]
+    python -m src.cli update works --threads 7 [--apply-deletes] [--dry-run]
+The paths come from the options, a JSON file passed with --config, the OPENALEX_* environment variables or the
+defaults, see src/config.py. The stages run with python -m (src.slices, src.dedup, src.compact, src.normalize) take
+the same path options. pandas, pyarrow and the flatteners are only imported by flatten and update, so status
+and verify start right away and create no directories.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.extend(['../', './'])
+from src.config import DEFAULTS, get_paths, load_config
+
+FLATTEN_ENTITIES = ['works', 'abstracts', 'authors', 'concepts', 'venues', 'institutions']
+# completion logs of the Parquet flatteners: {name: (manifest entity, log kind)}
+COMPLETION_LOGS = {
+    'works': ('works', 'works'),
+    'abstracts': ('works', 'works_abstracts'),
+    'authors': ('authors', 'authors'),
+    'concepts': ('concepts', 'concepts'),
+    'venues': ('venues', 'venues'),
+    'institutions': ('institutions', 'institutions'),
+}
+CSV_FLATTENERS = ['authors', 'concepts', 'venues', 'institutions']  # entities with an old CSV flattener
+UPDATE_ENTITIES = ['works', 'authors']  # the entities of src/incremental.py
+CSV_CODECS = ['gzip', 'zstd', 'none']  # the codecs of utils.CSV_CODECS, without importing pyarrow
+
+
+def files_to_process(value: str):
+    return value if value == 'all' else int(value)
+
+
+def get_overrides(cli_args: argparse.Namespace) -> dict:
+    return {key: getattr(cli_args, key) for key in DEFAULTS}
+
+
+def get_paths_parser() -> argparse.ArgumentParser:
+    """
+    Parent parser of the path options, shared by the subcommands and the pipeline stages run with python -m
+    """
+    paths_parser = argparse.ArgumentParser(add_help=False)
+    paths_group = paths_parser.add_argument_group('paths')
+    paths_group.add_argument('--config', type=Path, help='JSON file with any of the settings below')
+    paths_group.add_argument('--basedir', help=f'{DEFAULTS["basedir"]!r} by default')
+    paths_group.add_argument('--month', help=f'{DEFAULTS["month"]!r} by default, names the CSV and Parquet dirs')
+    paths_group.add_argument('--snapshot-dir', dest='snapshot_dir', help='basedir/openalex-snapshot by default')
+    paths_group.add_argument('--csv-dir', dest='csv_dir',
+                             help='basedir/processed-snapshots/csv-files/{month} by default')
+    paths_group.add_argument('--parq-dir', dest='parq_dir',
+                             help='basedir/processed-snapshots/parquet-files/{month} by default')
+    return paths_parser
+
+
+def configure_paths(cli_args: argparse.Namespace):
+    """
+    Point the flatteners, and the stages reading their Parquets, at the paths of the options of get_paths_parser
+    """
+    import src.flatten_openalex as flatten_openalex
+
+    flatten_openalex.configure(cli_args.config, **get_overrides(cli_args))
+    return flatten_openalex
+
+
+def flatten(cli_args: argparse.Namespace) -> int:
+    flatten_openalex = configure_paths(cli_args)  # pandas, pyarrow and friends, only when flattening
+    print(f'Flattening {cli_args.entity!r} from {str(flatten_openalex.SNAPSHOT_DIR)!r}')
+
+    entity = cli_args.entity
+    parallel_kwargs = dict(files_to_process=cli_args.files, threads=cli_args.threads, chunk_size=cli_args.chunk_size)
+    csv_kwargs = dict(codec=cli_args.csv_codec, level=cli_args.csv_level)
+    if entity == 'works':
+        flatten_openalex.flatten_works(**parallel_kwargs, abstracts=not cli_args.no_abstracts,
+                                       profile=cli_args.profile)
+    elif entity == 'abstracts':
+        flatten_openalex.flatten_abstracts(**parallel_kwargs)
+    elif entity == 'authors' and cli_args.csv:
+        flatten_openalex.flatten_authors(files_to_process=cli_args.files, chunk_size=cli_args.chunk_size,
+                                         **csv_kwargs)
+    elif entity == 'authors':
+        flatten_openalex.flatten_authors_parquet(**parallel_kwargs)
+    elif cli_args.csv:  # the single process CSV flatteners of the small entities go through every file
+        getattr(flatten_openalex, f'flatten_{entity}')(**csv_kwargs)
+    else:
+        getattr(flatten_openalex, f'flatten_{entity}_parquet')(files_to_process=cli_args.files,
+                                                               threads=cli_args.threads)
+    return 0
+
+
+def update(cli_args: argparse.Namespace) -> int:
+    import src.incremental as incremental
+
+    flatten_openalex = configure_paths(cli_args)
+    print(f'Updating {cli_args.entity!r} from {str(flatten_openalex.SNAPSHOT_DIR)!r}')
+    incremental.update_snapshot(entity=cli_args.entity, threads=cli_args.threads, chunk_size=cli_args.chunk_size,
+                                apply_deletes=cli_args.apply_deletes, dry_run=cli_args.dry_run)
+    return 0
+
+
+def read_manifest_counts(snapshot_dir: Path, entity: str) -> dict:
+    """
+    {input file: number of records} of the manifest of entity, with the file names of read_manifest
+    """
+    manifest_path = snapshot_dir / 'data' / entity / 'manifest'
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as reader:
+        manifest = json.load(reader)
+    return {str(snapshot_dir / 'data' / entry['url'].replace('s3://openalex/data/', '')): entry['meta']['record_count']
+            for entry in manifest['entries']}
+
+
+def status(cli_args: argparse.Namespace) -> int:
+    from src.checkpoint import get_completion_log
+
+    paths = get_paths(load_config(cli_args.config, **get_overrides(cli_args)))
+    print(f'Snapshot at {str(paths["SNAPSHOT_DIR"])!r}, Parquets at {str(paths["PARQ_DIR"])!r}')
+    for name in cli_args.names or list(COMPLETION_LOGS):
+        entity, log_kind = COMPLETION_LOGS[name]
+        completion_log = get_completion_log(kind=log_kind, parq_dir=paths['PARQ_DIR'])
+        records = completion_log.load()
+        finished_files = completion_log.finished_files(check_outputs=not cli_args.no_check)
+        manifest_counts = read_manifest_counts(paths['SNAPSHOT_DIR'], entity)
+        num_invalid = sum(record.status == 'invalid' for record in records.values())
+
+        message = f'{name}: {len(finished_files):,} of {len(manifest_counts):,} files done'
+        if len(manifest_counts) > 0:
+            finished_records = sum(manifest_counts.get(filename, 0) for filename in finished_files)
+            total_records = sum(manifest_counts.values())
+            message += (f', {finished_records:,} of {total_records:,} records '
+                        f'({finished_records / max(total_records, 1):.1%})')
+        if len(records) - num_invalid > len(finished_files):
+            message += f', {len(records) - num_invalid - len(finished_files):,} with missing outputs'
+        if num_invalid > 0:
+            message += f', {num_invalid:,} invalidated'
+        print(message)
+    return 0
+
+
+def verify(cli_args: argparse.Namespace) -> int:
+    from src.checkpoint import get_completion_log
+
+    paths = get_paths(load_config(cli_args.config, **get_overrides(cli_args)))
+    num_broken = 0
+    for name in cli_args.names or list(COMPLETION_LOGS):
+        completion_log = get_completion_log(kind=COMPLETION_LOGS[name][1], parq_dir=paths['PARQ_DIR'])
+        num_broken += len(completion_log.verify(repair=cli_args.repair, checksums=not cli_args.no_checksums))
+    return 1 if num_broken > 0 and not cli_args.repair else 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    paths_parser = get_paths_parser()
+    parser = argparse.ArgumentParser(description='Flatten OpenAlex snapshots into CSVs and Parquets')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    flatten_parser = subparsers.add_parser('flatten', parents=[paths_parser], help='flatten the files of an entity')
+    flatten_parser.add_argument('entity', choices=FLATTEN_ENTITIES,
+                                help='abstracts is the deferred pass of flatten works --no-abstracts')
+    flatten_parser.add_argument('--threads', type=int, default=1, help='worker processes')
+    flatten_parser.add_argument('--files', type=files_to_process, default='all',
+                                help='number of files to flatten in this run, all of them by default')
+    flatten_parser.add_argument('--chunk-size', type=int, help='stream each file in chunks of this many rows')
+    flatten_parser.add_argument('--no-abstracts', action='store_true', help='leave out works_abstracts')
+    flatten_parser.add_argument('--profile', action='store_true', help='dump a cProfile of every works file')
+    flatten_parser.add_argument('--csv', action='store_true',
+                                help=f'use the old CSV flattener of any of {CSV_FLATTENERS} instead of Parquets')
+    flatten_parser.add_argument('--csv-codec', default='gzip', choices=list(CSV_CODECS),
+                                help='compression of the CSVs, zstd writes .csv.zst files')
+    flatten_parser.add_argument('--csv-level', type=int,
+                                help='compression level of the CSVs, the default of the codec if unset')
+    flatten_parser.set_defaults(func=flatten)
+
+    update_parser = subparsers.add_parser('update', parents=[paths_parser],
+                                          help='flatten only the files that changed since the last update')
+    update_parser.add_argument('entity', choices=UPDATE_ENTITIES)
+    update_parser.add_argument('--threads', type=int, default=1, help='worker processes')
+    update_parser.add_argument('--chunk-size', type=int, help='stream each file in chunks of this many rows')
+    update_parser.add_argument('--apply-deletes', action='store_true',
+                               help='also delete the IDs of the new merged_ids files from the Parquets')
+    update_parser.add_argument('--dry-run', action='store_true', help='only print the changed files')
+    update_parser.set_defaults(func=update)
+
+    status_parser = subparsers.add_parser('status', parents=[paths_parser],
+                                          help='progress of the Parquet flatteners from their completion logs')
+    status_parser.add_argument('names', nargs='*', help=f'any of {list(COMPLETION_LOGS)}, all of them by default')
+    status_parser.add_argument('--no-check', action='store_true',
+                               help='do not stat the Parquets of the finished files')
+    status_parser.set_defaults(func=status)
+
+    verify_parser = subparsers.add_parser('verify', parents=[paths_parser],
+                                          help='check the Parquets against the completion logs')
+    verify_parser.add_argument('names', nargs='*', help=f'any of {list(COMPLETION_LOGS)}, all of them by default')
+    verify_parser.add_argument('--repair', action='store_true',
+                               help='delete the broken Parquets so the next run redoes their files')
+    verify_parser.add_argument('--no-checksums', action='store_true', help='only compare the sizes')
+    verify_parser.set_defaults(func=verify)
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = get_parser()
+    cli_args = parser.parse_args(argv)
+    if cli_args.command == 'flatten' and cli_args.csv and cli_args.entity not in CSV_FLATTENERS:
+        parser.error(f'--csv only applies to {CSV_FLATTENERS}')
+    unknown_names = set(getattr(cli_args, 'names', [])) - set(COMPLETION_LOGS)
+    if len(unknown_names) > 0:  # not choices=, argparse rejects an empty list of them
+        parser.error(f'no completion logs named {sorted(unknown_names)}, choose from {list(COMPLETION_LOGS)}')
+    return cli_args.func(cli_args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
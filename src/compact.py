@@ -0,0 +1,249 @@
+"""
+Compaction of the per-partition Parquets written by the flatteners.
+Every kind of the works is rewritten into a dataset partitioned by publication_year and sorted by work_id, in row groups
+of a fixed size with column statistics, so that year windows only read their partitions and filters on work_id can
+skip row groups and files.
+    PARQ_DIR/compacted/works_authorships/publication_year=2001/part-000.parquet
+Each year is split into num_buckets consecutive ranges of work_id cut from a sample of the rows, one file per range,
+so a year is never sorted in memory at once and memory is bounded by the size of a range. Raise num_buckets for
+larger snapshots.
+Run with python -m src.compact [kinds ...] [--parq-dir ...] from the root of the repo, with the path options of
+python -m src.cli.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.extend(['../', './'])
+import src.flatten_openalex as flatten_openalex
+from src.cli import configure_paths, get_paths_parser
+from src.incremental import drop_tombstoned, read_tombstones
+from src.utils import parallel_largest_first
+
+YEAR_PARTITIONING = ds.partitioning(pa.schema([('publication_year', pa.int16())]), flavor='hive')
+SPILL_PARTITIONING = ds.partitioning(pa.schema([('publication_year', pa.int16()), ('bucket', pa.int16())]),
+                                     flavor='hive')
+ROW_GROUP_SIZE = 256 * 1024  # rows, large enough for fast scans, small enough for the statistics to prune
+NUM_BUCKETS = 16  # ranges of work_id of every publication year
+SAMPLE_EVERY = 100  # the ranges are cut from every SAMPLE_EVERY-th row
+YEAR_SHIFT = 40  # bits of work_id below the year in the (year, work_id) keys of the ranges
+
+
+def get_kind_dir(kind: str, compacted: bool = False, deduped: bool = False) -> Path:
+    """
+    Directory of a works kind, the flattened one by default, or the one written by src.dedup or by the compaction
+    """
+    kind_ = 'works' if kind == 'works' else f'works_{kind}'
+    if compacted:
+        return flatten_openalex.PARQ_DIR / 'compacted' / kind_
+    return flatten_openalex.PARQ_DIR / 'deduped' / kind_ if deduped else flatten_openalex.PARQ_DIR / kind_
+
+
+def read_compacted(kind: str, filter: Optional[pc.Expression] = None, columns: Optional[list] = None) -> pa.Table:
+    """
+    Read a compacted kind, a filter on publication_year only opens the matching partitions, eg
+    read_compacted('authorships', filter=(pc.field('publication_year') >= 1990) & (pc.field('publication_year') < 2000))
+    """
+    dataset = ds.dataset(get_kind_dir(kind, compacted=True), format='parquet', partitioning=YEAR_PARTITIONING)
+    return dataset.to_table(filter=filter, columns=columns)
+
+
+def get_work_years(works_dir: Path) -> tuple:
+    """
+    Sorted work IDs with their publication years from the compacted works, nulls are -1
+    """
+    works = ds.dataset(works_dir, format='parquet', partitioning=YEAR_PARTITIONING) \
+        .to_table(columns=['work_id', 'publication_year'])
+    work_ids = works.column('work_id').to_numpy()
+    years = works.column('publication_year').cast(pa.int16()).fill_null(-1).to_numpy()
+    order = np.argsort(work_ids, kind='stable')
+    return work_ids[order], years[order]
+
+
+def with_publication_year(batches, work_ids: np.ndarray, years: np.ndarray, name: str = 'publication_year'):
+    """
+    Add the publication year of the work to every row of the record batches of a kind that does not have one,
+    as the column name
+    """
+    for batch in batches:
+        batch_ids = batch.column('work_id').to_numpy(zero_copy_only=False)
+        positions = np.minimum(np.searchsorted(work_ids, batch_ids), max(len(work_ids) - 1, 0))
+        found = work_ids[positions] == batch_ids if len(work_ids) > 0 else np.zeros(len(batch_ids), dtype=bool)
+        batch_years = np.where(found, years[positions] if len(years) > 0 else -1, -1)
+        yield batch.append_column(name, pa.array(batch_years, mask=batch_years == -1, type=pa.int16()))
+
+
+def get_range_keys(work_ids: np.ndarray, years: np.ndarray) -> np.ndarray:
+    """
+    (year, work_id) as one int64 that sorts by year then work_id, missing years (-1) first
+    """
+    return ((years.astype(np.int64) + 1) << YEAR_SHIFT) | work_ids.astype(np.int64)
+
+
+def get_range_bounds(batches, num_buckets: int) -> np.ndarray:
+    """
+    Sorted keys of the num_buckets - 1 boundaries of the ranges of work_id of every publication year, with about as
+    many rows each, from every SAMPLE_EVERY-th row of the record batches with work_id and publication_year
+    """
+    work_ids, years = [], []
+    for batch in batches:
+        work_ids.append(batch.column('work_id').to_numpy(zero_copy_only=False)[:: SAMPLE_EVERY])
+        years.append(batch.column('publication_year').cast(pa.int16()).fill_null(-1).to_numpy()[:: SAMPLE_EVERY])
+    if len(work_ids) == 0 or num_buckets < 2:
+        return np.zeros(0, dtype=np.int64)
+    work_ids, years = np.concatenate(work_ids), np.concatenate(years)
+    bounds = [get_range_keys(np.quantile(work_ids[years == year], np.arange(1, num_buckets) / num_buckets,
+                                         method='lower'), np.full(num_buckets - 1, year))
+              for year in np.unique(years)]
+    return np.unique(np.concatenate(bounds))
+
+
+def with_bucket(batches, bounds: np.ndarray, name: str = 'bucket'):
+    """
+    Add the range of work_id of its publication year to every row of the record batches, as the column name
+    """
+    for batch in batches:
+        work_ids = batch.column('work_id').to_numpy(zero_copy_only=False)
+        years = batch.column('publication_year').cast(pa.int16()).fill_null(-1).to_numpy()
+        buckets = np.searchsorted(bounds, get_range_keys(work_ids, years), side='right') - \
+            np.searchsorted(bounds, get_range_keys(np.zeros(len(years), dtype=np.int64), years), side='left')
+        yield batch.append_column(name, pa.array(buckets, type=pa.int16()))
+
+
+def drop_pandas_column(schema: pa.Schema, name: str) -> pa.Schema:
+    """
+    Remove a column from the pandas metadata of schema, pd.read_parquet otherwise expects it in the files
+    """
+    if schema.pandas_metadata is None:
+        return schema
+    pandas_metadata = schema.pandas_metadata
+    pandas_metadata['columns'] = [col for col in pandas_metadata['columns'] if col['name'] != name]
+    return schema.with_metadata({**schema.metadata, b'pandas': json.dumps(pandas_metadata).encode('utf-8')})
+
+
+def sort_partition(spill_dir: str, out_filename: str, row_group_size: int, compression: str):
+    """
+    Sort the rows of one range of work_id of a publication_year partition by work_id and write them out in row groups
+    of row_group_size
+    """
+    table = ds.dataset(spill_dir, format='parquet').to_table()
+    table = table.take(pc.sort_indices(table, sort_keys=[('work_id', 'ascending')]))
+    table = table.replace_schema_metadata(drop_pandas_column(table.schema, 'publication_year').metadata)
+
+    out_filename = Path(out_filename)
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = out_filename.with_name(out_filename.name + '.tmp')
+    pq.write_table(table, temp_filename, row_group_size=row_group_size, compression=compression,
+                   write_statistics=True, coerce_timestamps='ms', allow_truncated_timestamps=True)
+    os.replace(temp_filename, out_filename)
+    return table.num_rows
+
+
+def compact_kind(kind: str, threads: int = 1, row_group_size: int = ROW_GROUP_SIZE, compression: str = 'snappy',
+                 deduped: bool = False, num_buckets: int = NUM_BUCKETS):
+    """
+    Compact one works kind into PARQ_DIR/compacted, in two out-of-core passes
+    1. stream the flattened Parquets into one spill directory per publication_year and range of work_id, looking up
+       the year of the kinds that do not have one in the compacted works, which are compacted first. The ranges are
+       cut from a sample taken in a first scan of the work_id and publication_year columns.
+    2. sort every range by work_id on threads processes, largest first, into a file of its year
+    The new dataset replaces the old one only once it is complete. The tombstoned works are left out.
+    deduped: read the deduplicated kind of src.dedup instead of the flattened one
+    num_buckets: ranges of work_id per year, peak memory is about the size of the largest one
+    """
+    source = ds.dataset(get_kind_dir(kind, deduped=deduped), format='parquet')
+    out_dir = get_kind_dir(kind, compacted=True)
+    spill_dir, temp_dir = out_dir.with_name(out_dir.name + '.spill'), out_dir.with_name(out_dir.name + '.tmp')
+    for path in (spill_dir, temp_dir):
+        if path.exists():
+            shutil.rmtree(path)
+
+    tombstones = read_tombstones('works')
+    scan = lambda columns=None: drop_tombstoned(source.to_batches(columns=columns), tombstones)
+
+    schema = source.schema
+    if 'publication_year' in schema.names:
+        schema = schema.set(schema.get_field_index('publication_year'), pa.field('publication_year', pa.int16()))
+        get_batches = scan
+        key_columns = ['work_id', 'publication_year']
+    else:
+        works_dir = get_kind_dir('works', compacted=True)
+        assert works_dir.exists(), f'Compact the works before {kind!r}, the publication years come from them'
+        work_ids, years = get_work_years(works_dir)
+        schema = schema.append(pa.field('publication_year', pa.int16()))
+        get_batches = lambda columns=None: with_publication_year(scan(columns=columns), work_ids=work_ids,
+                                                                 years=years)
+        key_columns = ['work_id']
+
+    bounds = get_range_bounds(get_batches(columns=key_columns), num_buckets=num_buckets)
+    spill_schema = schema.append(pa.field('bucket', pa.int16()))
+    data = pa.RecordBatchReader.from_batches(
+        spill_schema, with_bucket((batch.cast(schema) for batch in get_batches()), bounds=bounds)
+    )
+
+    print(f'Spilling {kind!r} into {num_buckets} ranges of work_id of every publication_year')
+    ds.write_dataset(data, spill_dir, format='parquet', partitioning=SPILL_PARTITIONING,
+                     max_partitions=max(4096, 512 * num_buckets), existing_data_behavior='overwrite_or_ignore')
+
+    year_dirs = sorted(path for path in spill_dir.iterdir() if path.is_dir())
+    bucket_dirs = [bucket_dir for year_dir in year_dirs for bucket_dir in sorted(year_dir.iterdir())
+                   if bucket_dir.is_dir()]
+    sizes = [sum(file.stat().st_size for file in bucket_dir.iterdir()) for bucket_dir in bucket_dirs]
+    args = [(str(bucket_dir), str(temp_dir / bucket_dir.parent.name /
+                                  f'part-{int(bucket_dir.name.split("=")[1]):03d}.parquet'),
+             row_group_size, compression) for bucket_dir in bucket_dirs]
+    if threads > 1:
+        num_rows = parallel_largest_first(func=sort_partition, args=args, sizes=sizes, num_workers=threads,
+                                          names=[f'{bucket_dir.parent.name}/{bucket_dir.name}'
+                                                 for bucket_dir in bucket_dirs], unit='bytes')
+    else:
+        num_rows = [sort_partition(*arg) for arg in args]
+
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    os.replace(temp_dir, out_dir)
+    shutil.rmtree(spill_dir)
+    print(f'Compacted {kind!r}: {sum(num_rows):,} rows in {len(year_dirs):,} publication years')
+    return
+
+
+def compact_works(kinds: Optional[list] = None, threads: int = 1, row_group_size: int = ROW_GROUP_SIZE,
+                  compression: str = 'snappy', deduped: bool = False, num_buckets: int = NUM_BUCKETS):
+    """
+    Compact the works kinds, the works themselves first since the other kinds take their publication years from them
+    """
+    kinds = kinds or flatten_openalex.WORKS_KINDS
+    kinds = sorted(kinds, key=lambda kind: kind != 'works')
+    for kind in kinds:
+        if not any(get_kind_dir(kind, deduped=deduped).glob('*.parquet')):
+            print(f'No Parquets for {kind!r}, skipping')
+            continue
+        compact_kind(kind, threads=threads, row_group_size=row_group_size, compression=compression, deduped=deduped,
+                     num_buckets=num_buckets)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact the works Parquets into year-partitioned datasets',
+                                     parents=[get_paths_parser()])
+    parser.add_argument('kinds', nargs='*', help='works kinds to compact, all of them by default')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('--compression', default='snappy')
+    parser.add_argument('--deduped', action='store_true', help='compact the output of src.dedup')
+    parser.add_argument('--buckets', type=int, default=NUM_BUCKETS, help='ranges of work_id of every year')
+    cli_args = parser.parse_args()
+    configure_paths(cli_args)
+
+    compact_works(kinds=cli_args.kinds or None, threads=cli_args.threads, row_group_size=cli_args.row_group_size,
+                  compression=cli_args.compression, deduped=cli_args.deduped, num_buckets=cli_args.buckets)
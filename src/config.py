@@ -0,0 +1,56 @@
+"""
+Paths of the snapshot and of the flattened files.
+Every setting comes from, in order of precedence, the command line, a JSON config file, the environment or the
+defaults below
+    {"basedir": "/N/project/openalex/ssikdar", "month": "feb-2023"}
+    OPENALEX_BASEDIR=/data/openalex OPENALEX_MONTH=mar-2023 python -m src.cli status works
+Only the standard library is imported and no directory is created here, the flatteners make the ones they write to.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+DEFAULTS = {
+    'basedir': '/N/project/openalex/ssikdar',  # directory where you have downloaded the OpenAlex snapshots
+    'month': 'feb-2023',
+    'snapshot_dir': None,  # basedir/openalex-snapshot
+    'csv_dir': None,  # basedir/processed-snapshots/csv-files/{month}
+    'parq_dir': None,  # basedir/processed-snapshots/parquet-files/{month}
+}
+ENV_PREFIX = 'OPENALEX_'
+
+
+def load_config(config_path: Optional[Union[str, Path]] = None, **overrides) -> dict:
+    """
+    Settings from the defaults, the OPENALEX_* environment variables, the JSON file at config_path and overrides,
+    later ones win and overrides that are None are ignored
+    """
+    config = dict(DEFAULTS)
+    for key in DEFAULTS:
+        if os.environ.get(ENV_PREFIX + key.upper()):
+            config[key] = os.environ[ENV_PREFIX + key.upper()]
+    if config_path is not None:
+        with open(config_path) as reader:
+            file_config = json.load(reader)
+        unknown_keys = set(file_config) - set(DEFAULTS)
+        assert len(unknown_keys) == 0, f'Unknown settings in {str(config_path)!r}: {sorted(unknown_keys)}'
+        config.update(file_config)
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def get_paths(config: Optional[dict] = None) -> dict:
+    """
+    BASEDIR, SNAPSHOT_DIR, MONTH, CSV_DIR and PARQ_DIR of a config, the load_config() one by default
+    """
+    config = config if config is not None else load_config()
+    basedir = Path(config['basedir'])
+    month = config['month']
+    return {
+        'BASEDIR': basedir,
+        'SNAPSHOT_DIR': Path(config['snapshot_dir'] or basedir / 'openalex-snapshot'),
+        'MONTH': month,
+        'CSV_DIR': Path(config['csv_dir'] or basedir / 'processed-snapshots' / 'csv-files' / month),
+        'PARQ_DIR': Path(config['parq_dir'] or basedir / 'processed-snapshots' / 'parquet-files' / month),
+    }
@@ -0,0 +1,195 @@
+"""
+Deduplication of the works across the per-partition Parquets written by the flatteners.
+A work updated after a snapshot shows up again in a later updated_date partition, so it has rows in more than one
+partition of every kind. Only the rows of its latest version are kept: the version with the latest updated_date,
+and of the latest partition on ties. Every kind is rewritten into hash buckets of work_id, sorted by work_id
+    PARQ_DIR/deduped/works_authorships/part-000.parquet
+Memory is bounded by the size of a bucket: the rows are streamed into a spill directory per bucket, and each bucket is
+deduplicated on its own. Raise num_buckets for larger snapshots. The works tombstoned by python -m src.cli update are
+dropped along the way.
+Run with python -m src.dedup [kinds ...] [--threads N] [--parq-dir ...] from the root of the repo, with the path
+options of python -m src.cli. The compaction, slices and normalization take --deduped to read from the deduplicated
+kinds.
+"""
+import argparse
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.extend(['../', './'])
+import src.flatten_openalex as flatten_openalex
+from src.cli import configure_paths, get_paths_parser
+from src.compact import get_kind_dir, ROW_GROUP_SIZE
+from src.incremental import drop_tombstoned, read_tombstones
+from src.utils import parallel_largest_first
+
+BUCKET_PARTITIONING = ds.partitioning(pa.schema([('bucket', pa.int16())]), flavor='hive')
+NUM_BUCKETS = 64
+
+
+def with_source(parq_files: list, sources: dict, num_buckets: int, tombstones: np.ndarray):
+    """
+    Record batches of parq_files with the index of their updated_date partition as source, from sources
+    {file name: index}, and the hash bucket of their work_id as bucket, without the rows of the tombstoned works
+    """
+    for parq_filename in parq_files:
+        source = sources[parq_filename.name]
+        for batch in drop_tombstoned(pq.ParquetFile(parq_filename).iter_batches(), tombstones):
+            buckets = batch.column('work_id').to_numpy(zero_copy_only=False) % num_buckets
+            yield (batch
+                   .append_column('source', pa.array(np.full(batch.num_rows, source, dtype=np.int32)))
+                   .append_column('bucket', pa.array(buckets, type=pa.int16())))
+
+
+def spill_kind(kind: str, spill_dir: Path, sources: dict, num_buckets: int, tombstones: np.ndarray):
+    """
+    Stream the Parquets of a kind into one spill directory per bucket of work_id
+    """
+    parq_files = sorted(get_kind_dir(kind).glob('*.parquet'))
+    schema = pq.read_schema(parq_files[0])
+    schema = schema.append(pa.field('source', pa.int32())).append(pa.field('bucket', pa.int16()))
+    data = pa.RecordBatchReader.from_batches(
+        schema, (batch.cast(schema) for batch in with_source(parq_files, sources=sources, num_buckets=num_buckets,
+                                                             tombstones=tombstones))
+    )
+    ds.write_dataset(data, spill_dir, format='parquet', partitioning=BUCKET_PARTITIONING,
+                     max_partitions=max(num_buckets, 1024), existing_data_behavior='overwrite_or_ignore')
+    return
+
+
+def is_first_of_run(values: np.ndarray) -> np.ndarray:
+    """
+    Mask of the first element of every run of equal values
+    """
+    return np.append(True, values[1:] != values[:-1]) if len(values) > 0 else np.zeros(0, dtype=bool)
+
+
+def find_latest_versions(works_spill_dir: str, out_filename: str) -> int:
+    """
+    The source of the latest version of every work in one bucket of the spilled works, sorted by work_id
+    """
+    works = ds.dataset(works_spill_dir, format='parquet').to_table(columns=['work_id', 'updated_date', 'source'])
+    works = works.take(pc.sort_indices(works, sort_keys=[('work_id', 'descending'), ('updated_date', 'descending'),
+                                                          ('source', 'descending')]))  # null updated_dates last
+    latest = works.select(['work_id', 'source']).filter(pa.array(is_first_of_run(works.column('work_id').to_numpy())))
+    latest = latest.take(pc.sort_indices(latest, sort_keys=[('work_id', 'ascending')]))
+    pq.write_table(latest, out_filename)
+    return latest.num_rows
+
+
+def dedup_bucket(kind: str, spill_dir: str, latest_filename: str, out_filename: str, row_group_size: int,
+                 compression: str) -> tuple:
+    """
+    Keep the rows of one bucket of a kind that come from the latest version of their work, sorted by work_id and
+    in their original order within a work. A work listed twice in its latest partition keeps its first works row.
+    Returns the number of rows kept and dropped.
+    """
+    table = ds.dataset(spill_dir, format='parquet').to_table()
+    num_rows = table.num_rows
+
+    if Path(latest_filename).exists():
+        latest = pq.read_table(latest_filename)
+        latest_ids, latest_sources = latest.column('work_id').to_numpy(), latest.column('source').to_numpy()
+        work_ids, sources = table.column('work_id').to_numpy(), table.column('source').to_numpy()
+        positions = np.minimum(np.searchsorted(latest_ids, work_ids), max(len(latest_ids) - 1, 0))
+        found = latest_ids[positions] == work_ids if len(latest_ids) > 0 else np.zeros(len(work_ids), dtype=bool)
+        table = table.filter(pa.array(~found | (latest_sources[positions] == sources)))  # no works row: keep them
+
+    table = table.take(pc.sort_indices(table, sort_keys=[('work_id', 'ascending')]))  # stable
+    if kind == 'works':
+        table = table.filter(pa.array(is_first_of_run(table.column('work_id').to_numpy())))
+    table = table.drop_columns(['source'])
+
+    out_filename = Path(out_filename)
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, out_filename, row_group_size=row_group_size, compression=compression,
+                   write_statistics=True, coerce_timestamps='ms', allow_truncated_timestamps=True)
+    return table.num_rows, num_rows - table.num_rows
+
+
+def dedup_works(kinds: Optional[list] = None, threads: int = 1, num_buckets: int = NUM_BUCKETS,
+                row_group_size: int = ROW_GROUP_SIZE, compression: str = 'snappy'):
+    """
+    Deduplicate the works kinds into PARQ_DIR/deduped, in two out-of-core passes
+    1. stream every kind into a spill directory per bucket of work_id, tagging the rows with their partition
+    2. find the latest version of every work in each bucket of the works, then keep the rows of that version in
+       each bucket of every kind, on threads processes
+    Each kind replaces its old directory only once it is complete, the other kinds are left as they are.
+    """
+    kinds = kinds or flatten_openalex.WORKS_KINDS
+    out_dir = flatten_openalex.PARQ_DIR / 'deduped'
+    temp_dir = out_dir.with_name(out_dir.name + '.tmp')
+    spill_dir = temp_dir / '.spill'
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    (spill_dir / 'latest').mkdir(parents=True)
+
+    def run(func, args: list, dirs: list):
+        if threads > 1:
+            return parallel_largest_first(func=func, args=args, names=[path.name for path in dirs], unit='bytes',
+                                          sizes=[sum(file.stat().st_size for file in path.iterdir()) for path in dirs],
+                                          num_workers=threads)
+        return [func(*arg) for arg in args]
+
+    # the partitions are named after their updated_date, so the later ones win ties of updated_date
+    works_files = sorted(get_kind_dir('works').glob('*.parquet'))
+    assert len(works_files) > 0, f'No works Parquets in {str(get_kind_dir("works"))!r}'
+    sources = {path.name: source for source, path in enumerate(works_files)}
+    tombstones = read_tombstones('works')
+
+    print(f'Spilling the works into {num_buckets} buckets of work_id')
+    spill_kind('works', spill_dir / 'works', sources=sources, num_buckets=num_buckets, tombstones=tombstones)
+    bucket_dirs = sorted((spill_dir / 'works').iterdir())
+    num_works = run(find_latest_versions, dirs=bucket_dirs,
+                    args=[(str(bucket_dir), str(spill_dir / 'latest' / f'{bucket_dir.name}.parquet'))
+                          for bucket_dir in bucket_dirs])
+    print(f'{sum(num_works):,} distinct works in {len(works_files):,} partitions')
+
+    for kind in kinds:
+        kind_ = 'works' if kind == 'works' else f'works_{kind}'
+        if not any(get_kind_dir(kind).glob('*.parquet')):
+            print(f'No Parquets for {kind!r}, skipping')
+            continue
+        if kind != 'works':
+            print(f'Spilling {kind!r} into {num_buckets} buckets of work_id')
+            spill_kind(kind, spill_dir / kind_, sources=sources, num_buckets=num_buckets, tombstones=tombstones)
+
+        bucket_dirs = sorted((spill_dir / kind_).iterdir())
+        num_rows = run(dedup_bucket, args=[
+            (kind, str(bucket_dir), str(spill_dir / 'latest' / f'{bucket_dir.name}.parquet'),
+             str(temp_dir / kind_ / f'part-{int(bucket_dir.name.split("=")[1]):03d}.parquet'), row_group_size,
+             compression) for bucket_dir in bucket_dirs
+        ], dirs=bucket_dirs)
+        num_kept, num_dropped = map(sum, zip(*num_rows))
+        shutil.rmtree(spill_dir / kind_)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        if (out_dir / kind_).exists():
+            shutil.rmtree(out_dir / kind_)
+        os.replace(temp_dir / kind_, out_dir / kind_)
+        print(f'Deduplicated {kind!r}: kept {num_kept:,} rows, dropped {num_dropped:,}')
+
+    shutil.rmtree(temp_dir)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deduplicate the works Parquets across updated_date partitions',
+                                     parents=[get_paths_parser()])
+    parser.add_argument('kinds', nargs='*', help='works kinds to deduplicate, all of them by default')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--buckets', type=int, default=NUM_BUCKETS, help='number of buckets of work_id')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('--compression', default='snappy')
+    cli_args = parser.parse_args()
+    configure_paths(cli_args)
+
+    dedup_works(kinds=cli_args.kinds or None, threads=cli_args.threads, num_buckets=cli_args.buckets,
+                row_group_size=cli_args.row_group_size, compression=cli_args.compression)
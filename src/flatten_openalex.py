@@ -5,27 +5,35 @@ Original script at https://gist.github.com/richard-orr/152d828356a7c47ed7e3e22d2
 import csv
 import glob
 import gzip
+import hashlib
 import json
+import multiprocessing
 import os
 import sys
+from datetime import datetime
 from pathlib import Path
 from typing import Union, Optional
 
+import numpy as np
 import orjson  # faster JSON library
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from tqdm.auto import tqdm
 
 sys.path.extend(['../', './'])
-from src.utils import convert_openalex_id_to_int, load_pickle, dump_pickle, reconstruct_abstract, read_manifest, \
-    parallel_async
+from src.utils import convert_openalex_id_to_int, convert_openalex_ids_to_int, load_pickle, dump_pickle, \
+    reconstruct_abstracts, read_manifest, iter_jsonl_lines, iter_jsonl_line_blocks, parallel_largest_first, \
+    get_shared_state, IdFilter, AsyncCSVWriter, get_csv_path
+from src.checkpoint import CompletionLog, get_completion_log
+from src.config import get_paths, load_config
+import src.instrumentation as instrumentation
 
-BASEDIR = Path('/N/project/openalex/ssikdar')  # directory where you have downloaded the OpenAlex snapshots
-SNAPSHOT_DIR = BASEDIR / 'openalex-snapshot'
-MONTH = 'feb-2023'
-CSV_DIR = BASEDIR / 'processed-snapshots' / 'csv-files' / MONTH
-PARQ_DIR = BASEDIR / 'processed-snapshots' / 'parquet-files' / MONTH
-CSV_DIR.mkdir(parents=True, exist_ok=True)
-PARQ_DIR.mkdir(parents=True, exist_ok=True)
+# set from the OPENALEX_* environment variables or src/config.py defaults, change them with configure()
+# the directories are only created by the flatteners writing to them
+CONFIG = load_config()  # the settings the paths below come from, handed to the pool workers
+BASEDIR, SNAPSHOT_DIR, MONTH, CSV_DIR, PARQ_DIR = get_paths(CONFIG).values()
 
 
 csv_files = \
@@ -240,6 +248,60 @@ csv_files = \
     },
     }
 
+# the kinds written out by process_jsonl_file for each entity, one Parquet directory each
+WORKS_KINDS = ['works', 'ids', 'primary_location', 'locations', 'authorships', 'biblio', 'concepts', 'mesh',
+               'referenced_works', 'related_works', 'abstracts']
+AUTHORS_KINDS = ['authors', 'ids', 'counts_by_year', 'concepts', 'hints']
+CONCEPTS_KINDS = ['concepts', 'ids', 'ancestors', 'counts_by_year', 'related_concepts']
+VENUES_KINDS = ['venues', 'ids', 'counts_by_year']
+INSTITUTIONS_KINDS = ['institutions', 'ids', 'geo', 'associated_institutions', 'counts_by_year']
+ENTITY_KINDS = {'works': WORKS_KINDS, 'authors': AUTHORS_KINDS, 'concepts': CONCEPTS_KINDS, 'venues': VENUES_KINDS,
+                'institutions': INSTITUTIONS_KINDS}
+
+
+def configure(config_path: Optional[Union[str, Path]] = None, **overrides):
+    """
+    Point the flatteners at other directories, eg configure(basedir='/data/openalex', month='mar-2023'),
+    with the settings of src/config.py taken from config_path, the environment and overrides.
+    The CSV names in csv_files follow CSV_DIR.
+    """
+    set_config(load_config(config_path, **overrides))
+    return
+
+
+def set_config(config: dict):
+    """
+    Point the flatteners at the paths of the settings config of load_config, as resolved by configure in the parent
+    process. Pool workers that do not fork import this module afresh, with the paths of the environment and the
+    defaults, so they get the settings of the parent through this.
+    """
+    global CONFIG, BASEDIR, SNAPSHOT_DIR, MONTH, CSV_DIR, PARQ_DIR
+    CONFIG = dict(config)
+    BASEDIR, SNAPSHOT_DIR, MONTH, CSV_DIR, PARQ_DIR = get_paths(CONFIG).values()
+    for entity_files in csv_files.values():
+        for file_spec in entity_files.values():
+            file_spec['name'] = os.path.join(CSV_DIR, os.path.basename(file_spec['name']))
+    return
+
+
+# columns that the parsers fill with raw OpenAlex ID strings, converted to ints a whole column at a time when the
+# rows are turned into a table, instead of once per value while parsing
+OPENALEX_ID_COLUMNS = {
+    'works': {
+        'primary_location': ['source_id'], 'locations': ['source_id'], 'authorships': ['author_id'],
+        'concepts': ['concept_id'], 'referenced_works': ['referenced_work_id'], 'related_works': ['related_work_id'],
+    },
+    'authors': {
+        'authors': ['last_known_institution'], 'concepts': ['concept_id'],
+    },
+    'concepts': {
+        'ancestors': ['ancestor_id'], 'related_concepts': ['related_concept_id'],
+    },
+    'institutions': {
+        'associated_institutions': ['associated_institution_id'],
+    },
+}
+
 
 def read_csvs(paths):
     """
@@ -249,309 +311,285 @@ def read_csvs(paths):
     return df
 
 
-def get_skip_ids(kind):
+def get_skip_ids(kind) -> IdFilter:
     """
-    Get the set of IDs that have been merged with other IDs to skip over them
+    Get the IDs that have been merged with other IDs to skip over them, as an IdFilter memory-mapped from a cache
+    in PARQ_DIR/temp. The cache is keyed by the names and sizes of the merged_ids files, and rebuilt when they change.
     """
     merged_entries_path = SNAPSHOT_DIR / 'data' / 'merged_ids' / kind
-    if merged_entries_path.exists():
-        merged_df = read_csvs(merged_entries_path.glob('*.csv.gz'))
-        skip_ids = set(
-            merged_df
-            .id
-        )
-        skip_ids = {convert_openalex_id_to_int(id_) for id_ in skip_ids}
-        print(f'{kind!r} {len(skip_ids):,} merged IDs')
-    else:
-        skip_ids = set()
-
+    merged_files = sorted(merged_entries_path.glob('*.csv.gz')) if merged_entries_path.exists() else []
+    if len(merged_files) == 0:
+        return IdFilter.from_ids([])
+
+    files_key = hashlib.sha1(
+        json.dumps([(path.name, path.stat().st_size) for path in merged_files]).encode('utf-8')
+    ).hexdigest()[: 16]
+    cache_path = PARQ_DIR / 'temp' / f'merged_ids_{kind}_{files_key}.npy'
+
+    if not cache_path.exists():
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        ids = []
+        for path in tqdm(merged_files, desc=f'Reading merged {kind} IDs', unit=' file', leave=False):
+            file_ids, null_mask = convert_openalex_ids_to_int(pd.read_csv(path, usecols=['id'], dtype=str).id)
+            ids.append(file_ids[~null_mask])
+        IdFilter.from_ids(np.concatenate(ids)).save(cache_path)
+
+        for stale_path in cache_path.parent.glob(f'merged_ids_{kind}_*.npy'):  # caches of older file lists
+            if stale_path != cache_path:
+                stale_path.unlink()
+
+    skip_ids = IdFilter.load(cache_path)
+    print(f'{kind!r} {len(skip_ids):,} merged IDs')
     return skip_ids
 
 
-def flatten_concepts():
-    # read the merged entries and skip over those entries
-    skip_ids = get_skip_ids('concepts')
-
-    with gzip.open(csv_files['concepts']['concepts']['name'], 'wt', encoding='utf-8') as concepts_csv, \
-            gzip.open(csv_files['concepts']['ancestors']['name'], 'wt', encoding='utf-8') as ancestors_csv, \
-            gzip.open(csv_files['concepts']['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(csv_files['concepts']['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['concepts']['related_concepts']['name'], 'wt',
-                      encoding='utf-8') as related_concepts_csv:
-
-        concepts_writer = csv.DictWriter(
-            concepts_csv, fieldnames=csv_files['concepts']['concepts']['columns'], extrasaction='ignore'
-        )
-        concepts_writer.writeheader()
-
-        ancestors_writer = csv.DictWriter(ancestors_csv, fieldnames=csv_files['concepts']['ancestors']['columns'])
-        ancestors_writer.writeheader()
+def open_csv_writer(spec: dict, mode: str = 'w', extrasaction: str = 'raise', codec: str = 'gzip',
+                    level: Optional[int] = None) -> AsyncCSVWriter:
+    """
+    AsyncCSVWriter of the CSV of a csv_files spec compressed with codec, with its header unless appending to an
+    existing file
+    """
+    filename = get_csv_path(spec['name'], codec=codec)
+    write_header = mode.startswith('w') or not filename.exists()
+    writer = AsyncCSVWriter(filename, fieldnames=spec['columns'], mode=mode, extrasaction=extrasaction, codec=codec,
+                            level=level)
+    if write_header:
+        writer.writeheader()
+    return writer
 
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv,
-                                               fieldnames=csv_files['concepts']['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
 
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=csv_files['concepts']['ids']['columns'])
-        ids_writer.writeheader()
+def flatten_concepts(codec: str = 'gzip', level: Optional[int] = None):
+    """
+    codec, level: compression of the CSVs, encoded and compressed on background threads by AsyncCSVWriter
+    """
+    # read the merged entries and skip over those entries
+    skip_ids = get_skip_ids('concepts')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
 
-        related_concepts_writer = csv.DictWriter(related_concepts_csv,
-                                                 fieldnames=csv_files['concepts']['related_concepts']['columns'])
-        related_concepts_writer.writeheader()
+    file_spec = csv_files['concepts']
+    csv_kwargs = dict(codec=codec, level=level)
+    with open_csv_writer(file_spec['concepts'], extrasaction='ignore', **csv_kwargs) as concepts_writer, \
+            open_csv_writer(file_spec['ancestors'], **csv_kwargs) as ancestors_writer, \
+            open_csv_writer(file_spec['counts_by_year'], **csv_kwargs) as counts_by_year_writer, \
+            open_csv_writer(file_spec['ids'], **csv_kwargs) as ids_writer, \
+            open_csv_writer(file_spec['related_concepts'], **csv_kwargs) as related_concepts_writer:
 
         seen_concept_ids = set()
 
         files = list(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'concepts', '*', '*.gz')))
         for jsonl_file_name in tqdm(files, desc='Flattening concepts...', unit=' file'):
-            with gzip.open(jsonl_file_name, 'r') as concepts_jsonl:
-                for concept_json in concepts_jsonl:
-                    if not concept_json.strip():
-                        continue
+            for concept_json in iter_jsonl_lines(jsonl_file_name):
+                if not concept_json.strip():
+                    continue
 
-                    concept = json.loads(concept_json)
+                concept = json.loads(concept_json)
 
-                    if not (concept_id := concept.get('id')) or concept_id in seen_concept_ids:
-                        continue
+                if not (concept_id := concept.get('id')) or concept_id in seen_concept_ids:
+                    continue
 
-                    concept_id = convert_openalex_id_to_int(concept_id)  # convert to int
-                    if concept_id in skip_ids:  # skip over already merged IDs
-                        continue
+                concept_id = convert_openalex_id_to_int(concept_id)  # convert to int
+                if concept_id in skip_ids:  # skip over already merged IDs
+                    continue
 
-                    concept_name = concept['display_name']
-                    seen_concept_ids.add(concept_id)
-
-                    concept['concept_id'] = concept_id
-                    concept['concept_name'] = concept_name
-                    concepts_writer.writerow(concept)
-
-                    if concept_ids := concept.get('ids'):
-                        concept_ids['concept_id'] = concept_id
-                        concept_ids['concept_name'] = concept_name
-                        concept_ids['umls_aui'] = json.dumps(concept_ids.get('umls_aui'), ensure_ascii=False)
-                        concept_ids['umls_cui'] = json.dumps(concept_ids.get('umls_cui'), ensure_ascii=False)
-                        ids_writer.writerow(concept_ids)
-
-                    if ancestors := concept.get('ancestors'):
-                        for ancestor in ancestors:
-                            if ancestor_id := ancestor.get('id'):
-                                ancestors_writer.writerow({
-                                    'concept_id': concept_id,
-                                    'ancestor_id': ancestor_id
-                                })
-
-                    if counts_by_year := concept.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['concept_id'] = concept_id
-                            count_by_year['concept_name'] = concept_name
-                            counts_by_year_writer.writerow(count_by_year)
-
-                    if related_concepts := concept.get('related_concepts'):
-                        for related_concept in related_concepts:
-                            if related_concept_id := related_concept.get('id'):
-                                related_concepts_writer.writerow({
-                                    'concept_id': concept_id,
-                                    'related_concept_id': related_concept_id,
-                                    'score': related_concept.get('score')
-                                })
+                concept_name = concept['display_name']
+                seen_concept_ids.add(concept_id)
+
+                concept['concept_id'] = concept_id
+                concept['concept_name'] = concept_name
+                concepts_writer.writerow(concept)
+
+                if concept_ids := concept.get('ids'):
+                    concept_ids['concept_id'] = concept_id
+                    concept_ids['concept_name'] = concept_name
+                    concept_ids['umls_aui'] = json.dumps(concept_ids.get('umls_aui'), ensure_ascii=False)
+                    concept_ids['umls_cui'] = json.dumps(concept_ids.get('umls_cui'), ensure_ascii=False)
+                    ids_writer.writerow(concept_ids)
+
+                if ancestors := concept.get('ancestors'):
+                    for ancestor in ancestors:
+                        if ancestor_id := ancestor.get('id'):
+                            ancestors_writer.writerow({
+                                'concept_id': concept_id,
+                                'ancestor_id': ancestor_id
+                            })
+
+                if counts_by_year := concept.get('counts_by_year'):
+                    for count_by_year in counts_by_year:
+                        count_by_year['concept_id'] = concept_id
+                        count_by_year['concept_name'] = concept_name
+                        counts_by_year_writer.writerow(count_by_year)
+
+                if related_concepts := concept.get('related_concepts'):
+                    for related_concept in related_concepts:
+                        if related_concept_id := related_concept.get('id'):
+                            related_concepts_writer.writerow({
+                                'concept_id': concept_id,
+                                'related_concept_id': related_concept_id,
+                                'score': related_concept.get('score')
+                            })
     return
 
 
-def flatten_venues():
+def flatten_venues(codec: str = 'gzip', level: Optional[int] = None):
+    """
+    codec, level: compression of the CSVs, see flatten_concepts
+    """
     skip_ids = get_skip_ids('venues')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
 
-    with gzip.open(csv_files['venues']['venues']['name'], 'wt', encoding='utf-8') as venues_csv, \
-            gzip.open(csv_files['venues']['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['venues']['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv:
-
-        venues_writer = csv.DictWriter(
-            venues_csv, fieldnames=csv_files['venues']['venues']['columns'], extrasaction='ignore'
-        )
-        venues_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=csv_files['venues']['ids']['columns'], extrasaction='ignore')
-        ids_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv,
-                                               fieldnames=csv_files['venues']['counts_by_year']['columns'],
-                                               extrasaction='ignore')
-        counts_by_year_writer.writeheader()
+    file_spec = csv_files['venues']
+    csv_kwargs = dict(extrasaction='ignore', codec=codec, level=level)
+    with open_csv_writer(file_spec['venues'], **csv_kwargs) as venues_writer, \
+            open_csv_writer(file_spec['ids'], **csv_kwargs) as ids_writer, \
+            open_csv_writer(file_spec['counts_by_year'], **csv_kwargs) as counts_by_year_writer:
 
         seen_venue_ids = set()
 
         files = list(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'venues', '*', '*.gz')))
         for jsonl_file_name in tqdm(files, desc='Flattening venues...', unit=' file'):
 
-            with gzip.open(jsonl_file_name, 'r') as venues_jsonl:
-                for venue_json in venues_jsonl:
-                    if not venue_json.strip():
-                        continue
+            for venue_json in iter_jsonl_lines(jsonl_file_name):
+                if not venue_json.strip():
+                    continue
 
-                    venue = orjson.loads(venue_json)
+                venue = orjson.loads(venue_json)
 
-                    if not (venue_id := venue.get('id')) or venue_id in seen_venue_ids:
-                        continue
+                if not (venue_id := venue.get('id')) or venue_id in seen_venue_ids:
+                    continue
 
-                    venue_id = convert_openalex_id_to_int(venue_id)
-                    if venue_id in skip_ids:  # skip over merged IDs
-                        continue
+                venue_id = convert_openalex_id_to_int(venue_id)
+                if venue_id in skip_ids:  # skip over merged IDs
+                    continue
 
-                    venue_name = venue['display_name']
-                    venue['venue_name'] = venue_name
-                    seen_venue_ids.add(venue_id)
+                venue_name = venue['display_name']
+                venue['venue_name'] = venue_name
+                seen_venue_ids.add(venue_id)
 
-                    venue['issn'] = json.dumps(venue.get('issn'))
-                    venues_writer.writerow(venue)
+                venue['issn'] = json.dumps(venue.get('issn'))
+                venues_writer.writerow(venue)
 
-                    if venue_ids := venue.get('ids'):
-                        venue_ids['venue_id'] = venue_id
-                        venue_ids['venue_name'] = venue_name
-                        venue_ids['issn'] = json.dumps(venue_ids.get('issn'))
-                        ids_writer.writerow(venue_ids)
+                if venue_ids := venue.get('ids'):
+                    venue_ids['venue_id'] = venue_id
+                    venue_ids['venue_name'] = venue_name
+                    venue_ids['issn'] = json.dumps(venue_ids.get('issn'))
+                    ids_writer.writerow(venue_ids)
 
-                    if counts_by_year := venue.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['venue_id'] = venue_id
-                            count_by_year['venue_name'] = venue_name
-                            counts_by_year_writer.writerow(count_by_year)
+                if counts_by_year := venue.get('counts_by_year'):
+                    for count_by_year in counts_by_year:
+                        count_by_year['venue_id'] = venue_id
+                        count_by_year['venue_name'] = venue_name
+                        counts_by_year_writer.writerow(count_by_year)
 
     return
 
 
-def flatten_institutions():
+def flatten_institutions(codec: str = 'gzip', level: Optional[int] = None):
+    """
+    codec, level: compression of the CSVs, see flatten_concepts
+    """
     skip_ids = get_skip_ids('institutions')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
 
     file_spec = csv_files['institutions']
-
-    with gzip.open(file_spec['institutions']['name'], 'wt', encoding='utf-8') as institutions_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['geo']['name'], 'wt', encoding='utf-8') as geo_csv, \
-            gzip.open(file_spec['associated_institutions']['name'], 'wt',
-                      encoding='utf-8') as associated_institutions_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv:
-
-        institutions_writer = csv.DictWriter(
-            institutions_csv, fieldnames=file_spec['institutions']['columns'], extrasaction='ignore'
-        )
-        institutions_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=file_spec['ids']['columns'])
-        ids_writer.writeheader()
-
-        geo_writer = csv.DictWriter(geo_csv, fieldnames=file_spec['geo']['columns'])
-        geo_writer.writeheader()
-
-        associated_institutions_writer = csv.DictWriter(
-            associated_institutions_csv, fieldnames=file_spec['associated_institutions']['columns']
-        )
-        associated_institutions_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv, fieldnames=file_spec['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
+    csv_kwargs = dict(codec=codec, level=level)
+    with open_csv_writer(file_spec['institutions'], extrasaction='ignore', **csv_kwargs) as institutions_writer, \
+            open_csv_writer(file_spec['ids'], **csv_kwargs) as ids_writer, \
+            open_csv_writer(file_spec['geo'], **csv_kwargs) as geo_writer, \
+            open_csv_writer(file_spec['associated_institutions'], **csv_kwargs) as associated_institutions_writer, \
+            open_csv_writer(file_spec['counts_by_year'], **csv_kwargs) as counts_by_year_writer:
 
         seen_institution_ids = set()
 
         files = list(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'institutions', '*', '*.gz')))
         for jsonl_file_name in tqdm(files, desc='Flattening Institutions...'):
-            with gzip.open(jsonl_file_name, 'r') as institutions_jsonl:
-                for institution_json in institutions_jsonl:
-                    if not institution_json.strip():
-                        continue
-
-                    institution = orjson.loads(institution_json)
-
-                    if not (institution_id := institution.get('id')) or institution_id in seen_institution_ids:
-                        continue
-
-                    institution_id = convert_openalex_id_to_int(institution_id)
-                    if institution_id in skip_ids:
-                        continue
-
-                    institution_name = institution['display_name']
-                    seen_institution_ids.add(institution_id)
-
-                    # institutions
-                    institution['institution_id'] = institution_id
-                    institution['institution_name'] = institution_name
-                    institution['display_name_acroynyms'] = json.dumps(institution.get('display_name_acroynyms'),
-                                                                       ensure_ascii=False)
-                    institution['display_name_alternatives'] = json.dumps(institution.get('display_name_alternatives'),
-                                                                          ensure_ascii=False)
-                    institutions_writer.writerow(institution)
-
-                    # ids
-                    if institution_ids := institution.get('ids'):
-                        institution_ids['institution_id'] = institution_id
-                        institution_ids['institution_name'] = institution_name
-                        ids_writer.writerow(institution_ids)
-
-                    # geo
-                    if institution_geo := institution.get('geo'):
-                        institution_geo['institution_id'] = institution_id
-                        institution_geo['institution_name'] = institution_name
-                        geo_writer.writerow(institution_geo)
-
-                    # associated_institutions
-                    if associated_institutions := institution.get(
-                            'associated_institutions', institution.get('associated_insitutions')  # typo in api
-                    ):
-                        for associated_institution in associated_institutions:
-                            if associated_institution_id := associated_institution.get('id'):
-                                associated_institutions_writer.writerow({
-                                    'institution_id': institution_id,
-                                    'associated_institution_id': associated_institution_id,
-                                    'relationship': associated_institution.get('relationship')
-                                })
-
-                    # counts_by_year
-                    if counts_by_year := institution.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['institution_id'] = institution_id
-                            count_by_year['institution_name'] = institution_name
-                            counts_by_year_writer.writerow(count_by_year)
-    return
+            for institution_json in iter_jsonl_lines(jsonl_file_name):
+                if not institution_json.strip():
+                    continue
 
+                institution = orjson.loads(institution_json)
 
-def flatten_authors(files_to_process: Union[str, int] = 'all'):
-    skip_ids = get_skip_ids('authors')
+                if not (institution_id := institution.get('id')) or institution_id in seen_institution_ids:
+                    continue
 
-    file_spec = csv_files['authors']
+                institution_id = convert_openalex_id_to_int(institution_id)
+                if institution_id in skip_ids:
+                    continue
 
-    authors_csv_exists = Path(file_spec['authors']['name']).exists()
-    ids_csv_exists = Path(file_spec['ids']['name']).exists()
-    counts_by_year_csv_exists = Path(file_spec['counts_by_year']['name']).exists()
-    authors_concepts_csv_exists = Path(file_spec['concepts']['name']).exists()
-    authors_hints_csv_exists = Path(file_spec['hints']['name']).exists()
+                institution_name = institution['display_name']
+                seen_institution_ids.add(institution_id)
 
-    with gzip.open(file_spec['authors']['name'], 'at', encoding='utf-8') as authors_csv, \
-            gzip.open(file_spec['ids']['name'], 'at', encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'at', encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(file_spec['concepts']['name'], 'at', encoding='utf-8') as authors_concepts_csv, \
-            gzip.open(file_spec['hints']['name'], 'at', encoding='utf-8') as authors_hints_csv:
+                # institutions
+                institution['institution_id'] = institution_id
+                institution['institution_name'] = institution_name
+                institution['display_name_acroynyms'] = json.dumps(institution.get('display_name_acroynyms'),
+                                                                   ensure_ascii=False)
+                institution['display_name_alternatives'] = json.dumps(institution.get('display_name_alternatives'),
+                                                                      ensure_ascii=False)
+                institutions_writer.writerow(institution)
 
-        authors_writer = csv.DictWriter(
-            authors_csv, fieldnames=file_spec['authors']['columns'], extrasaction='ignore'
-        )
-        if not authors_csv_exists:
-            authors_writer.writeheader()
+                # ids
+                if institution_ids := institution.get('ids'):
+                    institution_ids['institution_id'] = institution_id
+                    institution_ids['institution_name'] = institution_name
+                    ids_writer.writerow(institution_ids)
+
+                # geo
+                if institution_geo := institution.get('geo'):
+                    institution_geo['institution_id'] = institution_id
+                    institution_geo['institution_name'] = institution_name
+                    geo_writer.writerow(institution_geo)
+
+                # associated_institutions
+                if associated_institutions := institution.get(
+                        'associated_institutions', institution.get('associated_insitutions')  # typo in api
+                ):
+                    for associated_institution in associated_institutions:
+                        if associated_institution_id := associated_institution.get('id'):
+                            associated_institutions_writer.writerow({
+                                'institution_id': institution_id,
+                                'associated_institution_id': associated_institution_id,
+                                'relationship': associated_institution.get('relationship')
+                            })
 
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=file_spec['ids']['columns'])
-        if not ids_csv_exists:
-            ids_writer.writeheader()
+                # counts_by_year
+                if counts_by_year := institution.get('counts_by_year'):
+                    for count_by_year in counts_by_year:
+                        count_by_year['institution_id'] = institution_id
+                        count_by_year['institution_name'] = institution_name
+                        counts_by_year_writer.writerow(count_by_year)
+    return
 
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv, fieldnames=file_spec['counts_by_year']['columns'])
-        if not counts_by_year_csv_exists:
-            counts_by_year_writer.writeheader()
 
-        authors_concepts_writer = csv.DictWriter(
-            authors_concepts_csv, fieldnames=file_spec['concepts']['columns'], extrasaction='ignore'
-        )
-        if not authors_concepts_csv_exists:
-            authors_concepts_writer.writeheader()
+def flatten_authors(files_to_process: Union[str, int] = 'all', chunk_size: Optional[int] = None,
+                    codec: str = 'gzip', level: Optional[int] = None):
+    """
+    chunk_size: if set, append the rows to the CSVs every chunk_size authors instead of holding the rows of the
+        whole file in memory. A file interrupted mid-way has its written rows appended again
+        on restart, so drop duplicates after loading if a streaming run was killed.
+    codec, level: compression of the CSVs, see flatten_concepts. The rows of a file are in the CSVs before it is
+        marked as finished.
+    """
+    skip_ids = get_skip_ids('authors')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
 
-        authors_hints_writer = csv.DictWriter(
-            authors_hints_csv, fieldnames=file_spec['hints']['columns'], extrasaction='ignore'
-        )
-        if not authors_hints_csv_exists:
-            authors_hints_writer.writeheader()
+    file_spec = csv_files['authors']
+    csv_kwargs = dict(mode='a', codec=codec, level=level)
+    with open_csv_writer(file_spec['authors'], extrasaction='ignore', **csv_kwargs) as authors_writer, \
+            open_csv_writer(file_spec['ids'], **csv_kwargs) as ids_writer, \
+            open_csv_writer(file_spec['counts_by_year'], **csv_kwargs) as counts_by_year_writer, \
+            open_csv_writer(file_spec['concepts'], extrasaction='ignore', **csv_kwargs) as authors_concepts_writer, \
+            open_csv_writer(file_spec['hints'], extrasaction='ignore', **csv_kwargs) as authors_hints_writer:
+
+        def flush_rows():
+            # write all the lines to the CSVs
+            authors_writer.writerows(authors_rows)
+            ids_writer.writerows(ids_rows)
+            counts_by_year_writer.writerows(counts_by_year_rows)
+            authors_concepts_writer.writerows(authors_concepts_rows)
+            authors_hints_writer.writerows(author_hints_rows)
+            for rows in (authors_rows, ids_rows, counts_by_year_rows, authors_concepts_rows, author_hints_rows):
+                rows.clear()
+            return
 
         print(f'This might take a while, like 6-7 hours..')
 
@@ -579,8 +617,7 @@ def flatten_authors(files_to_process: Union[str, int] = 'all'):
             if i > files_to_process:
                 break
 
-            with gzip.open(jsonl_file_name, 'r') as authors_jsonl:
-                authors_jsonls = authors_jsonl.readlines()
+            authors_jsonls = iter_jsonl_lines(jsonl_file_name)
 
             authors_rows, ids_rows, counts_by_year_rows, authors_concepts_rows, author_hints_rows = [], [], [], [], []
 
@@ -653,12 +690,13 @@ def flatten_authors(files_to_process: Union[str, int] = 'all'):
                 # authors_hints_writer.writerow(author_hints_row)
                 author_hints_rows.append(author_hints_row)
 
-            ## write all the lines to the CSVs
-            authors_writer.writerows(authors_rows)
-            ids_writer.writerows(ids_rows)
-            counts_by_year_writer.writerows(counts_by_year_rows)
-            authors_concepts_writer.writerows(authors_concepts_rows)
-            authors_hints_writer.writerows(author_hints_rows)
+                if chunk_size is not None and len(authors_rows) >= chunk_size:
+                    flush_rows()
+
+            flush_rows()
+            for writer in (authors_writer, ids_writer, counts_by_year_writer, authors_concepts_writer,
+                           authors_hints_writer):
+                writer.flush()
 
             finished_files.add(str(jsonl_file_name))
             dump_pickle(obj=finished_files, path=finished_files_pickle_path)
@@ -668,6 +706,7 @@ def flatten_authors(files_to_process: Union[str, int] = 'all'):
 
 def flatten_authors_concepts(files_to_process: Union[str, int] = 'all'):
     skip_ids = get_skip_ids('authors')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
     file_spec = csv_files['authors']
     authors_concepts_zero_filename = CSV_DIR / 'authors_concepts_zero.csv.gz'
 
@@ -715,8 +754,7 @@ def flatten_authors_concepts(files_to_process: Union[str, int] = 'all'):
             if i > files_to_process:
                 break
 
-            with gzip.open(jsonl_file_name, 'r') as authors_jsonl:
-                authors_jsonls = authors_jsonl.readlines()
+            authors_jsonls = iter_jsonl_lines(jsonl_file_name)
             author_concept_rows = []
             author_concept_zero_rows = []
 
@@ -760,6 +798,7 @@ def flatten_authors_concepts(files_to_process: Union[str, int] = 'all'):
 
 def flatten_authors_hints(files_to_process: Union[str, int] = 'all'):
     skip_ids = get_skip_ids('authors')
+    CSV_DIR.mkdir(parents=True, exist_ok=True)
     file_spec = csv_files['authors']
 
     authors_hints_csv_exists = Path(file_spec['hints']['name']).exists()
@@ -797,8 +836,7 @@ def flatten_authors_hints(files_to_process: Union[str, int] = 'all'):
             if i > files_to_process:
                 break
 
-            with gzip.open(jsonl_file_name, 'r') as authors_jsonl:
-                authors_jsonls = authors_jsonl.readlines()
+            authors_jsonls = iter_jsonl_lines(jsonl_file_name)
 
             author_hints_rows = []
             for author_json in tqdm(authors_jsonls, desc='Parsing JSONs', leave=False, unit=' line', unit_scale=True):
@@ -832,250 +870,599 @@ def flatten_authors_hints(files_to_process: Union[str, int] = 'all'):
     return
 
 
-def process_work_json(skip_ids, jsonl_file_name, finished_files, finished_files_pickle_path):
+def parse_work(work: dict, skip_ids, rows: dict):
     """
-    Process each work JSON lines file in parallel
+    Flatten a single work JSON into the per-kind row lists in rows, leaving the OPENALEX_ID_COLUMNS as raw ID strings
     """
-    with gzip.open(jsonl_file_name, 'r') as works_jsonl:
-        works_jsonls = works_jsonl.readlines()
-
-    work_rows, id_rows, primary_location_rows, location_rows, authorship_rows, biblio_rows = [], [], [], [], [], []
-    concept_rows, mesh_rows, oa_rows, refs_rows, rels_rows, abstract_rows = [], [], [], [], [], []
-
-    for work_json in tqdm(works_jsonls, desc=f'Parsing JSONs... {str(Path(jsonl_file_name).parts[-2:])}', unit=' line',
-                          unit_scale=True, colour='blue',
-                          leave=False):
-        if not work_json.strip():
-            continue
-
-        work = orjson.loads(work_json)
+    if not (work_id := work.get('id')):
+        return
 
-        if not (work_id := work.get('id')):
-            continue
+    # works
+    work_id = convert_openalex_id_to_int(work_id)
+    if work_id in skip_ids:
+        return
 
-        # works
-        work_id = convert_openalex_id_to_int(work_id)
-        if work_id in skip_ids:
-            continue
+    num_authors = 0
 
-        num_authors = 0
+    work['work_id'] = work_id
+    doi = work['doi']
+    doi = doi.replace('https://doi.org/', '') if doi is not None else None
+    work['doi'] = doi
 
-        work['work_id'] = work_id
-        doi = work['doi']
-        doi = doi.replace('https://doi.org/', '') if doi is not None else None
-        work['doi'] = doi
+    if work['title'] is None:
+        title = None
+    else:
+        title = work['title'].replace(r'\n', ' ')  # deleting stray \n's in title
+    work['title'] = title
+
+    # authorships
+    if authorships := work.get('authorships'):
+        for authorship in authorships:
+            if author_id := authorship.get('author', {}).get('id'):
+                num_authors += 1  # increase the count of authors
+                author_name = authorship.get('author', {}).get('display_name')
+
+                institutions = authorship.get('institutions')
+                institution_ids = [convert_openalex_id_to_int(i.get('id')) for i in institutions]
+                institution_ids = [i for i in institution_ids if i]
+                institution_ids = institution_ids or [None]
+
+                institution_names = [i.get('display_name') for i in institutions]
+                institution_names = [i for i in institution_names if i]
+                institution_names = institution_names or [None]
+
+                for institution_id, institution_name in zip(institution_ids, institution_names):
+                    rows['authorships'].append({
+                        'work_id': work_id,
+                        'author_position': authorship.get('author_position'),
+                        'author_id': author_id,
+                        'author_name': author_name,
+                        'institution_id': institution_id,
+                        'institution_name': institution_name,
+                        'raw_affiliation_string': authorship.get('raw_affiliation_string'),
+                        'publication_year': work.get('publication_year')
+                    })
 
-        if work['title'] is None:
-            title = None
-        else:
-            title = work['title'].replace(r'\n', ' ')  # deleting stray \n's in title
-        work['title'] = title
-
-        # authorships
-        if authorships := work.get('authorships'):
-            for authorship in authorships:
-                if author_id := authorship.get('author', {}).get('id'):
-                    num_authors += 1  # increase the count of authors
-                    author_id = convert_openalex_id_to_int(author_id)
-                    author_name = authorship.get('author', {}).get('display_name')
-
-                    institutions = authorship.get('institutions')
-                    institution_ids = [convert_openalex_id_to_int(i.get('id')) for i in institutions]
-                    institution_ids = [i for i in institution_ids if i]
-                    institution_ids = institution_ids or [None]
-
-                    institution_names = [i.get('display_name') for i in institutions]
-                    institution_names = [i for i in institution_names if i]
-                    institution_names = institution_names or [None]
-
-                    for institution_id, institution_name in zip(institution_ids, institution_names):
-                        authorship_rows.append({
-                            # authorships_writer.writerow({
-                            'work_id': work_id,
-                            'author_position': authorship.get('author_position'),
-                            'author_id': author_id,
-                            'author_name': author_name,
-                            'institution_id': institution_id,
-                            'institution_name': institution_name,
-                            'raw_affiliation_string': authorship.get('raw_affiliation_string'),
-                            'publication_year': work.get('publication_year')
-                        })
-
-        # works_writer.writerow(work)
-        work['num_authors'] = num_authors
-        work_rows.append(work)
-
-        # primary location
-        if primary_location := (work.get('primary_location') or {}):
-            if source := primary_location.get('source'):
-                source_id = convert_openalex_id_to_int(source.get('id'))
-                primary_location_rows.append({
+    work['num_authors'] = num_authors
+    # keep only the flattened columns, not the whole nested JSON
+    rows['works'].append({col: work.get(col) for col in csv_files['works']['works']['columns']})
+
+    # primary location
+    if primary_location := (work.get('primary_location') or {}):
+        if source := primary_location.get('source'):
+            source_id = source.get('id')
+            rows['primary_location'].append({
+                'work_id': work_id,
+                'source_id': source_id,
+                'source_name': source.get('display_name'),
+                'source_type': source.get('type'),
+                'version': primary_location.get('version'),
+                'license': primary_location.get('license'),
+                'is_oa': primary_location.get('is_oa'),
+            })
+
+    # locations
+    if locations := work.get('locations'):
+        for location in locations:
+            if source := location.get('source'):
+                source_id = source.get('id')
+                rows['locations'].append({
                     'work_id': work_id,
                     'source_id': source_id,
                     'source_name': source.get('display_name'),
                     'source_type': source.get('type'),
-                    'version': primary_location.get('version'),
-                    'license': primary_location.get('license'),
-                    'is_oa': primary_location.get('is_oa'),
+                    'version': location.get('version'),
+                    'license': location.get('license'),
+                    'is_oa': location.get('is_oa'),
                 })
 
-        # locations
-        if locations := work.get('locations'):
-            for location in locations:
-                if source := location.get('source'):
-                    source_id = convert_openalex_id_to_int(source.get('id'))
-                    location_rows.append({
-                        'work_id': work_id,
-                        'source_id': source_id,
-                        'source_name': source.get('display_name'),
-                        'source_type': source.get('type'),
-                        'version': location.get('version'),
-                        'license': location.get('license'),
-                        'is_oa': location.get('is_oa'),
-                    })
+    # biblio
+    if biblio := work.get('biblio'):
+        biblio['work_id'] = work_id
+        rows['biblio'].append(biblio)
+
+    # concepts
+    for concept in work.get('concepts'):
+        if concept_id := concept.get('id'):
+            concept_name = concept.get('display_name')
+            level = concept.get('level')
+
+            rows['concepts'].append({
+                'work_id': work_id,
+                'publication_year': work.get('publication_year'),
+                'concept_id': concept_id,
+                'concept_name': concept_name,
+                'level': level,
+                'score': concept.get('score'),
+            })
+
+    # ids
+    if ids := work.get('ids'):
+        ids['work_id'] = work_id
+        ids['doi'] = doi
+        rows['ids'].append(ids)
+
+    # mesh
+    for mesh in work.get('mesh'):
+        mesh['work_id'] = work_id
+        rows['mesh'].append(mesh)
+
+    # referenced_works
+    for referenced_work in work.get('referenced_works'):
+        if referenced_work:
+            rows['referenced_works'].append({
+                'work_id': work_id,
+                'referenced_work_id': referenced_work
+            })
+
+    # related_works
+    for related_work in work.get('related_works'):
+        if related_work:
+            rows['related_works'].append({
+                'work_id': work_id,
+                'related_work_id': related_work
+            })
+
+    # abstracts, the inverted indexes are reconstructed in batches by the builder, see ArrowTableBuilder
+    if (abstract_inv_index := work.get('abstract_inverted_index')) is not None:
+        rows['abstracts'].append({'work_id': work_id, 'title': title, 'abstract': abstract_inv_index,
+                                  'publication_year': work.get('publication_year')})
+    return
 
 
-        # biblio
-        if biblio := work.get('biblio'):
-            biblio['work_id'] = work_id
-            biblio_rows.append(biblio)
-            # biblio_writer.writerow(biblio)
+def parse_author(author: dict, skip_ids, rows: dict):
+    """
+    Flatten a single author JSON into the per-kind row lists in rows, leaving the OPENALEX_ID_COLUMNS as raw ID strings
+    """
+    if not (author_id := author.get('id')):
+        return
+    author_id = convert_openalex_id_to_int(author_id)
+    if author_id in skip_ids:
+        return
 
-        # concepts
-        for concept in work.get('concepts'):
-            if concept_id := concept.get('id'):
-                concept_id = convert_openalex_id_to_int(concept_id)
-                concept_name = concept.get('display_name')
-                level = concept.get('level')
+    author_name = author['display_name']
+    works_count, cited_by_count = author.get('works_count', 0), author.get('cited_by_count', 0)
+
+    # authors
+    orcid = author.get('orcid')
+    last_known_institution = (author.get('last_known_institution') or {}).get('id')
+    rows['authors'].append({
+        'author_id': author_id,
+        'orcid': orcid.replace('https://orcid.org/', '') if orcid is not None else None,
+        'author_name': author_name,
+        'display_name_alternatives': json.dumps(author.get('display_name_alternatives'), ensure_ascii=False),
+        'works_count': works_count,
+        'cited_by_count': cited_by_count,
+        'last_known_institution': last_known_institution,
+        'updated_date': author.get('updated_date'),
+    })
+
+    # ids
+    if author_ids := author.get('ids'):
+        author_ids['author_id'] = author_id
+        author_ids['author_name'] = author_name
+        rows['ids'].append(author_ids)
+
+    # counts_by_year
+    for count_by_year in author.get('counts_by_year') or []:
+        count_by_year['author_id'] = author_id
+        count_by_year['author_name'] = author_name
+        rows['counts_by_year'].append(count_by_year)
+
+    # concepts, all of them including the ones with a zero score
+    for x_concept in author.get('x_concepts') or []:
+        rows['concepts'].append({
+            'author_id': author_id,
+            'author_name': author_name,
+            'works_count': works_count,
+            'cited_by_count': cited_by_count,
+            'concept_id': x_concept.get('id'),
+            'concept_name': x_concept.get('display_name'),
+            'level': x_concept.get('level'),
+            'score': x_concept.get('score'),
+        })
+
+    # hints
+    rows['hints'].append({
+        'author_id': author_id,
+        'author_name': author_name,
+        'works_count': works_count,
+        'cited_by_count': cited_by_count,
+        'most_cited_work': author.get('most_cited_work', ''),
+    })
+    return
 
-                # concepts_writer.writerow({
-                concept_rows.append({
-                    'work_id': work_id,
-                    'publication_year': work.get('publication_year'),
-                    'concept_id': concept_id,
-                    'concept_name': concept_name,
-                    'level': level,
-                    'score': concept.get('score'),
-                })
 
-        # ids
-        if ids := work.get('ids'):
-            ids['work_id'] = work_id
-            ids['doi'] = doi
-            id_rows.append(ids)
-            # ids_writer.writerow(ids)
-
-        # mesh
-        for mesh in work.get('mesh'):
-            mesh['work_id'] = work_id
-            mesh_rows.append(mesh)
-            # mesh_writer.writerow(mesh)
-
-        # referenced_works
-        for referenced_work in work.get('referenced_works'):
-            if referenced_work:
-                referenced_work = convert_openalex_id_to_int(referenced_work)
-                refs_rows.append({
-                    # referenced_works_writer.writerow({
-                    'work_id': work_id,
-                    'referenced_work_id': referenced_work
-                })
+def parse_concept(concept: dict, skip_ids, rows: dict):
+    """
+    Flatten a single concept JSON into the per-kind row lists in rows, the rows of flatten_concepts
+    """
+    if not (concept_id := concept.get('id')):
+        return
+    concept_id = convert_openalex_id_to_int(concept_id)
+    if concept_id in skip_ids:
+        return
 
-        # related_works
-        for related_work in work.get('related_works'):
-            if related_work:
-                related_work = convert_openalex_id_to_int(related_work)
+    concept_name = concept['display_name']
+    concept['concept_id'] = concept_id
+    concept['concept_name'] = concept_name
+    rows['concepts'].append({col: concept.get(col) for col in csv_files['concepts']['concepts']['columns']})
+
+    if concept_ids := concept.get('ids'):
+        concept_ids['concept_id'] = concept_id
+        concept_ids['concept_name'] = concept_name
+        concept_ids['umls_aui'] = json.dumps(concept_ids.get('umls_aui'), ensure_ascii=False)
+        concept_ids['umls_cui'] = json.dumps(concept_ids.get('umls_cui'), ensure_ascii=False)
+        rows['ids'].append(concept_ids)
+
+    for ancestor in concept.get('ancestors') or []:
+        if ancestor_id := ancestor.get('id'):
+            rows['ancestors'].append({'concept_id': concept_id, 'ancestor_id': ancestor_id})
+
+    for count_by_year in concept.get('counts_by_year') or []:
+        count_by_year['concept_id'] = concept_id
+        count_by_year['concept_name'] = concept_name
+        rows['counts_by_year'].append(count_by_year)
+
+    for related_concept in concept.get('related_concepts') or []:
+        if related_concept_id := related_concept.get('id'):
+            rows['related_concepts'].append({
+                'concept_id': concept_id,
+                'related_concept_id': related_concept_id,
+                'score': related_concept.get('score'),
+            })
+    return
 
-                # related_works_writer.writerow({
-                rels_rows.append({
-                    'work_id': work_id,
-                    'related_work_id': related_work
-                })
 
-        # abstracts
-        if (abstract_inv_index := work.get('abstract_inverted_index')) is not None:
-            try:
-                abstract = reconstruct_abstract(abstract_inv_index)
-            except orjson.JSONDecodeError as e:
-                abstract = ''
-
-            abstract_row = {'work_id': work_id, 'title': title, 'abstract': abstract,
-                            'publication_year': work.get('publication_year')}
-            abstract_rows.append(abstract_row)
-            # abstracts_writer.writerow(abstract_row)
-
-    # write the batched parquets here
-    kinds = ['works', 'ids', 'primary_location', 'locations', 'authorships', 'biblio', 'concepts', 'mesh',
-             'referenced_works', 'related_works', 'abstracts']
-    row_names = [work_rows, id_rows, primary_location_rows, location_rows, authorship_rows, biblio_rows,
-                 concept_rows, mesh_rows, refs_rows, rels_rows, abstract_rows]
-
-    with tqdm(total=len(kinds), desc='Writing CSVs and parquets', leave=False, colour='green') as pbar:
-        for kind, rows in zip(kinds, row_names):
-            pbar.set_postfix_str(kind)
-            write_to_csv_and_parquet(json_filename=jsonl_file_name, kind=kind, rows=rows)
-            pbar.update(1)
-
-    finished_files.add(str(jsonl_file_name))
-    dump_pickle(obj=finished_files, path=finished_files_pickle_path)
+def parse_venue(venue: dict, skip_ids, rows: dict):
+    """
+    Flatten a single venue JSON into the per-kind row lists in rows, the rows of flatten_venues
+    """
+    if not (venue_id := venue.get('id')):
+        return
+    venue_id = convert_openalex_id_to_int(venue_id)
+    if venue_id in skip_ids:
+        return
+
+    venue_name = venue['display_name']
+    venue['venue_id'] = venue_id
+    venue['venue_name'] = venue_name
+    venue['issn'] = json.dumps(venue.get('issn'))
+    rows['venues'].append({col: venue.get(col) for col in csv_files['venues']['venues']['columns']})
+
+    if venue_ids := venue.get('ids'):
+        venue_ids['venue_id'] = venue_id
+        venue_ids['venue_name'] = venue_name
+        venue_ids['issn'] = json.dumps(venue_ids.get('issn'))
+        rows['ids'].append(venue_ids)
+
+    for count_by_year in venue.get('counts_by_year') or []:
+        count_by_year['venue_id'] = venue_id
+        count_by_year['venue_name'] = venue_name
+        rows['counts_by_year'].append(count_by_year)
     return
 
 
-def flatten_works(files_to_process: Union[str, int] = 'all', threads=1):
+def parse_institution(institution: dict, skip_ids, rows: dict):
     """
-    New flattening function that only writes Parquets, uses the Sources
+    Flatten a single institution JSON into the per-kind row lists in rows, the rows of flatten_institutions
+    """
+    if not (institution_id := institution.get('id')):
+        return
+    institution_id = convert_openalex_id_to_int(institution_id)
+    if institution_id in skip_ids:
+        return
+
+    institution_name = institution['display_name']
+    institution['institution_id'] = institution_id
+    institution['institution_name'] = institution_name
+    institution['display_name_acroynyms'] = json.dumps(institution.get('display_name_acroynyms'), ensure_ascii=False)
+    institution['display_name_alternatives'] = json.dumps(institution.get('display_name_alternatives'),
+                                                          ensure_ascii=False)
+    rows['institutions'].append({col: institution.get(col)
+                                 for col in csv_files['institutions']['institutions']['columns']})
+
+    if institution_ids := institution.get('ids'):
+        institution_ids['institution_id'] = institution_id
+        institution_ids['institution_name'] = institution_name
+        rows['ids'].append(institution_ids)
+
+    if institution_geo := institution.get('geo'):
+        institution_geo['institution_id'] = institution_id
+        institution_geo['institution_name'] = institution_name
+        rows['geo'].append(institution_geo)
+
+    associated_institutions = institution.get('associated_institutions',
+                                              institution.get('associated_insitutions'))  # typo in api
+    for associated_institution in associated_institutions or []:
+        if associated_institution_id := associated_institution.get('id'):
+            rows['associated_institutions'].append({
+                'institution_id': institution_id,
+                'associated_institution_id': associated_institution_id,
+                'relationship': associated_institution.get('relationship'),
+            })
+
+    for count_by_year in institution.get('counts_by_year') or []:
+        count_by_year['institution_id'] = institution_id
+        count_by_year['institution_name'] = institution_name
+        rows['counts_by_year'].append(count_by_year)
+    return
+
+
+# the row parser of each entity, see process_jsonl_file
+ENTITY_PARSERS = {'works': parse_work, 'authors': parse_author, 'concepts': parse_concept, 'venues': parse_venue,
+                  'institutions': parse_institution}
+
+
+class DiscardedRows:
+    """
+    Stand-in for the rows of a kind that is left out of a run, the parsers append to it as usual
+    """
+    def __len__(self):
+        return 0
+
+    def append(self, row: dict):
+        return
+
+    def clear(self):
+        return
+
+
+def process_jsonl_file(entity: str, skip_ids, jsonl_file_name, completion_log: CompletionLog,
+                       chunk_size: Optional[int] = None, use_arrow: bool = True, kinds: Optional[list] = None,
+                       stats_path: Optional[Path] = None, profile_dir: Optional[Path] = None):
+    """
+    Flatten one JSON lines file of an entity into a Parquet per kind of that entity, in a single pass over the file
+    completion_log: gets a record with the row count and checksum of every Parquet once they are all written
+    chunk_size: if set, flush every kind to its Parquet as a new row group whenever it has chunk_size rows,
+        so peak memory is bounded by the chunk size and not the partition size
+    use_arrow: collect the rows in ArrowTableBuilders with the fixed DTYPES schema instead of lists of dicts that
+        go through a pandas DataFrame, only works have the pandas writer
+    kinds: the kinds to write, all the kinds of the entity by default, the rows of the others are discarded
+    stats_path, profile_dir: where to append the per-stage stats of the file and dump its profile,
+        see instrumentation.instrument_file
     """
-    skip_ids = get_skip_ids('works')
+    parse_func = ENTITY_PARSERS[entity]
+    kinds = kinds or ENTITY_KINDS[entity]
+    assert use_arrow or entity == 'works', f'Only works can be written through pandas, got {entity=}'
+    in_worker = multiprocessing.parent_process() is not None  # nested progress bars of workers garble the terminal
+
+    with instrumentation.instrument_file(jsonl_file_name, entity=entity, stats_path=stats_path,
+                                         profile_dir=profile_dir) as stats:
+        read_stats = {}
+        blocks = iter_jsonl_line_blocks(jsonl_file_name, stats=read_stats)  # decompressed ahead on a reader thread
+        if chunk_size is None:
+            writers = None
+        else:
+            writers = {kind: ParquetChunkWriter(kind=kind,
+                                                parq_filename=get_parquet_path(kind, jsonl_file_name, entity))
+                       for kind in kinds}
+
+        rows = {kind: DiscardedRows() for kind in ENTITY_KINDS[entity]}
+        if use_arrow:
+            rows.update({kind: ArrowTableBuilder(kind, entity) for kind in kinds})
+        else:
+            rows.update({kind: [] for kind in kinds})
+
+        with tqdm(desc=f'Parsing JSONs... {str(Path(jsonl_file_name).parts[-2:])}', unit=' line', unit_scale=True,
+                  colour='blue', leave=False, disable=in_worker) as pbar:
+            while True:
+                with stats.stage('read_wait'):
+                    lines = next(blocks, None)
+                if lines is None:
+                    break
+
+                for line in lines:
+                    if not line.strip():
+                        continue
+
+                    with stats.stage('json_parse'):
+                        record = orjson.loads(line)
+                    with stats.stage('parse_rows'):
+                        parse_func(record, skip_ids, rows)
+                    stats.rows_in += 1
+
+                    if writers is not None:
+                        for kind, kind_rows in rows.items():
+                            if len(kind_rows) >= chunk_size:
+                                writers[kind].write_rows(kind_rows)
+                                kind_rows.clear()
+                pbar.update(len(lines))
+        stats.add_decompression(read_stats)
+
+        # write the batched parquets here
+        outputs = stats.outputs
+        with tqdm(total=len(kinds), desc='Writing CSVs and parquets', leave=False, colour='green',
+                  disable=in_worker) as pbar:
+            for kind in kinds:
+                pbar.set_postfix_str(kind)
+                if writers is None:
+                    outputs[kind] = write_to_csv_and_parquet(json_filename=jsonl_file_name, kind=kind,
+                                                             rows=rows[kind], entity=entity)
+                else:
+                    writers[kind].write_rows(rows[kind])
+                    outputs[kind] = writers[kind].close()
+                pbar.update(1)
+
+        with stats.stage('checkpoint'):
+            completion_log.record(jsonl_file_name, outputs=outputs)
+    return
+
+
+def process_work_json(skip_ids, jsonl_file_name, completion_log: CompletionLog,
+                      chunk_size: Optional[int] = None, use_arrow: bool = True):
+    """
+    Process each work JSON lines file in parallel, see process_jsonl_file
+    """
+    return process_jsonl_file(entity='works', skip_ids=skip_ids, jsonl_file_name=jsonl_file_name,
+                              completion_log=completion_log, chunk_size=chunk_size, use_arrow=use_arrow)
+
 
-    kinds = ['works', 'ids', 'primary_location', 'locations', 'authorships', 'biblio', 'concepts', 'mesh',
-             'referenced_works', 'related_works', 'abstracts']
-    for kind in kinds:
+def process_author_json(skip_ids, jsonl_file_name, completion_log: CompletionLog, chunk_size: Optional[int] = None):
+    """
+    Flatten an authors JSON lines file into all the author tables at once, see process_jsonl_file
+    """
+    return process_jsonl_file(entity='authors', skip_ids=skip_ids, jsonl_file_name=jsonl_file_name,
+                              completion_log=completion_log, chunk_size=chunk_size)
+
+
+def process_jsonl_file_shared(entity: str, jsonl_file_name, completion_log: CompletionLog,
+                              chunk_size: Optional[int] = None, use_arrow: bool = True, kinds: Optional[list] = None,
+                              stats_path: Optional[Path] = None, profile_dir: Optional[Path] = None):
+    """
+    process_jsonl_file for the pool workers, reading skip_ids and the settings of the parent from the state shared
+    with them
+    """
+    if CONFIG != get_shared_state('config'):  # spawned or forkserver workers start from the default paths
+        set_config(get_shared_state('config'))
+    return process_jsonl_file(entity=entity, skip_ids=get_shared_state('skip_ids'), jsonl_file_name=jsonl_file_name,
+                              completion_log=completion_log, chunk_size=chunk_size, use_arrow=use_arrow, kinds=kinds,
+                              stats_path=stats_path, profile_dir=profile_dir)
+
+
+def flatten_entity(entity: str, files_to_process: Union[str, int] = 'all', threads=1,
+                   chunk_size: Optional[int] = None, use_arrow: bool = True, kinds: Optional[list] = None,
+                   log_name: Optional[str] = None, stats: bool = True, profile: bool = False):
+    """
+    Flatten every file in the manifest of an entity into per-partition Parquets, one directory per kind.
+    Files are run largest first on threads processes and checkpointed in the completion log of the entity.
+    kinds: only write these kinds, see process_jsonl_file
+    log_name: name of the completion log, the entity by default. Runs over a different set of kinds need their own.
+    stats: append the per-stage stats of every file to PARQ_DIR/temp/stats_{log_name}.jsonl,
+        summarize them with python -m src.instrumentation
+    profile: also dump a cProfile of every file into PARQ_DIR/temp/profiles/{log_name}
+    """
+    skip_ids = get_skip_ids(entity)
+
+    for kind in kinds or ENTITY_KINDS[entity]:
         # ensure directories exist
-        if kind != 'works':
-            kind = f'works_{kind}'
-        path = (PARQ_DIR / kind)
+        path = get_parquet_path(kind=kind, json_filename='updated_date=/.gz', entity=entity).parent
         if not path.exists():
             print(f'Creating dir at {str(path)}')
             path.mkdir(parents=True)
 
-    finished_files_pickle_path = PARQ_DIR / 'temp' / 'finished_works.pkl'
-    finished_files_pickle_path.parent.mkdir(exist_ok=True)  # make the temp directory if needed
-
-    if finished_files_pickle_path.exists():
-        finished_files = load_pickle(finished_files_pickle_path)  # load the pickle
-        print(f'{len(finished_files)} existing files found!')
+    # append-only log shared by all the workers, replaces the old finished_*.pkl
+    if log_name is None:
+        completion_log = get_completion_log(kind=entity, parq_dir=PARQ_DIR,
+                                            legacy_pickle_path=PARQ_DIR / 'temp' / f'finished_{entity}.pkl')
     else:
-        finished_files = set()
-
-    works_manifest = read_manifest(kind='works', snapshot_dir=SNAPSHOT_DIR / 'data')
-    files = [str(entry.filename) for entry in works_manifest.entries]
-    files = [f for f in files if f not in finished_files]
+        completion_log = get_completion_log(kind=log_name, parq_dir=PARQ_DIR)
+    finished_files = completion_log.finished_files()  # files whose outputs are missing or resized are redone
+    if len(finished_files) > 0:
+        print(f'{len(finished_files)} existing files found!')
 
-    print(f'This might take a while, like 20 hours..')
+    manifest = read_manifest(kind=entity, snapshot_dir=SNAPSHOT_DIR / 'data')
+    entries = [entry for entry in manifest.entries if str(entry.filename) not in finished_files]
 
     if files_to_process == 'all':
-        files_to_process = len(files)
+        files_to_process = len(entries)
     print(f'{files_to_process=}')
 
-    args = []
+    entries = entries[: files_to_process]
 
-    for i, jsonl_file_name in tqdm(enumerate(files), desc='Flattening works...', total=files_to_process,
-                                   unit=' files'):
-        if i >= files_to_process:
-            break
-        if threads > 1:
-            args.append((skip_ids, jsonl_file_name, finished_files, finished_files_pickle_path))
-        else:
-            process_work_json(skip_ids=skip_ids, jsonl_file_name=jsonl_file_name, finished_files=finished_files,
-                              finished_files_pickle_path=finished_files_pickle_path)
+    stats_path = PARQ_DIR / 'temp' / f'stats_{log_name or entity}.jsonl' if stats else None
+    profile_dir = PARQ_DIR / 'temp' / 'profiles' / (log_name or entity) if profile else None
 
     if threads > 1:
-        print(f'Spinning up {threads} parallel threads')
-        parallel_async(func=process_work_json, args=args, num_workers=threads)
+        print(f'Spinning up {threads} parallel processes, largest files first')
+        parallel_largest_first(
+            func=process_jsonl_file_shared,
+            args=[(entity, str(entry.filename), completion_log, chunk_size, use_arrow, kinds, stats_path, profile_dir)
+                  for entry in entries],
+            sizes=[entry.count for entry in entries], names=[entry.updated_date for entry in entries],
+            num_workers=threads, shared_state={'skip_ids': skip_ids, 'config': CONFIG},
+        )
+    else:
+        for entry in tqdm(entries, desc=f'Flattening {entity}...', unit=' files'):
+            process_jsonl_file(entity=entity, skip_ids=skip_ids, jsonl_file_name=str(entry.filename),
+                               completion_log=completion_log, chunk_size=chunk_size, use_arrow=use_arrow, kinds=kinds,
+                               stats_path=stats_path, profile_dir=profile_dir)
+    if stats_path is not None and stats_path.exists():
+        print(f'Per-stage stats in {str(stats_path)!r}')
+    return
+
+
+def flatten_works(files_to_process: Union[str, int] = 'all', threads=1, chunk_size: Optional[int] = None,
+                  use_arrow: bool = True, abstracts: bool = True, profile: bool = False):
+    """
+    New flattening function that only writes Parquets, uses the Sources
+    chunk_size: stream each file and write Parquet row groups of at most chunk_size rows, see process_jsonl_file
+    use_arrow: build the Parquets with ArrowTableBuilders, set to False for the older pandas writer
+    abstracts: set to False to leave out works_abstracts, the most expensive kind to build, and run
+        flatten_abstracts later if they are needed
+    profile: dump a cProfile of every file next to the per-stage stats, see flatten_entity
+    """
+    print(f'This might take a while, like 20 hours..')
+    kinds = None if abstracts else [kind for kind in WORKS_KINDS if kind != 'abstracts']
+    flatten_entity(entity='works', files_to_process=files_to_process, threads=threads, chunk_size=chunk_size,
+                   use_arrow=use_arrow, kinds=kinds, profile=profile)
+    return
+
+
+def flatten_abstracts(files_to_process: Union[str, int] = 'all', threads=1, chunk_size: Optional[int] = None):
+    """
+    Deferred pass that only writes works_abstracts, for runs of flatten_works with abstracts=False.
+    It has its own completion log, finished_works_abstracts.jsonl.
+    """
+    flatten_entity(entity='works', files_to_process=files_to_process, threads=threads, chunk_size=chunk_size,
+                   kinds=['abstracts'], log_name='works_abstracts')
+    return
+
+
+def flatten_authors_parquet(files_to_process: Union[str, int] = 'all', threads=1, chunk_size: Optional[int] = None):
+    """
+    Parallel, single pass replacement for flatten_authors, flatten_authors_concepts and flatten_authors_hints.
+    Each authors file is parsed once into per-partition Parquets of the authors, ids, counts_by_year, concepts
+    and hints tables, with the same scheduling and completion log as the works.
+    The level 0 author concepts of flatten_authors_concepts are the rows of authors_concepts with level == 0.
+    """
+    flatten_entity(entity='authors', files_to_process=files_to_process, threads=threads, chunk_size=chunk_size)
+    return
+
+
+def flatten_concepts_parquet(files_to_process: Union[str, int] = 'all', threads=1):
+    """
+    Parallel replacement for flatten_concepts, writing typed per-partition Parquets of the concepts, ids, ancestors,
+    counts_by_year and related_concepts tables. The ancestor and related concept IDs are ints, unlike in the CSVs.
+    """
+    flatten_entity(entity='concepts', files_to_process=files_to_process, threads=threads)
+    return
+
+
+def flatten_venues_parquet(files_to_process: Union[str, int] = 'all', threads=1):
+    """
+    Parallel replacement for flatten_venues, writing typed per-partition Parquets of the venues, ids
+    and counts_by_year tables
+    """
+    flatten_entity(entity='venues', files_to_process=files_to_process, threads=threads)
+    return
 
+
+def flatten_institutions_parquet(files_to_process: Union[str, int] = 'all', threads=1):
+    """
+    Parallel replacement for flatten_institutions, writing typed per-partition Parquets of the institutions, ids,
+    geo, associated_institutions and counts_by_year tables. The associated institution IDs are ints.
+    """
+    flatten_entity(entity='institutions', files_to_process=files_to_process, threads=threads)
     return
 
 
+def verify_works(repair: bool = False, checksums: bool = True):
+    """
+    Check the works Parquets against the completion log, repair deletes the broken ones so the next run redoes them
+    """
+    completion_log = get_completion_log(kind='works', parq_dir=PARQ_DIR)
+    return completion_log.verify(repair=repair, checksums=checksums)
+
+
+def verify_authors(repair: bool = False, checksums: bool = True):
+    """
+    Check the author Parquets of flatten_authors_parquet against the completion log, see verify_works
+    """
+    completion_log = get_completion_log(kind='authors', parq_dir=PARQ_DIR)
+    return completion_log.verify(repair=repair, checksums=checksums)
+
+
 STRING_DTYPE = 'string[pyarrow]'  # use the more memory efficient PyArrow string datatype
 
 if STRING_DTYPE == 'string[pyarrow]':
@@ -1119,7 +1506,7 @@ DTYPES = {
         work_id='int64', publication_year='Int16', concept_id='int64', concept_name='category', level='uint8',
         score=float
     ),
-    'abstract': dict(
+    'abstracts': dict(
         work_id='int64', publication_year='Int16', title=STRING_DTYPE, abstract=STRING_DTYPE,
     ),
     'ids': dict(
@@ -1127,36 +1514,306 @@ DTYPES = {
     ),
     'biblio': dict(
         work_id='int64', volume=STRING_DTYPE, issue=STRING_DTYPE, first_page=STRING_DTYPE, last_page=STRING_DTYPE,
-    )
+    ),
+    'mesh': dict(
+        work_id='int64', descriptor_ui=STRING_DTYPE, descriptor_name=STRING_DTYPE, qualifier_ui=STRING_DTYPE,
+        qualifier_name=STRING_DTYPE, is_major_topic='boolean',
+    ),
+}
+
+AUTHOR_DTYPES = {
+    'authors': dict(
+        author_id='int64', orcid=STRING_DTYPE, author_name=STRING_DTYPE, display_name_alternatives=STRING_DTYPE,
+        works_count='uint32', cited_by_count='uint32', last_known_institution='Int64', updated_date=STRING_DTYPE,
+    ),
+    'ids': dict(
+        author_id='int64', author_name=STRING_DTYPE, openalex=STRING_DTYPE, orcid=STRING_DTYPE, scopus=STRING_DTYPE,
+        twitter=STRING_DTYPE, wikipedia=STRING_DTYPE, mag='Int64',
+    ),
+    'counts_by_year': dict(
+        author_id='int64', author_name=STRING_DTYPE, year='Int16', works_count='uint32', cited_by_count='uint32',
+    ),
+    'concepts': dict(
+        author_id='int64', author_name=STRING_DTYPE, works_count='uint32', cited_by_count='uint32',
+        concept_id='int64', concept_name='category', level='uint8', score=float,
+    ),
+    'hints': dict(
+        author_id='int64', author_name=STRING_DTYPE, works_count='uint32', cited_by_count='uint32',
+        most_cited_work=STRING_DTYPE,
+    ),
+}
+
+CONCEPT_DTYPES = {
+    'concepts': dict(
+        concept_id='int64', concept_name=STRING_DTYPE, wikidata=STRING_DTYPE, level='uint8', description=STRING_DTYPE,
+        works_count='uint32', cited_by_count='uint32', updated_date=STRING_DTYPE,
+    ),
+    'ids': dict(
+        concept_id='int64', concept_name=STRING_DTYPE, openalex=STRING_DTYPE, wikidata=STRING_DTYPE,
+        wikipedia=STRING_DTYPE, umls_aui=STRING_DTYPE, umls_cui=STRING_DTYPE, mag='Int64',
+    ),
+    'ancestors': dict(
+        concept_id='int64', ancestor_id='Int64',
+    ),
+    'counts_by_year': dict(
+        concept_id='int64', concept_name=STRING_DTYPE, year='Int16', works_count='uint32', cited_by_count='uint32',
+    ),
+    'related_concepts': dict(
+        concept_id='int64', related_concept_id='Int64', score=float,
+    ),
 }
 
+VENUE_DTYPES = {
+    'venues': dict(
+        venue_id='int64', issn_l=STRING_DTYPE, issn=STRING_DTYPE, venue_name=STRING_DTYPE, type='category',
+        publisher=STRING_DTYPE, works_count='uint32', cited_by_count='uint32', is_oa='boolean', is_in_doaj='boolean',
+        homepage_url=STRING_DTYPE, updated_date=STRING_DTYPE,
+    ),
+    'ids': dict(
+        venue_id='int64', venue_name=STRING_DTYPE, openalex=STRING_DTYPE, issn_l=STRING_DTYPE, issn=STRING_DTYPE,
+        mag='Int64',
+    ),
+    'counts_by_year': dict(
+        venue_id='int64', venue_name=STRING_DTYPE, year='Int16', works_count='uint32', cited_by_count='uint32',
+    ),
+}
 
-def write_to_csv_and_parquet(rows: list, kind: str, json_filename: str, debug: bool = False,
-                             csv_writer: Optional[csv.DictWriter] = None):
+INSTITUTION_DTYPES = {
+    'institutions': dict(
+        institution_id='int64', institution_name=STRING_DTYPE, ror=STRING_DTYPE, country_code='category',
+        type='category', homepage_url=STRING_DTYPE, display_name_acroynyms=STRING_DTYPE,
+        display_name_alternatives=STRING_DTYPE, works_count='uint32', cited_by_count='uint32',
+        updated_date=STRING_DTYPE,
+    ),
+    'ids': dict(
+        institution_id='int64', institution_name=STRING_DTYPE, openalex=STRING_DTYPE, ror=STRING_DTYPE,
+        grid=STRING_DTYPE, wikipedia=STRING_DTYPE, wikidata=STRING_DTYPE, mag='Int64',
+    ),
+    'geo': dict(
+        institution_id='int64', institution_name=STRING_DTYPE, city=STRING_DTYPE, geonames_city_id=STRING_DTYPE,
+        region=STRING_DTYPE, country_code='category', country='category', latitude=float, longitude=float,
+    ),
+    'associated_institutions': dict(
+        institution_id='int64', associated_institution_id='Int64', relationship='category',
+    ),
+    'counts_by_year': dict(
+        institution_id='int64', institution_name=STRING_DTYPE, year='Int16', works_count='uint32',
+        cited_by_count='uint32',
+    ),
+}
+
+ENTITY_DTYPES = {'works': DTYPES, 'authors': AUTHOR_DTYPES, 'concepts': CONCEPT_DTYPES, 'venues': VENUE_DTYPES,
+                 'institutions': INSTITUTION_DTYPES}
+
+
+WORKS_DATE_COLUMNS = ['publication_date', 'created_date', 'updated_date']  # parsed into timestamps
+# the ISO 8601 dates of the snapshots, eg 2023-02-01 or 2023-02-01T01:02:03.123456, which Arrow casts in one go
+ISO_DATE_PATTERN = r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}:\d{2}(\.\d{1,6})?)?$'
+
+# Arrow counterparts of the pandas dtypes used in DTYPES
+ARROW_TYPES = {
+    'int64': pa.int64(), 'Int64': pa.int64(), 'Int16': pa.int16(), 'uint32': pa.uint32(), 'uint16': pa.uint16(),
+    'uint8': pa.uint8(), 'boolean': pa.bool_(), float: pa.float64(), STRING_DTYPE: pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()), 'datetime64[ns]': pa.timestamp('ms'),
+}
+
+
+def get_arrow_schema(kind: str, entity: str = 'works') -> pa.Schema:
     """
-    Write rows to the CSV using the CSV writer
-    Also create a new file inside the respective parquet directory
+    Fixed Arrow schema of a kind of an entity built from its columns and ENTITY_DTYPES, columns without a dtype are
+    strings. The pandas metadata is attached so that pd.read_parquet restores the same dtypes as the pandas writer.
     """
-    if len(rows) == 0:
+    kind_dtypes = ENTITY_DTYPES[entity].get(kind, {})
+    dtypes = {col: kind_dtypes.get(col, STRING_DTYPE) for col in csv_files[entity][kind]['columns']}
+    if entity == 'works' and kind == 'works':
+        dtypes.update({col: 'datetime64[ns]' for col in WORKS_DATE_COLUMNS})
+    return make_arrow_schema(dtypes)
+
+
+def make_arrow_schema(dtypes: dict) -> pa.Schema:
+    """
+    Arrow schema of columns with the pandas dtypes of dtypes, with the pandas metadata of those dtypes
+    """
+    empty_df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+    metadata = pa.Schema.from_pandas(empty_df, preserve_index=False).metadata
+
+    return pa.schema([pa.field(col, ARROW_TYPES[dtype]) for col, dtype in dtypes.items()], metadata=metadata)
+
+
+def coerce_value(value, type_: pa.DataType):
+    """
+    Coerce a single value to type_, returning None if it does not fit
+    """
+    if value is None:
+        return None
+    try:
+        if pa.types.is_string(type_):
+            return str(value)
+        if pa.types.is_integer(type_):
+            value = int(value)
+        elif pa.types.is_floating(type_):
+            value = float(value)
+        return pa.scalar(value, type=type_).as_py()  # raises if the value is out of range
+    except (ValueError, TypeError, OverflowError, pa.ArrowInvalid):
+        return None
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_dates(values, type_: pa.DataType = pa.timestamp('ms')) -> pa.Array:
+    """
+    Parse a column of date strings into an Arrow array of type_. The strings matching ISO_DATE_PATTERN are cast by
+    Arrow all at once, only the others go through parse_date one by one. Dates that do not parse, or do not fit a
+    nanosecond type_, become nulls and are counted as malformed_dates in the stats of the file.
+    """
+    with instrumentation.stage('dates'):
+        strings = values if isinstance(values, pa.Array) else to_arrow_array(values, pa.string())
+        is_iso = pc.fill_null(pc.match_substring_regex(strings, ISO_DATE_PATTERN), False)
+        try:
+            dates = pc.if_else(is_iso, strings, pa.scalar(None, pa.string())).cast(pa.timestamp('us'))
+            is_slow = pc.and_(pc.is_valid(strings), pc.invert(is_iso))
+        except pa.ArrowInvalid:  # well formed but out of range, eg 2023-02-30
+            dates, is_slow = pa.nulls(len(strings), pa.timestamp('us')), pc.is_valid(strings)
+
+        num_slow = pc.sum(is_slow).as_py() or 0
+        if num_slow > 0:
+            slow_dates = pa.array([parse_date(value) for value in strings.filter(is_slow).to_pylist()],
+                                  type=pa.timestamp('us'))
+            dates = pc.replace_with_mask(dates, is_slow, slow_dates)
+
+        if pa.types.is_timestamp(type_) and type_.unit == 'ns':  # like pd.to_datetime(errors='coerce')
+            micros, limit = dates.cast(pa.int64()), np.iinfo(np.int64).max // 1000
+            dates = pc.if_else(pc.and_(pc.greater(micros, -limit), pc.less(micros, limit)), dates,
+                               pa.scalar(None, pa.timestamp('us')))
+        dates = dates.cast(type_, safe=False)
+        instrumentation.count('malformed_dates', pc.sum(pc.and_(pc.is_valid(strings), pc.is_null(dates))).as_py() or 0)
+    return dates
+
+
+def to_arrow_array(values: list, type_: pa.DataType) -> pa.Array:
+    """
+    Convert a column buffer into an Arrow array of type_. Values that do not fit the type become nulls.
+    """
+    if pa.types.is_dictionary(type_):
+        return to_arrow_array(values, type_.value_type).dictionary_encode()
+
+    if pa.types.is_timestamp(type_):
+        return parse_dates(values, type_)
+
+    try:
+        return pa.array(values, type=type_, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):  # fall back to converting value by value
+        return pa.array([coerce_value(value, type_) for value in values], type=type_)
+
+
+def openalex_ids_to_arrow_array(values, type_: pa.DataType = pa.int64()) -> pa.Array:
+    """
+    Convert a column of raw OpenAlex ID strings into an Arrow integer array, malformed IDs become nulls
+    """
+    ids, null_mask = convert_openalex_ids_to_int(values)
+    return pa.array(ids, mask=null_mask, type=pa.int64()).cast(type_)
+
+
+ABSTRACTS_BATCH_SIZE = 2_000  # inverted indexes held by an abstracts builder before they are reconstructed
+
+
+class ArrowTableBuilder:
+    """
+    Append the rows of one kind straight into per-column buffers, and build pyarrow Tables with the fixed schema
+    of that kind without going through a pandas DataFrame.
+    The works abstracts come in as inverted indexes, several times larger than the text, so they are reconstructed
+    ABSTRACTS_BATCH_SIZE rows at a time as the rows come in instead of all at once when the table is built.
+    """
+    def __init__(self, kind: str, entity: str = 'works'):
+        self.kind = kind
+        self.entity = entity
+        self.schema = get_arrow_schema(kind, entity)
+        self.id_columns = set(OPENALEX_ID_COLUMNS.get(entity, {}).get(kind, []))
+        self.columns = {name: [] for name in self.schema.names}
+        self.num_rows = 0
+        self.has_inverted_abstracts = entity == 'works' and kind == 'abstracts'  # the parser leaves them as is
+        self.num_reconstructed = 0  # rows whose abstract is already reconstructed
+
+    def __len__(self):
+        return self.num_rows
+
+    def append(self, row: dict):
+        for col, values in self.columns.items():
+            values.append(row.get(col))
+        self.num_rows += 1
+        if self.has_inverted_abstracts and self.num_rows - self.num_reconstructed >= ABSTRACTS_BATCH_SIZE:
+            self.reconstruct_abstracts()
         return
 
-    if csv_writer is not None:
-        csv_writer.writerows(rows)
+    def reconstruct_abstracts(self):
+        """
+        Replace the inverted indexes appended since the last call with the reconstructed abstracts
+        """
+        abstracts = self.columns['abstract']
+        with instrumentation.stage('abstracts'):
+            abstracts[self.num_reconstructed:] = reconstruct_abstracts(abstracts[self.num_reconstructed:])
+        self.num_reconstructed = self.num_rows
+        return
+
+    def clear(self):
+        for values in self.columns.values():
+            values.clear()
+        self.num_rows = 0
+        self.num_reconstructed = 0
+        return
+
+    def to_table(self) -> pa.Table:
+        with instrumentation.stage('table_build'):
+            return self._to_table()
+
+    def _to_table(self) -> pa.Table:
+        if self.has_inverted_abstracts:  # the last, partial batch
+            self.reconstruct_abstracts()
+        columns = self.columns
+
+        arrays = []
+        for field in self.schema:
+            if field.name in self.id_columns:
+                with instrumentation.stage('id_conversion'):
+                    arrays.append(openalex_ids_to_arrow_array(columns[field.name], field.type))
+            else:
+                arrays.append(to_arrow_array(columns[field.name], field.type))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+
+        if self.entity == 'works' and self.kind == 'authorships':  # weird bug causes authorships table to have repeated rows sometimes
+            first_rows = (  # row number of the first occurrence of every distinct row
+                table
+                .append_column('row_number', pa.array(range(len(table)), type=pa.int64()))
+                .group_by(self.schema.names, use_threads=False)
+                .aggregate([('row_number', 'min')])
+                ['row_number_min']
+            )
+            table = table.take(pc.take(first_rows, pc.sort_indices(first_rows)))
+        return table
 
+
+def get_parquet_path(kind: str, json_filename, entity: str = 'works') -> Path:
+    """
+    Path of the Parquet file holding the rows of kind flattened from json_filename
+    """
     json_filename = Path(json_filename)
 
-    kind_ = f'works_{kind}' if kind != 'works' else 'works'
+    kind_ = f'{entity}_{kind}' if kind != entity else entity
     parq_filename = PARQ_DIR / kind_ / (
             '_'.join(json_filename.parts[-2:]).replace('updated_date=', '').replace('.gz', '')
             + '.parquet')
+    return parq_filename
 
-    if parq_filename.exists():
-        print(f'Parquet already exists {str(parq_filename.parts[-2:])}')
-        return
-    # parq_filename.parent.mkdir(exist_ok=True, parents=True)
-    if debug:
-        print(f'{kind=} {parq_filename=} {len(rows)=:,}')
 
+def make_dataframe(rows: list, kind: str) -> pd.DataFrame:
+    """
+    Convert the rows of a works kind into a DataFrame with the columns and datatypes of that kind
+    """
     keep_cols = csv_files['works'][kind]['columns']
 
     df = (
@@ -1169,21 +1826,21 @@ def write_to_csv_and_parquet(rows: list, kind: str, json_filename: str, debug: b
 
     df = df[keep_cols]
 
+    for col in OPENALEX_ID_COLUMNS['works'].get(kind, []):
+        with instrumentation.stage('id_conversion'):
+            ids, null_mask = convert_openalex_ids_to_int(df[col])
+            df[col] = pd.arrays.IntegerArray(ids, null_mask)
+
+    if kind == 'abstracts':
+        with instrumentation.stage('abstracts'):
+            df['abstract'] = reconstruct_abstracts(df['abstract'])
+
     if kind in DTYPES:
         df = df.astype(dtype=DTYPES[kind], errors='ignore')  # handle pesky dates
 
     if kind == 'works':
-        df = (
-            df
-            .assign(
-                publication_date=lambda df_: pd.to_datetime(df_.publication_date, errors='coerce',
-                                                            infer_datetime_format=True),
-                created_date=lambda df_: pd.to_datetime(df_.created_date, errors='coerce',
-                                                        infer_datetime_format=True),
-                updated_date=lambda df_: pd.to_datetime(df_.updated_date, errors='coerce',
-                                                        infer_datetime_format=True),
-            )
-        )
+        for col in WORKS_DATE_COLUMNS:  # NaT for the malformed dates
+            df[col] = parse_dates(df[col], type_=pa.timestamp('ns')).to_numpy(zero_copy_only=False)
         # don't set the index here
         # df.set_index('work_id', inplace=True)
         # df.sort_values(by='work_id', inplace=True)  # helps with setting the index later
@@ -1191,8 +1848,101 @@ def write_to_csv_and_parquet(rows: list, kind: str, json_filename: str, debug: b
     elif kind == 'authorships':
         df.drop_duplicates(inplace=True)  # weird bug causes authorships table to have repeated rows sometimes
 
-    df.to_parquet(parq_filename, engine='pyarrow', coerce_timestamps='ms', allow_truncated_timestamps=True)
-    return
+    return df
+
+
+def write_to_csv_and_parquet(rows: Union[list, ArrowTableBuilder], kind: str, json_filename: str, debug: bool = False,
+                             csv_writer: Optional[csv.DictWriter] = None, entity: str = 'works'):
+    """
+    Write rows to the CSV using the CSV writer
+    Also create a new file inside the respective parquet directory
+    rows: either a list of row dicts, converted through a pandas DataFrame, or an ArrowTableBuilder written directly
+    The Parquet is written to a temporary file and renamed into place, so it either exists whole or not at all.
+    Returns the Parquet path (None if there were no rows) and the number of rows written
+    """
+    if len(rows) == 0:
+        return None, 0
+
+    if isinstance(rows, ArrowTableBuilder):
+        table, df = rows.to_table(), None
+    else:
+        with instrumentation.stage('table_build'):
+            table, df = None, make_dataframe(rows=rows, kind=kind)
+
+    if csv_writer is not None:
+        csv_writer.writerows(table.to_pylist() if table is not None else df.to_dict('records'))
+
+    parq_filename = get_parquet_path(kind=kind, json_filename=json_filename, entity=entity)
+    temp_filename = parq_filename.with_name(parq_filename.name + '.tmp')
+
+    # parq_filename.parent.mkdir(exist_ok=True, parents=True)
+    if debug:
+        print(f'{kind=} {parq_filename=} {len(rows)=:,}')
+
+    with instrumentation.stage('parquet_write'):
+        if table is not None:
+            pq.write_table(table, temp_filename, coerce_timestamps='ms', allow_truncated_timestamps=True)
+            num_rows = len(table)
+        else:
+            df.to_parquet(temp_filename, engine='pyarrow', coerce_timestamps='ms', allow_truncated_timestamps=True)
+            num_rows = len(df)
+
+        os.replace(temp_filename, parq_filename)
+    return parq_filename, num_rows
+
+
+class ParquetChunkWriter:
+    """
+    Write the rows of one works kind into a Parquet file as a series of row groups, one per chunk.
+    The file is written under a temporary name and moved into place on close, so an interrupted run
+    never leaves behind a partial Parquet that looks finished.
+    """
+    def __init__(self, kind: str, parq_filename: Path):
+        self.kind = kind
+        self.parq_filename = parq_filename
+        self.temp_filename = parq_filename.with_name(parq_filename.name + '.tmp')
+        self.writer = None
+        self.num_rows = 0
+
+    def write_rows(self, rows: Union[list, ArrowTableBuilder]):
+        if len(rows) == 0:
+            return
+
+        if isinstance(rows, ArrowTableBuilder):
+            table = rows.to_table()  # already has the fixed schema of the kind
+        else:
+            with instrumentation.stage('table_build'):
+                table = pa.Table.from_pandas(make_dataframe(rows=rows, kind=self.kind), preserve_index=False)
+
+        if self.writer is None:
+            # fix the schema from the first chunk, widening the types that can drift between chunks
+            fields = []
+            for field in table.schema:
+                if pa.types.is_dictionary(field.type):
+                    field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+                elif pa.types.is_null(field.type):
+                    field = field.with_type(pa.string())
+                fields.append(field)
+            schema = pa.schema(fields, metadata=table.schema.metadata)
+            self.writer = pq.ParquetWriter(self.temp_filename, schema=schema, coerce_timestamps='ms',
+                                           allow_truncated_timestamps=True)
+        with instrumentation.stage('parquet_write'):
+            table = table.cast(self.writer.schema)
+            self.writer.write_table(table, row_group_size=len(table))
+        self.num_rows += len(table)
+        return
+
+    def close(self):
+        """
+        Returns the Parquet path (None if no rows were written) and the number of rows written
+        """
+        if self.writer is None:
+            return None, 0
+        with instrumentation.stage('parquet_write'):
+            self.writer.close()
+            os.replace(self.temp_filename, self.parq_filename)
+        self.writer = None
+        return self.parq_filename, self.num_rows
 
 
 def init_dict_writer(csv_file, file_spec, **kwargs):
@@ -1206,15 +1956,6 @@ def init_dict_writer(csv_file, file_spec, **kwargs):
 
 
 if __name__ == '__main__':
-    # flatten_concepts()  # takes about 30s
-    # flatten_venues()  # takes about 20s
-    # flatten_institutions()  # takes about 20s
-
-    # files_to_process = 10
-    files_to_process = 'all'  # to do everything
-    # files_to_process = 100  # or any other number
-    threads = 7
-
-    # flatten_authors(files_to_process=files_to_process)  # takes 6-7 hours for the whole thing! ~3 mins per file
+    from src.cli import main  # python -m src.cli flatten works --threads 7, see python -m src.cli --help
 
-    flatten_works(files_to_process=files_to_process, threads=threads)  # takes about 20 hours  ~6 mins per file
+    sys.exit(main(['flatten', *sys.argv[1:]]))
@@ -0,0 +1,298 @@
+"""
+Incremental updates of a flattened snapshot.
+A new OpenAlex snapshot mostly adds updated_date partitions and rewrites a few recent ones, so instead of flattening
+everything again, the manifest of the new snapshot is compared with the one of the last update by partition,
+record count and file identity. Only new and changed files are flattened, the Parquets of changed and removed files
+are dropped, and the new merged_ids files are written out as tombstones and optionally deleted from the Parquets.
+The slices, compaction, deduplication and normalization drop the rows of tombstoned works as they read the Parquets,
+so the merges apply to their outputs without --apply-deletes. The authors are not read by any of them, their merges
+only reach the author Parquets with --apply-deletes.
+    python -m src.cli update works --threads 7 [--apply-deletes] [--dry-run] [--parq-dir ...]
+"""
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from box import Box
+
+import src.flatten_openalex as flatten_openalex
+from src.checkpoint import CompletionLog, get_completion_log
+from src.utils import read_manifest, convert_openalex_ids_to_int
+
+ID_COLUMNS = {'works': 'work_id', 'authors': 'author_id'}  # the ID column shared by all kinds of an entity
+
+
+def get_state_path(entity: str) -> Path:
+    return flatten_openalex.PARQ_DIR / 'temp' / f'snapshot_state_{entity}.json'
+
+
+def load_state(entity: str) -> Optional[Box]:
+    """
+    State saved by the last update: the manifest files with their identity and the merged_ids files applied
+    """
+    state_path = get_state_path(entity)
+    if not state_path.exists():
+        return None
+    with open(state_path) as reader:
+        return Box(json.load(reader))
+
+
+def save_state(entity: str, files: dict, merged_ids: list):
+    state_path = get_state_path(entity)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = state_path.with_name(state_path.name + '.tmp')
+    with open(temp_path, 'w') as writer:
+        json.dump({'time': time.time(), 'files': files, 'merged_ids': sorted(merged_ids)}, writer, indent=1)
+    os.replace(temp_path, state_path)
+    return
+
+
+def get_manifest_files(entity: str) -> dict:
+    """
+    Identity of every file in the current manifest, keyed by updated_date partition and part name.
+    A file is identified by its record count and the content length of the manifest, plus its size on disk so that
+    a partially synced file is not taken for the finished one.
+    """
+    manifest = read_manifest(kind=entity, snapshot_dir=flatten_openalex.SNAPSHOT_DIR / 'data')
+    files = {}
+    for entry in manifest.entries:
+        filename = Path(entry.filename)
+        files['/'.join(filename.parts[-2:])] = {
+            'filename': str(filename),
+            'count': entry.count,
+            'content_length': entry.content_length,
+            'bytes': filename.stat().st_size if filename.exists() else None,
+        }
+    return files
+
+
+def diff_manifests(old_files: dict, new_files: dict) -> Box:
+    """
+    Split the files into new, changed, removed and unchanged ones by partition and identity
+    """
+    identity = lambda file: (file['count'], file['content_length'], file['bytes'])
+
+    diff = Box({'new': [], 'changed': [], 'removed': [], 'unchanged': []})
+    for key, new_file in new_files.items():
+        if key not in old_files:
+            diff.new.append(key)
+        elif identity(old_files[key]) != identity(new_file):
+            diff.changed.append(key)
+        else:
+            diff.unchanged.append(key)
+    diff.removed = [key for key in old_files if key not in new_files]
+    return diff
+
+
+def get_extra_completion_logs(entity: str) -> list:
+    """
+    Completion logs of the passes over a subset of the kinds of entity that have been run, like flatten_abstracts
+    """
+    extra_logs = [get_completion_log(kind=f'{entity}_abstracts', parq_dir=flatten_openalex.PARQ_DIR)] \
+        if entity == 'works' else []
+    return [completion_log for completion_log in extra_logs if completion_log.path.exists()]
+
+
+def drop_outputs(entity: str, completion_log: CompletionLog, filenames: list):
+    """
+    Delete the Parquets of filenames, including the ones of legacy entries without recorded outputs,
+    and mark them invalid in the completion log and the extra completion logs of entity
+    """
+    num_deleted = 0
+    for filename in filenames:
+        for kind in flatten_openalex.ENTITY_KINDS[entity]:
+            parq_filename = flatten_openalex.get_parquet_path(kind=kind, json_filename=filename, entity=entity)
+            if parq_filename.exists():
+                parq_filename.unlink()
+                num_deleted += 1
+    for log in [completion_log] + get_extra_completion_logs(entity):
+        num_deleted += log.invalidate(*filenames)
+    return num_deleted
+
+
+def get_merged_ids_files(entity: str) -> list:
+    merged_ids_path = flatten_openalex.SNAPSHOT_DIR / 'data' / 'merged_ids' / entity
+    return sorted(merged_ids_path.glob('*.csv.gz')) if merged_ids_path.exists() else []
+
+
+def get_tombstones_path(entity: str) -> Path:
+    return flatten_openalex.PARQ_DIR / f'{entity}_tombstones'
+
+
+def write_tombstones(entity: str, merged_ids_file: Path) -> pa.Table:
+    """
+    Write the IDs of a merged_ids file as a tombstone Parquet, readers anti-join on it to drop the merged entries
+    """
+    merged_df = pd.read_csv(merged_ids_file, dtype=str)
+    ids, null_mask = convert_openalex_ids_to_int(merged_df.id)
+    merge_into_ids, merge_into_null_mask = convert_openalex_ids_to_int(merged_df.merge_into_id)
+    tombstones = pa.table({
+        'id': pa.array(ids, mask=null_mask, type=pa.int64()),
+        'merge_into_id': pa.array(merge_into_ids, mask=merge_into_null_mask, type=pa.int64()),
+        'merge_date': pa.array(merged_df.merge_date, type=pa.string()),
+    })
+
+    tombstones_path = get_tombstones_path(entity) / merged_ids_file.name.replace('.csv.gz', '.parquet')
+    tombstones_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = tombstones_path.with_name(tombstones_path.name + '.tmp')
+    pq.write_table(tombstones, temp_path)
+    os.replace(temp_path, tombstones_path)
+    return tombstones
+
+
+def read_tombstones(entity: str) -> np.ndarray:
+    """
+    Sorted IDs of all the tombstones written for entity
+    """
+    tombstones_path = get_tombstones_path(entity)
+    if not tombstones_path.exists() or not any(tombstones_path.glob('*.parquet')):
+        return np.array([], dtype=np.int64)
+    ids = pq.read_table(tombstones_path, columns=['id']).column('id').drop_null().to_numpy()
+    return np.unique(ids)
+
+
+def drop_tombstoned(batches, ids: np.ndarray, id_column: str = 'work_id'):
+    """
+    Record batches without the rows whose id_column is one of the tombstoned ids, of read_tombstones
+    """
+    value_set = pa.array(ids, type=pa.int64())
+    for batch in batches:
+        if len(ids) > 0:
+            batch = batch.filter(pc.invert(pc.is_in(batch.column(id_column), value_set=value_set)))
+        yield batch
+
+
+def might_contain(parq_filename: Path, id_column: str, ids: np.ndarray) -> bool:
+    """
+    Use the min/max statistics of the row groups to rule out Parquets that cannot hold any of the sorted ids
+    """
+    metadata = pq.ParquetFile(parq_filename).metadata
+    col_idx = metadata.schema.to_arrow_schema().get_field_index(id_column)
+    for rg in range(metadata.num_row_groups):
+        stats = metadata.row_group(rg).column(col_idx).statistics
+        if stats is None or not stats.has_min_max:
+            return True
+        if np.searchsorted(ids, stats.max, side='right') > np.searchsorted(ids, stats.min, side='left'):
+            return True
+    return False
+
+
+def apply_tombstones(entity: str, completion_log: CompletionLog, ids: np.ndarray, skip_files: set = frozenset()):
+    """
+    Delete the rows with the sorted tombstoned ids from the finished Parquets of entity, rewriting only the files
+    whose statistics overlap with ids, and record the rewritten files again so their checksums stay valid.
+    Legacy entries have no recorded outputs and are left to the readers.
+    """
+    id_column = ID_COLUMNS[entity]
+    ids_array = pa.array(ids, type=pa.int64())
+    num_deleted_rows = 0
+
+    for filename, record in completion_log.load().items():
+        if record.status != 'done' or filename in skip_files:
+            continue
+
+        outputs, rewritten = {}, False
+        for kind, output in record.outputs.items():
+            parq_filename = completion_log.root / output.path if output.path is not None else None
+            outputs[kind] = (parq_filename, output.rows)
+            if parq_filename is None or not parq_filename.exists() or \
+                    not might_contain(parq_filename, id_column, ids):
+                continue
+
+            table = pq.read_table(parq_filename)
+            mask = pc.invert(pc.is_in(table.column(id_column), value_set=ids_array))
+            num_rows = pc.sum(mask.cast(pa.int64())).as_py() or 0
+            if num_rows == table.num_rows:
+                continue
+
+            num_deleted_rows += table.num_rows - num_rows
+            rewritten = True
+            if num_rows == 0:
+                parq_filename.unlink()
+                outputs[kind] = (None, 0)
+                continue
+
+            temp_filename = parq_filename.with_name(parq_filename.name + '.tmp')
+            pq.write_table(table.filter(mask), temp_filename, coerce_timestamps='ms', allow_truncated_timestamps=True)
+            os.replace(temp_filename, parq_filename)
+            outputs[kind] = (parq_filename, num_rows)
+
+        if rewritten:
+            completion_log.record(filename, outputs=outputs)
+
+    return num_deleted_rows
+
+
+def update_snapshot(entity: str = 'works', threads=1, chunk_size: Optional[int] = None, apply_deletes: bool = False,
+                    dry_run: bool = False) -> Box:
+    """
+    Bring the Parquets of entity up to date with the snapshot at SNAPSHOT_DIR, doing work proportional to the change.
+    1. diff the manifest against the state of the last update
+    2. drop the Parquets of changed and removed files, then flatten the new and changed files
+    3. write tombstones for the new merged_ids files, and if apply_deletes, delete those IDs from the Parquets
+    4. save the new state
+    Without a saved state, the files in the completion log and the merged_ids files are taken as up to date, the full
+    flatten skipped the merged IDs, so run this once right after a full flatten to start tracking a snapshot.
+    An interrupted update can be rerun, files flattened since the last saved state are not dropped again.
+    """
+    completion_log = get_completion_log(kind=entity, parq_dir=flatten_openalex.PARQ_DIR)
+    new_files = get_manifest_files(entity)
+    state = load_state(entity)
+
+    if state is None:
+        print(f'No saved state for {entity!r}, taking the finished files as up to date')
+        finished_files = completion_log.finished_files()
+        state = Box({'time': time.time(), 'merged_ids': [path.name for path in get_merged_ids_files(entity)],
+                     'files': {key: file for key, file in new_files.items() if file['filename'] in finished_files}})
+
+    diff = diff_manifests(old_files=state.files.to_dict(), new_files=new_files)
+    merged_ids_files = [path for path in get_merged_ids_files(entity) if path.name not in state.merged_ids]
+    print(f'{entity!r}: {len(diff.new):,} new, {len(diff.changed):,} changed, {len(diff.removed):,} removed, '
+          f'{len(diff.unchanged):,} unchanged files, {len(merged_ids_files):,} new merged_ids files')
+    if dry_run:
+        return diff
+
+    # files already redone by an interrupted run of this update are newer than the state
+    records = completion_log.load()
+    stale_files = [state.files[key].filename for key in diff.removed] + \
+                  [new_files[key]['filename'] for key in diff.changed
+                   if new_files[key]['filename'] not in records
+                   or records[new_files[key]['filename']].time < state.time]
+    if len(stale_files) > 0:
+        num_deleted = drop_outputs(entity, completion_log=completion_log, filenames=stale_files)
+        print(f'Dropped {num_deleted:,} Parquets of {len(stale_files):,} changed or removed files')
+
+    # the new and changed files are the ones missing from the completion log
+    flatten_openalex.flatten_entity(entity=entity, threads=threads, chunk_size=chunk_size)
+
+    if len(merged_ids_files) > 0:
+        for merged_ids_file in merged_ids_files:
+            tombstones = write_tombstones(entity, merged_ids_file)
+            print(f'Wrote {tombstones.num_rows:,} tombstones from {merged_ids_file.name!r}')
+
+        if apply_deletes:
+            # the files flattened in this update already skipped every merged ID
+            just_flattened = {new_files[key]['filename'] for key in diff.new + diff.changed}
+            new_ids = np.unique(np.concatenate([
+                pq.read_table(get_tombstones_path(entity) / path.name.replace('.csv.gz', '.parquet'),
+                              columns=['id']).column('id').drop_null().to_numpy()
+                for path in merged_ids_files
+            ]))
+            num_deleted_rows = sum(
+                apply_tombstones(entity, completion_log=log, ids=new_ids, skip_files=just_flattened)
+                for log in [completion_log] + get_extra_completion_logs(entity)
+            )
+            print(f'Deleted {num_deleted_rows:,} rows of merged IDs')
+
+    if len(diff.new) + len(diff.changed) > 0 and len(get_extra_completion_logs(entity)) > 0:
+        print(f'Run flatten_abstracts to bring the deferred abstracts up to date')
+
+    save_state(entity, files=new_files, merged_ids=list(state.merged_ids) + [path.name for path in merged_ids_files])
+    return diff
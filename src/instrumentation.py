@@ -0,0 +1,240 @@
+"""
+Per-file and per-stage instrumentation of the flatteners.
+Every flattened file appends one JSON line to a stats file, by default PARQ_DIR/temp/stats_{log name}.jsonl
+{"file": <input file>, "entity": "works", "pid": <worker>, "start": <unix time>, "wall_s": ..., "cpu_s": ...,
+ "stages": {<stage>: {"wall_s": ..., "cpu_s": ..., "calls": ...}},
+ "rows_in": <records parsed>, "rows_out": {<kind>: <rows>}, "bytes_read": <gzipped>, "bytes_decompressed": ...,
+ "bytes_written": <Parquets>, "peak_rss_bytes": ..., "counts": {<event>: <count>}, "error": <only if the file failed>}
+Stages nest, and the time of a stage leaves out the stages run inside it, so the stages of the main thread add up to
+about the wall time of the file. decompress runs on the reader thread alongside the others, read_wait is the time
+the parser spent waiting on it. counts tallies the data problems handled along the way, eg malformed_dates, the dates
+that did not parse and were written as nulls.
+Summarize a stats file with python -m src.instrumentation <stats file>.
+"""
+import argparse
+import cProfile
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+sys.path.extend(['../', './'])
+from src.checkpoint import append_json_lines
+
+STAGES = ['decompress', 'read_wait', 'json_parse', 'parse_rows', 'table_build', 'id_conversion', 'abstracts', 'dates',
+          'parquet_write', 'checkpoint']
+
+_NULL_STAGE = nullcontext()
+_current_stats: Optional['FileStats'] = None  # stats of the file being flattened in this process
+
+
+class _Stage:
+    __slots__ = ('stats', 'name', 'start_wall', 'start_cpu')
+
+    def __init__(self, stats: 'FileStats', name: str):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.child_times.append([0.0, 0.0])
+        self.start_wall, self.start_cpu = time.perf_counter(), time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time, cpu_time = time.perf_counter() - self.start_wall, time.thread_time() - self.start_cpu
+        child_wall_time, child_cpu_time = self.stats.child_times.pop()
+        self.stats.add(self.name, wall_s=wall_time - child_wall_time, cpu_s=cpu_time - child_cpu_time)
+        if len(self.stats.child_times) > 0:
+            self.stats.child_times[-1][0] += wall_time
+            self.stats.child_times[-1][1] += cpu_time
+        return False
+
+
+class FileStats:
+    """
+    Stage times, row counts and bytes of the file being flattened, disabled ones only hand out no-op stages
+    """
+    def __init__(self, jsonl_file_name: Union[str, Path], entity: str, enabled: bool = True):
+        self.jsonl_file_name = str(jsonl_file_name)
+        self.entity = entity
+        self.enabled = enabled
+        self.stages = {}
+        self.counts = {}  # {event: count}
+        self.child_times = []  # [wall, cpu] of the stages run inside each open stage
+        self.rows_in = 0
+        self.outputs = {}  # {kind: (parquet path or None, number of rows)}, as recorded in the completion log
+        self.bytes_decompressed = 0
+        self.start_time = time.time()
+        self.start_wall, self.start_cpu = time.perf_counter(), time.process_time()
+
+    def stage(self, name: str):
+        """
+        Context manager timing a stage, eg
+            with stats.stage('json_parse'):
+                work = orjson.loads(line)
+        """
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def add(self, name: str, wall_s: float, cpu_s: float, calls: int = 1):
+        stage = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0})
+        stage['wall_s'] += wall_s
+        stage['cpu_s'] += cpu_s
+        stage['calls'] += calls
+        return
+
+    def count(self, name: str, num: int = 1):
+        if self.enabled and num > 0:
+            self.counts[name] = self.counts.get(name, 0) + num
+        return
+
+    def add_decompression(self, read_stats: dict):
+        """
+        Add the stats of the reader thread filled in by iter_jsonl_line_blocks
+        """
+        if len(read_stats) > 0:
+            self.add('decompress', wall_s=read_stats['wall_s'], cpu_s=read_stats['cpu_s'])
+            self.bytes_decompressed += read_stats['bytes']
+        return
+
+    def to_record(self, error: Optional[BaseException] = None) -> dict:
+        record = {
+            'file': self.jsonl_file_name,
+            'entity': self.entity,
+            'pid': os.getpid(),
+            'start': self.start_time,
+            'wall_s': time.perf_counter() - self.start_wall,
+            'cpu_s': time.process_time() - self.start_cpu,  # all the threads of the process
+            'stages': {name: self.stages[name] for name in sorted(self.stages, key=_stage_order)},
+            'rows_in': self.rows_in,
+            'rows_out': {kind: num_rows for kind, (_, num_rows) in self.outputs.items()},
+            'bytes_read': os.path.getsize(self.jsonl_file_name) if os.path.exists(self.jsonl_file_name) else None,
+            'bytes_decompressed': self.bytes_decompressed,
+            'bytes_written': sum(Path(parq_filename).stat().st_size for parq_filename, _ in self.outputs.values()
+                                 if parq_filename is not None and Path(parq_filename).exists()),
+            'peak_rss_bytes': get_peak_rss(),
+            'counts': dict(self.counts),
+        }
+        if error is not None:
+            record['error'] = repr(error)
+        return record
+
+
+def _stage_order(name: str):
+    return STAGES.index(name) if name in STAGES else len(STAGES)
+
+
+def get_peak_rss() -> int:
+    """
+    Peak resident set size of this process in bytes, since the last reset_peak_rss where the kernel allows it
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process on Linux, so a pool worker reports the peak of each file and not of all the
+    files it ran so far. Elsewhere the peak stays the one of the whole process.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as writer:
+            writer.write('5')
+    except OSError:
+        pass
+    return
+
+
+def stage(name: str):
+    """
+    Time a stage of the file being flattened in this process, for code that does not hold its FileStats
+    """
+    return _current_stats.stage(name) if _current_stats is not None else _NULL_STAGE
+
+
+def count(name: str, num: int = 1):
+    """
+    Add num to the count of an event of the file being flattened in this process, if any
+    """
+    if _current_stats is not None:
+        _current_stats.count(name, num)
+    return
+
+
+@contextmanager
+def instrument_file(jsonl_file_name: Union[str, Path], entity: str, stats_path: Optional[Path] = None,
+                    profile_dir: Optional[Path] = None):
+    """
+    Collect the FileStats of flattening one file and append them to stats_path, also when the file fails
+    stats_path: None disables the instrumentation
+    profile_dir: if set, also profile the file with cProfile into profile_dir/<partition>_<part>.prof,
+        read it with pstats or snakeviz
+    """
+    global _current_stats
+    stats = FileStats(jsonl_file_name, entity=entity, enabled=stats_path is not None)
+    if stats.enabled:
+        reset_peak_rss()
+    profiler = cProfile.Profile() if profile_dir is not None else None
+
+    _current_stats = stats
+    error = None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stats
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_dir = Path(profile_dir)
+            profile_dir.mkdir(parents=True, exist_ok=True)
+            jsonl_file_name = Path(jsonl_file_name)
+            profiler.dump_stats(profile_dir / ('_'.join(jsonl_file_name.parts[-2:])
+                                               .replace('updated_date=', '').replace('.gz', '') + '.prof'))
+        _current_stats = None
+        if stats_path is not None:
+            append_json_lines(stats_path, stats.to_record(error=error))
+    return
+
+
+def summarize_stats(stats_path: Union[str, Path]) -> pd.DataFrame:
+    """
+    Totals per stage over all the files in a stats file, with their share of the summed wall time of the files,
+    plus the overall throughput
+    """
+    records = pd.read_json(stats_path, lines=True)
+    stages = pd.DataFrame([
+        {'stage': name, **stage} for stages in records.stages for name, stage in stages.items()
+    ])
+    summary = (
+        stages
+        .groupby('stage')
+        [['wall_s', 'cpu_s', 'calls']]
+        .sum()
+        .assign(wall_share=lambda df_: df_.wall_s / records.wall_s.sum())
+        .sort_values('wall_s', ascending=False)
+    )
+
+    wall_time = records.wall_s.sum()
+    counts = pd.DataFrame(list(records.counts.dropna())) if 'counts' in records.columns else pd.DataFrame()
+    print(f'{len(records):,} files, {records.rows_in.sum():,} records, {wall_time:,.1f}s summed over the workers, '
+          f'{records.rows_in.sum() / wall_time:,.0f} records/s, '
+          f'{records.bytes_decompressed.sum() / 2 ** 20 / wall_time:,.1f} MB/s decompressed per worker, '
+          f'peak RSS {records.peak_rss_bytes.max() / 2 ** 30:,.2f} GB'
+          + (f', {records.error.notna().sum():,} failed files' if 'error' in records.columns else '')
+          + ''.join(f', {int(total):,} {name}' for name, total in counts.sum().items() if total > 0))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stats of a flattening run')
+    parser.add_argument('stats_path', type=Path)
+    cli_args = parser.parse_args()
+
+    with pd.option_context('display.float_format', '{:,.2f}'.format):
+        print(summarize_stats(cli_args.stats_path))
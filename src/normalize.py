@@ -0,0 +1,334 @@
+"""
+Normalized copy of the flattened works, with smaller Parquets and DataFrames.
+The names repeated on every row of authorships, locations and concepts move to one dimension table per entity, keyed
+by its ID, and the fact tables keep the integer keys. The string columns left in them are dictionary encoded and read
+back as categoricals.
+    PARQ_DIR/normalized/works_authorships/2023-02-01_part_000.parquet
+        work_id, author_position, author_id, institution_id, raw_affiliation_string, publication_year
+    PARQ_DIR/normalized/dimensions/authors/part-000.parquet
+        author_id, author_name
+The dimension tables are split into buckets by ID, so they are built and looked up a bucket at a time. An ID with
+different names in different partitions gets the one of the latest partition. With --deduped the Parquets are the
+hash buckets of work_id of src.dedup rather than updated_date partitions, so such an ID gets the name of the highest
+bucket it appears in, which is arbitrary rather than the newest. The works tombstoned by python -m src.cli update are
+left out.
+Each run replaces the fact tables of its kinds and rebuilds their dimensions from the distinct rows of every kind
+normalized so far, kept in PARQ_DIR/normalized/.dimension-parts, so the kinds can be normalized in separate runs.
+Add the names back with with_names, eg with_names(authorships, 'authors'), which only reads the rows of the IDs
+in the table.
+Run with python -m src.normalize [kinds ...] [--threads N] [--parq-dir ...] from the root of the repo, with the path
+options of python -m src.cli.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.extend(['../', './'])
+import src.flatten_openalex as flatten_openalex
+from src.cli import configure_paths, get_paths_parser
+from src.compact import get_kind_dir, ROW_GROUP_SIZE
+from src.incremental import drop_tombstoned, read_tombstones
+from src.utils import parallel_largest_first
+
+DIMENSIONS = {  # columns of each dimension table, its key first
+    'authors': ['author_id', 'author_name'],
+    'institutions': ['institution_id', 'institution_name'],
+    'sources': ['source_id', 'source_name', 'source_type'],
+    'concepts': ['concept_id', 'concept_name', 'level'],
+}
+NORMALIZED_KINDS = {  # the works kinds that are normalized, with the dimensions they refer to
+    'authorships': ['authors', 'institutions'],
+    'primary_location': ['sources'],
+    'locations': ['sources'],
+    'concepts': ['concepts'],
+}
+NUM_BUCKETS = 16
+
+
+def get_normalized_dir() -> Path:
+    return flatten_openalex.PARQ_DIR / 'normalized'
+
+
+def get_parts_dir() -> Path:
+    """
+    Directory of the distinct dimension rows of every partition of the normalized kinds,
+    {dimension}/{kind}/{partition}.parquet
+    """
+    return get_normalized_dir() / '.dimension-parts'
+
+
+def get_dimension_schema(dimension: str) -> pa.Schema:
+    """
+    Schema of a dimension table, with the dtypes of the kinds it comes from. Its names are distinct per ID,
+    so they are plain strings.
+    """
+    kind = next(kind for kind, dimensions in NORMALIZED_KINDS.items() if dimension in dimensions)
+    key, *columns = DIMENSIONS[dimension]
+    dtypes = {key: 'int64'}
+    for col in columns:
+        dtype = flatten_openalex.DTYPES[kind].get(col, flatten_openalex.STRING_DTYPE)
+        dtypes[col] = flatten_openalex.STRING_DTYPE if col.endswith('_name') else dtype
+    return flatten_openalex.make_arrow_schema(dtypes)
+
+
+def get_fact_schema(kind: str) -> pa.Schema:
+    """
+    Schema of a normalized works kind: the columns of its dimensions other than their keys are dropped,
+    and the remaining strings become dictionaries
+    """
+    moved_columns = {col for dimension in NORMALIZED_KINDS[kind] for col in DIMENSIONS[dimension][1:]}
+    dtypes = {}
+    for col in flatten_openalex.csv_files['works'][kind]['columns']:
+        if col in moved_columns:
+            continue
+        dtype = flatten_openalex.DTYPES[kind].get(col, flatten_openalex.STRING_DTYPE)
+        dtypes[col] = 'category' if dtype == flatten_openalex.STRING_DTYPE else dtype
+    return flatten_openalex.make_arrow_schema(dtypes)
+
+
+def unique_rows(table: pa.Table) -> pa.Table:
+    return table.group_by(table.column_names, use_threads=False).aggregate([])
+
+
+def normalize_partition(kind: str, parq_filename: str, out_filename: str, parts_dir: str, num_buckets: int,
+                        compression: str, tombstones: np.ndarray) -> int:
+    """
+    Write the fact table of one Parquet of a kind to out_filename, a batch at a time, along with the distinct rows
+    of its dimensions into parts_dir/{dimension}/{kind}/{partition}.parquet, sorted by bucket with a row group each.
+    The rows of the tombstoned works are left out.
+    """
+    schema = get_fact_schema(kind)
+    dimension_rows = {dimension: [] for dimension in NORMALIZED_KINDS[kind]}
+    out_filename = Path(out_filename)
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = out_filename.with_name(out_filename.name + '.tmp')
+
+    num_rows = 0
+    with pq.ParquetWriter(temp_filename, schema=schema, compression=compression) as writer:
+        for batch in drop_tombstoned(pq.ParquetFile(parq_filename).iter_batches(), tombstones):
+            table = pa.Table.from_batches([batch])
+            writer.write_table(table.select(schema.names).cast(schema))
+            num_rows += table.num_rows
+
+            for dimension, rows in dimension_rows.items():
+                dimension_schema = get_dimension_schema(dimension)
+                key = dimension_schema.names[0]
+                rows.append(unique_rows(
+                    table.select(dimension_schema.names).filter(pc.is_valid(table.column(key))).cast(dimension_schema)
+                ))
+    os.replace(temp_filename, out_filename)
+
+    for dimension, rows in dimension_rows.items():
+        table = unique_rows(pa.concat_tables(rows)) if len(rows) > 0 else get_dimension_schema(dimension).empty_table()
+        buckets = table.column(0).to_numpy() % num_buckets
+        order = np.argsort(buckets, kind='stable')
+        buckets = buckets[order]
+        table = table.take(order).append_column('bucket', pa.array(buckets, type=pa.int16()))
+
+        part_filename = Path(parts_dir) / dimension / kind / f'{Path(parq_filename).stem}.parquet'
+        part_filename.parent.mkdir(parents=True, exist_ok=True)
+        with pq.ParquetWriter(part_filename, schema=table.schema) as writer:
+            _, starts, counts = np.unique(buckets, return_index=True, return_counts=True)
+            for start, count in zip(starts, counts):
+                writer.write_table(table.slice(start, count))
+    return num_rows
+
+
+def merge_dimension_bucket(dimension: str, bucket: int, part_filenames: list, out_filename: str,
+                           row_group_size: int, compression: str) -> int:
+    """
+    Merge one bucket of the parts of a dimension into a table with a row per ID sorted by ID,
+    the parts are in partition order and the row of the latest one wins
+    """
+    schema = get_dimension_schema(dimension)
+    key = schema.names[0]
+    tables = [pq.read_table(part_filename, filters=[('bucket', '=', bucket)], columns=schema.names)
+              for part_filename in part_filenames]
+    table = pa.concat_tables(tables).cast(schema) if len(tables) > 0 else schema.empty_table()
+
+    last_rows = (
+        table
+        .append_column('row_number', pa.array(np.arange(table.num_rows), type=pa.int64()))
+        .group_by(key, use_threads=False)
+        .aggregate([('row_number', 'max')])
+    )
+    table = table.take(last_rows.column('row_number_max'))
+    table = table.take(pc.sort_indices(table, sort_keys=[(key, 'ascending')]))
+
+    out_filename = Path(out_filename)
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, out_filename, row_group_size=row_group_size, compression=compression, write_statistics=True)
+    return table.num_rows
+
+
+def check_dimension_parts(kinds: list, num_buckets: int):
+    """
+    Make sure that the distinct dimension rows of the normalized kinds left out of a run of kinds are there and in
+    num_buckets buckets, the dimensions the kinds share with them are rebuilt from them
+    """
+    out_dir, parts_dir = get_normalized_dir(), get_parts_dir()
+    dimensions = {dimension for kind in kinds for dimension in NORMALIZED_KINDS[kind]}
+    other_kinds = [kind for kind in NORMALIZED_KINDS if kind not in kinds and (out_dir / f'works_{kind}').exists()
+                   and len(dimensions & set(NORMALIZED_KINDS[kind])) > 0]
+    if len(other_kinds) == 0:
+        return
+
+    missing_kinds = [kind for kind in other_kinds
+                     if not all((parts_dir / dimension / kind).exists() for dimension in NORMALIZED_KINDS[kind])]
+    assert len(missing_kinds) == 0, \
+        f'No dimension rows of {missing_kinds}, normalize them again along with {kinds} to rebuild the dimensions'
+    saved_buckets = get_dimension_buckets()
+    for dimension in dimensions & {dimension for kind in other_kinds for dimension in NORMALIZED_KINDS[kind]}:
+        assert saved_buckets.get(dimension) == num_buckets, \
+            f'The {dimension!r} rows of {other_kinds} are in {saved_buckets.get(dimension)} buckets, run with ' \
+            f'num_buckets={saved_buckets.get(dimension)} or normalize them again along with {kinds}'
+    return
+
+
+def get_dimension_buckets() -> dict:
+    """
+    {dimension: number of buckets} of the distinct dimension rows in get_parts_dir()
+    """
+    meta_path = get_parts_dir() / 'meta.json'
+    if not meta_path.exists():
+        return {}
+    with open(meta_path) as reader:
+        return json.load(reader)
+
+
+def replace_dir(temp_path: Path, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(temp_path, path)
+    return
+
+
+def normalize_works(kinds: Optional[list] = None, threads: int = 1, num_buckets: int = NUM_BUCKETS,
+                    row_group_size: int = ROW_GROUP_SIZE, compression: str = 'snappy', deduped: bool = False):
+    """
+    Normalize the works kinds into PARQ_DIR/normalized
+    1. write the fact table of every Parquet of each kind, along with the distinct rows of its dimensions,
+       on threads processes, largest first
+    2. merge every bucket of each dimension of the kinds into a table with one row per ID, from the distinct rows of
+       all the kinds normalized so far
+    Each kind and dimension replaces its old directory only once it is complete, the other kinds and dimensions are
+    left as they are.
+    deduped: read the deduplicated kinds of src.dedup instead of the flattened ones. Their files are buckets of
+    work_id, so an ID with different names gets an arbitrary one of them rather than the one of the newest partition.
+    """
+    kinds = sorted(kinds or NORMALIZED_KINDS, key=list(NORMALIZED_KINDS).index)
+    check_dimension_parts(kinds, num_buckets=num_buckets)
+    out_dir, parts_dir = get_normalized_dir(), get_parts_dir()
+    temp_dir = out_dir.with_name(out_dir.name + '.tmp')
+    temp_parts_dir = temp_dir / '.dimension-parts'
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    temp_parts_dir.mkdir(parents=True)
+
+    def run(func, args: list, sizes: list, names: list):
+        if threads > 1:
+            return parallel_largest_first(func=func, args=args, sizes=sizes, num_workers=threads, names=names,
+                                          unit='bytes')
+        return [func(*arg) for arg in args]
+
+    tombstones = read_tombstones('works')
+    for kind in kinds:
+        parq_files = sorted(get_kind_dir(kind, deduped=deduped).glob('*.parquet'))
+        kind_dir = temp_dir / f'works_{kind}'
+        num_rows = run(normalize_partition,
+                       args=[(kind, str(path), str(kind_dir / path.name), str(temp_parts_dir), num_buckets,
+                              compression, tombstones) for path in parq_files],
+                       sizes=[path.stat().st_size for path in parq_files], names=[path.name for path in parq_files])
+        kind_dir.mkdir(parents=True, exist_ok=True)
+        replace_dir(kind_dir, out_dir / f'works_{kind}')
+        for dimension in NORMALIZED_KINDS[kind]:
+            (temp_parts_dir / dimension / kind).mkdir(parents=True, exist_ok=True)
+            replace_dir(temp_parts_dir / dimension / kind, parts_dir / dimension / kind)
+        print(f'Normalized {kind!r}: {sum(num_rows):,} rows in {len(parq_files):,} files')
+
+    dimensions = [dimension for dimension in DIMENSIONS if any(dimension in NORMALIZED_KINDS[kind] for kind in kinds)]
+    dimension_buckets = {**get_dimension_buckets(), **{dimension: num_buckets for dimension in dimensions}}
+    with open(parts_dir / 'meta.json', 'w') as writer:
+        json.dump(dimension_buckets, writer)
+    for dimension in dimensions:
+        # in partition order, then kind order like the rows of a partition, the row of the latest one wins (of the
+        # highest bucket of work_id with deduped)
+        part_filenames = [str(path) for path in sorted((parts_dir / dimension).glob('*/*.parquet'),
+                                                       key=lambda path: (path.stem, path.parent.name))]
+        buckets = list(range(num_buckets))
+        num_rows = run(merge_dimension_bucket,  # the buckets are about the same size
+                       args=[(dimension, bucket, part_filenames,
+                              str(temp_dir / 'dimensions' / dimension / f'part-{bucket:03d}.parquet'),
+                              row_group_size, compression) for bucket in buckets],
+                       sizes=[1] * num_buckets, names=[f'{dimension} bucket {bucket}' for bucket in buckets])
+        replace_dir(temp_dir / 'dimensions' / dimension, out_dir / 'dimensions' / dimension)
+        print(f'Built the {dimension!r} dimension: {sum(num_rows):,} rows')
+
+    shutil.rmtree(temp_dir)
+    return
+
+
+def read_dimension(dimension: str, ids=None, columns: Optional[list] = None) -> pd.DataFrame:
+    """
+    Rows of a dimension table, only the ones of ids if given, read from the buckets of those IDs
+    columns: the columns besides the key, all of them by default
+    """
+    schema = get_dimension_schema(dimension)
+    key = schema.names[0]
+    columns = [key] + [col for col in (columns or schema.names[1:]) if col != key]
+    filenames = sorted((get_normalized_dir() / 'dimensions' / dimension).glob('part-*.parquet'))
+    assert len(filenames) > 0, f'No {dimension!r} dimension in {str(get_normalized_dir())!r}, run normalize_works'
+
+    filter = None
+    if ids is not None:
+        ids = np.unique(pd.Series(ids).dropna().to_numpy(dtype=np.int64))
+        filenames = [filenames[bucket] for bucket in np.unique(ids % len(filenames))]
+        filter = pc.field(key).isin(pa.array(ids))
+    if len(filenames) == 0:
+        return schema.empty_table().select(columns).to_pandas()
+    return ds.dataset(filenames, format='parquet').to_table(columns=columns, filter=filter).to_pandas()
+
+
+def with_names(df: pd.DataFrame, dimension: str, columns: Optional[list] = None, on: Optional[str] = None) \
+        -> pd.DataFrame:
+    """
+    df with the columns of a dimension joined on its key, eg with_names(authorships, 'authors') adds author_name
+    Only the dimension rows of the IDs in df are read.
+    on: the column of df holding the IDs, the key of the dimension by default
+    """
+    key = DIMENSIONS[dimension][0]
+    on = on or key
+    names = read_dimension(dimension, ids=df[on], columns=columns)
+    if on != key:
+        names = names.rename(columns={key: on})
+    return df.merge(names.astype({on: df[on].dtype}), on=on, how='left')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Normalize the works Parquets into fact and dimension tables',
+                                     parents=[get_paths_parser()])
+    parser.add_argument('kinds', nargs='*',
+                        help=f'works kinds to normalize, all of {list(NORMALIZED_KINDS)} by default')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--buckets', type=int, default=NUM_BUCKETS, help='number of buckets of each dimension')
+    parser.add_argument('--compression', default='snappy')
+    parser.add_argument('--deduped', action='store_true',
+                        help='normalize the output of src.dedup, an ID with different names then gets an arbitrary '
+                             'one of them instead of the one of the latest partition')
+    cli_args = parser.parse_args()
+    configure_paths(cli_args)
+
+    normalize_works(kinds=cli_args.kinds or None, threads=cli_args.threads, num_buckets=cli_args.buckets,
+                    compression=cli_args.compression, deduped=cli_args.deduped)
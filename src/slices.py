@@ -0,0 +1,229 @@
+"""
+Discipline slices of the flattened works, the inputs of the notebooks.
+A slice has the works tagged with a root concept or any of its descendants, along with their authorships, concepts
+and referenced works, written to data/{FIELD} like the slices on Zenodo
+    data/Physics/works.parquet, works_authorships.parquet, works_concepts.parquet, works_referenced_works.parquet
+The works Parquets are only ever read a batch at a time, one partition per task, so the full tables never have to fit
+in memory. The works tombstoned by python -m src.cli update are left out.
+Run with python -m src.slices Physics [--threads N] [--parq-dir ...] from the root of the repo, with the path options
+of python -m src.cli.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+sys.path.extend(['../', './'])
+import src.flatten_openalex as flatten_openalex
+from src.cli import configure_paths, get_paths_parser
+from src.compact import get_kind_dir, with_publication_year
+from src.incremental import read_tombstones
+from src.utils import convert_openalex_ids_to_int, parallel_largest_first, IdFilter
+
+# root concepts of the disciplines, all of level 0
+DISCIPLINES = {
+    'Physics': ['Physics'],
+    'CS': ['Computer science'],
+    'BioMed': ['Biology', 'Medicine'],
+}
+SLICE_KINDS = ['works', 'authorships', 'concepts', 'referenced_works']  # works first, the others need its years
+
+
+def get_descendant_concepts(root_names: list) -> np.ndarray:
+    """
+    Sorted IDs of the root concepts named root_names and of all their descendants, from the flattened concepts and
+    concepts_ancestors tables, the Parquets of flatten_concepts_parquet if there are any or else the CSVs
+    """
+    concepts_dir = flatten_openalex.PARQ_DIR / 'concepts'
+    if any(concepts_dir.glob('*.parquet')):
+        concepts = pd.read_parquet(concepts_dir, columns=['concept_id', 'concept_name', 'level'])
+        ancestors = pq.read_table(flatten_openalex.PARQ_DIR / 'concepts_ancestors').drop_null()
+        concept_ids = ancestors.column('concept_id').to_numpy()
+        ancestor_ids = ancestors.column('ancestor_id').to_numpy()
+    else:
+        concepts_csv = flatten_openalex.csv_files['concepts']
+        concepts = pd.read_csv(concepts_csv['concepts']['name'], usecols=['concept_id', 'concept_name', 'level'])
+        # flatten_concepts writes the ancestors as OpenAlex URLs
+        ancestors = pd.read_csv(concepts_csv['ancestors']['name'], dtype={'concept_id': 'int64', 'ancestor_id': str})
+        ancestor_ids, null_mask = convert_openalex_ids_to_int(ancestors.ancestor_id)
+        concept_ids, ancestor_ids = ancestors.concept_id.to_numpy()[~null_mask], ancestor_ids[~null_mask]
+
+    roots = concepts[concepts.concept_name.isin(root_names) & (concepts.level == 0)]
+    missing_roots = set(root_names) - set(roots.concept_name)
+    assert len(missing_roots) == 0, f'No level 0 concepts named {sorted(missing_roots)}'
+
+    # OpenAlex lists every ancestor of a concept, but follow the edges until nothing changes to not rely on it
+    selected = np.unique(roots.concept_id.to_numpy(dtype=np.int64))
+    while True:
+        grown = np.union1d(selected, concept_ids[np.isin(ancestor_ids, selected)])
+        if len(grown) == len(selected):
+            return selected
+        selected = grown
+
+
+def select_work_ids(parq_filename: str, concept_ids: np.ndarray, min_score: float) -> np.ndarray:
+    """
+    Unique IDs of the works of one works_concepts Parquet tagged with one of concept_ids
+    """
+    concept_ids = pa.array(concept_ids, type=pa.int64())
+    work_ids = []
+    for batch in pq.ParquetFile(parq_filename).iter_batches(columns=['work_id', 'concept_id', 'score']):
+        mask = pc.is_in(batch.column('concept_id'), value_set=concept_ids)
+        if min_score > 0:
+            mask = pc.and_(mask, pc.greater_equal(batch.column('score'), min_score))
+        work_ids.append(pc.filter(batch.column('work_id'), mask).to_numpy())
+    return np.unique(np.concatenate(work_ids)) if len(work_ids) > 0 else np.array([], dtype=np.int64)
+
+
+def filter_partition(parq_filename: str, part_filename: str, work_ids: IdFilter) -> int:
+    """
+    Semi-join one Parquet with the work IDs of the slice, a batch at a time, into part_filename
+    Returns the number of rows kept, no file is written when there are none.
+    """
+    writer, num_rows = None, 0
+    try:
+        for batch in pq.ParquetFile(parq_filename).iter_batches():
+            mask = work_ids.contains(batch.column('work_id').to_numpy(zero_copy_only=False))
+            if not mask.any():
+                continue
+            batch = batch.filter(pa.array(mask))
+            if writer is None:
+                writer = pq.ParquetWriter(part_filename, schema=batch.schema)
+            writer.write_batch(batch)
+            num_rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+
+def get_slice_schema(kind: str) -> pa.Schema:
+    """
+    Schema of a slice file: the works are indexed by work_id when read back with pandas,
+    and the referenced works get the publication year of the citing work
+    """
+    schema = flatten_openalex.get_arrow_schema(kind)
+    pandas_metadata = schema.pandas_metadata
+    if kind == 'works':
+        pandas_metadata['index_columns'] = ['work_id']
+    elif kind == 'referenced_works':
+        schema = schema.append(pa.field('work_publication_year', pa.int16()))
+        pandas_metadata['columns'].append({'name': 'work_publication_year', 'field_name': 'work_publication_year',
+                                           'pandas_type': 'int16', 'numpy_type': 'Int16', 'metadata': None})
+    return schema.with_metadata({**schema.metadata, b'pandas': json.dumps(pandas_metadata).encode('utf-8')})
+
+
+def get_work_years(works_filename: Path) -> tuple:
+    """
+    Sorted work IDs of a slice with their publication years, nulls are -1
+    """
+    works = pq.read_table(works_filename, columns=['work_id', 'publication_year'])
+    work_ids = works.column('work_id').to_numpy()
+    years = works.column('publication_year').fill_null(-1).to_numpy()
+    order = np.argsort(work_ids, kind='stable')
+    return work_ids[order], years[order]
+
+
+def merge_parts(kind: str, part_filenames: list, out_filename: Path, work_years: Optional[tuple] = None,
+                compression: str = 'snappy') -> int:
+    """
+    Stream the filtered parts of a kind into one Parquet, a batch at a time, casting them to the slice schema
+    """
+    schema = get_slice_schema(kind)
+    temp_filename = out_filename.with_name(out_filename.name + '.tmp')
+    num_rows = 0
+    with pq.ParquetWriter(temp_filename, schema=schema, compression=compression, coerce_timestamps='ms',
+                          allow_truncated_timestamps=True) as writer:
+        for part_filename in part_filenames:
+            batches = pq.ParquetFile(part_filename).iter_batches()
+            if kind == 'referenced_works':
+                batches = with_publication_year(batches, *work_years, name='work_publication_year')
+            for batch in batches:
+                writer.write_table(pa.Table.from_batches([batch]).select(schema.names).cast(schema))
+                num_rows += batch.num_rows
+    os.replace(temp_filename, out_filename)
+    return num_rows
+
+
+def build_slice(field: str, out_dir: Optional[Path] = None, root_names: Optional[list] = None, threads: int = 1,
+                min_score: float = 0, kinds: Optional[list] = None, compression: str = 'snappy', deduped: bool = False):
+    """
+    Build the slice of a discipline from the flattened works Parquets at PARQ_DIR
+    1. find the root concepts of field and all their descendants in concepts_ancestors
+    2. collect the IDs of the works tagged with any of them (with at least min_score) from works_concepts, but the
+       tombstoned ones of merged works
+    3. semi-join every Parquet of each kind with those IDs on threads processes, largest partitions first
+    4. merge the filtered parts of each kind into out_dir/works_{kind}.parquet
+    root_names defaults to the roots in DISCIPLINES, out_dir to data/{field}. deduped reads the deduplicated kinds of
+    src.dedup instead of the flattened ones.
+    """
+    root_names = root_names or DISCIPLINES[field]
+    out_dir = Path(out_dir) if out_dir is not None else Path('data') / field
+    kinds = sorted(kinds or SLICE_KINDS, key=SLICE_KINDS.index)
+    temp_dir = out_dir / '.slice-parts'
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    temp_dir.mkdir(parents=True)
+
+    def run(func, args: list, files: list):
+        if threads > 1:
+            return parallel_largest_first(func=func, args=args, sizes=[path.stat().st_size for path in files],
+                                          num_workers=threads, names=[path.name for path in files], unit='bytes')
+        return [func(*arg) for arg in args]
+
+    concept_ids = get_descendant_concepts(root_names)
+    print(f'{field!r}: {len(concept_ids):,} concepts under {root_names}')
+
+    concept_files = sorted(get_kind_dir('concepts', deduped=deduped).glob('*.parquet'))
+    work_ids = run(select_work_ids, args=[(str(path), concept_ids, min_score) for path in concept_files],
+                   files=concept_files)
+    work_ids = np.concatenate(work_ids) if len(work_ids) > 0 else np.array([], dtype=np.int64)
+    work_ids = IdFilter.from_ids(np.setdiff1d(work_ids, read_tombstones('works')))
+    work_ids.save(temp_dir / 'work_ids.npy')
+    work_ids = IdFilter.load(temp_dir / 'work_ids.npy')  # pickled as its path, the workers map the same file
+    print(f'{field!r}: {len(work_ids):,} works')
+
+    work_years = None
+    for kind in kinds:
+        kind_ = 'works' if kind == 'works' else f'works_{kind}'
+        parq_files = sorted(get_kind_dir(kind, deduped=deduped).glob('*.parquet'))
+        part_filenames = [temp_dir / kind_ / path.name for path in parq_files]
+        (temp_dir / kind_).mkdir()
+        num_rows = run(filter_partition, args=[(str(path), str(part), work_ids)
+                                               for path, part in zip(parq_files, part_filenames)], files=parq_files)
+        part_filenames = [part for part, rows in zip(part_filenames, num_rows) if rows > 0]
+
+        if kind == 'referenced_works' and work_years is None:
+            work_years = get_work_years(out_dir / 'works.parquet')
+        out_filename = out_dir / f'{kind_}.parquet'
+        num_rows = merge_parts(kind, part_filenames, out_filename=out_filename, work_years=work_years,
+                               compression=compression)
+        print(f'Wrote {num_rows:,} rows to {str(out_filename)!r}')
+
+    shutil.rmtree(temp_dir)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a discipline slice from the flattened works',
+                                     parents=[get_paths_parser()])
+    parser.add_argument('field', help=f'one of {list(DISCIPLINES)}, or any name along with --roots')
+    parser.add_argument('--roots', nargs='+', help='names of the root concepts, the ones of field by default')
+    parser.add_argument('--out-dir', type=Path, help='data/{field} by default')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--min-score', type=float, default=0, help='minimum score of the concept tags')
+    parser.add_argument('--deduped', action='store_true', help='slice the output of src.dedup')
+    cli_args = parser.parse_args()
+    configure_paths(cli_args)
+
+    build_slice(cli_args.field, out_dir=cli_args.out_dir, root_names=cli_args.roots, threads=cli_args.threads,
+                min_score=cli_args.min_score, deduped=cli_args.deduped)
@@ -0,0 +1,320 @@
+"""
+Synthetic OpenAlex snapshots, to benchmark the flatteners without downloading the real one.
+Works, authors, concepts, venues and institutions are written in the layout of the snapshot, with a manifest per
+entity and merged_ids files of the works and authors
+    {snapshot_dir}/data/works/updated_date=2023-02-01/part_000.gz
+    {snapshot_dir}/data/works/manifest
+    {snapshot_dir}/data/merged_ids/works/2023-02-01.csv.gz
+The counts that drive the cost of flattening are long-tailed like in OpenAlex: a few works have hundreds of authors
+or references and most have a handful, abstract lengths are log-normal and words follow Zipf's law, and prolific
+authors show up on many more works than the rest.
+Run with python -m src.synthetic <snapshot dir> [--works N] [--authors N] [--partitions N] from the root of the repo.
+"""
+import argparse
+import gzip
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import orjson
+from box import Box
+
+sys.path.extend(['../', './'])
+from src.utils import OPENALEX_URL
+
+VOCABULARY_SIZE = 20_000
+NUM_CONCEPTS = 2_000
+NUM_INSTITUTIONS = 5_000
+NUM_SOURCES = 3_000
+MAX_WORK_ID = 4_400_000_000  # keeps the IDs as long as the real ones
+
+
+def openalex_id(prefix: str, id_: int) -> str:
+    return f'{OPENALEX_URL}{prefix}{id_}'
+
+
+def long_tail(rng: np.random.Generator, mean_log: float, sigma: float, maximum: int,
+              zero_fraction: float = 0.0) -> int:
+    """
+    Draw a log-normal count capped at maximum, which is zero zero_fraction of the time
+    """
+    if zero_fraction > 0 and rng.random() < zero_fraction:
+        return 0
+    return int(min(round(rng.lognormal(mean_log, sigma)), maximum))
+
+
+def zipf_ids(rng: np.random.Generator, num_ids: int, size: int, exponent: float = 1.3) -> np.ndarray:
+    """
+    Draw size IDs in [1, num_ids] where a few low IDs are much more common than the rest
+    """
+    return (rng.zipf(exponent, size=size) - 1) % num_ids + 1
+
+
+def make_inverted_index(rng: np.random.Generator, num_words: int) -> dict:
+    inv_abstract = {}
+    for position, word in enumerate(zipf_ids(rng, VOCABULARY_SIZE, num_words, exponent=1.1)):
+        inv_abstract.setdefault(f'word{word}', []).append(position)
+    return inv_abstract
+
+
+def make_work(rng: np.random.Generator, work_id: int, num_authors: int, updated_date: str) -> dict:
+    """
+    A work JSON with the fields read by flatten_openalex.parse_work
+    """
+    publication_year = int(2023 - min(rng.exponential(12), 120))
+    num_authorships = long_tail(rng, mean_log=1.0, sigma=0.8, maximum=2_000, zero_fraction=0.05)
+    authorships = []
+    for position, author_id in enumerate(zipf_ids(rng, num_authors, num_authorships)):
+        institutions = [{'id': openalex_id('I', int(institution_id)), 'display_name': f'Institution {institution_id}'}
+                        for institution_id in zipf_ids(rng, NUM_INSTITUTIONS, rng.choice(4, p=[.3, .55, .1, .05]))]
+        authorships.append({
+            'author_position': 'first' if position == 0 else 'last' if position == num_authorships - 1 else 'middle',
+            'author': {'id': openalex_id('A', int(author_id)), 'display_name': f'Author {author_id}'},
+            'institutions': institutions,
+            'raw_affiliation_string': '; '.join(institution['display_name'] for institution in institutions),
+        })
+
+    locations = [{
+        'source': {'id': openalex_id('S', int(source_id)), 'display_name': f'Source {source_id}', 'type': 'journal'},
+        'version': 'publishedVersion', 'license': 'cc-by' if rng.random() < 0.3 else None, 'is_oa': rng.random() < 0.4,
+    } for source_id in zipf_ids(rng, NUM_SOURCES, 1 + rng.poisson(0.5))]
+
+    concept_ids = np.unique(zipf_ids(rng, NUM_CONCEPTS, 1 + rng.poisson(6)))
+    num_references = long_tail(rng, mean_log=3.0, sigma=1.0, maximum=5_000, zero_fraction=0.25)
+    num_abstract_words = long_tail(rng, mean_log=5.0, sigma=0.5, maximum=3_000)
+    doi = f'https://doi.org/10.{rng.integers(1000, 9999)}/{work_id}'
+
+    return {
+        'id': openalex_id('W', work_id),
+        'doi': doi if rng.random() < 0.7 else None,
+        'title': ' '.join(f'word{word}' for word in zipf_ids(rng, VOCABULARY_SIZE, 1 + rng.poisson(9))),
+        'publication_year': publication_year,
+        'publication_date': f'{publication_year}-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}',
+        'type': rng.choice(['article', 'book-chapter', 'dissertation', 'dataset'], p=[.85, .08, .04, .03]),
+        'cited_by_count': long_tail(rng, mean_log=1.5, sigma=1.5, maximum=100_000, zero_fraction=0.4),
+        'is_retracted': False,
+        'is_paratext': False,
+        'created_date': '2016-06-24',
+        'updated_date': f'{updated_date}T{rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}:00.000000',
+        'authorships': authorships,
+        'primary_location': locations[0],
+        'locations': locations,
+        'biblio': {'volume': str(rng.integers(1, 300)), 'issue': str(rng.integers(1, 12)),
+                   'first_page': '1', 'last_page': str(rng.integers(2, 40))},
+        'concepts': [{'id': openalex_id('C', int(concept_id)), 'display_name': f'Concept {concept_id}',
+                      'level': int(concept_id % 6), 'score': round(float(rng.random()), 6)}
+                     for concept_id in concept_ids],
+        'ids': {'openalex': openalex_id('W', work_id), 'doi': doi, 'mag': int(work_id)},
+        'mesh': [{'descriptor_ui': f'D{rng.integers(1, 99999):06d}', 'descriptor_name': 'Descriptor',
+                  'qualifier_ui': '', 'qualifier_name': None, 'is_major_topic': bool(rng.random() < 0.3)}
+                 for _ in range(rng.poisson(8) if rng.random() < 0.3 else 0)],
+        'referenced_works': [openalex_id('W', int(id_)) for id_ in rng.integers(1, MAX_WORK_ID, num_references)],
+        'related_works': [openalex_id('W', int(id_)) for id_ in rng.integers(1, MAX_WORK_ID, 10)],
+        'abstract_inverted_index': make_inverted_index(rng, num_abstract_words) if rng.random() < 0.6 else None,
+    }
+
+
+def make_author(rng: np.random.Generator, author_id: int, updated_date: str) -> dict:
+    """
+    An author JSON with the fields read by flatten_openalex.parse_author
+    """
+    works_count = long_tail(rng, mean_log=1.0, sigma=1.3, maximum=50_000) + 1
+    num_years = int(min(works_count, 12))
+    return {
+        'id': openalex_id('A', author_id),
+        'orcid': f'https://orcid.org/0000-0002-{author_id % 10_000:04d}-0000' if rng.random() < 0.2 else None,
+        'display_name': f'Author {author_id}',
+        'display_name_alternatives': [f'A. {author_id}'] if rng.random() < 0.3 else [],
+        'works_count': works_count,
+        'cited_by_count': long_tail(rng, mean_log=2.0, sigma=1.8, maximum=1_000_000, zero_fraction=0.2),
+        'last_known_institution': {'id': openalex_id('I', int(zipf_ids(rng, NUM_INSTITUTIONS, 1)[0]))}
+        if rng.random() < 0.7 else None,
+        'ids': {'openalex': openalex_id('A', author_id)},
+        'counts_by_year': [{'year': 2023 - i, 'works_count': int(rng.poisson(2)), 'cited_by_count': int(rng.poisson(5))}
+                           for i in range(num_years)],
+        'x_concepts': [{'id': openalex_id('C', int(concept_id)), 'display_name': f'Concept {concept_id}',
+                        'level': int(concept_id % 6), 'score': round(float(rng.random()) * 100, 1) * (rng.random() < .8)}
+                       for concept_id in np.unique(zipf_ids(rng, NUM_CONCEPTS, 1 + rng.poisson(10)))],
+        'updated_date': updated_date,
+        'most_cited_work': f'Work {author_id}',
+    }
+
+
+def make_concept(rng: np.random.Generator, concept_id: int, updated_date: str) -> dict:
+    """
+    A concept JSON with the fields read by flatten_openalex.parse_concept, with the names and levels of the concepts
+    of the works and ancestors among the concepts of lower IDs
+    """
+    level = int(concept_id % 6)
+    num_ancestors = min(level, concept_id - 1)
+    return {
+        'id': openalex_id('C', concept_id),
+        'wikidata': f'https://www.wikidata.org/wiki/Q{concept_id}',
+        'display_name': f'Concept {concept_id}',
+        'level': level,
+        'description': ' '.join(f'word{word}' for word in zipf_ids(rng, VOCABULARY_SIZE, 1 + rng.poisson(6))),
+        'works_count': long_tail(rng, mean_log=6.0, sigma=2.0, maximum=10_000_000),
+        'cited_by_count': long_tail(rng, mean_log=8.0, sigma=2.0, maximum=100_000_000),
+        'ids': {'openalex': openalex_id('C', concept_id), 'wikidata': f'Q{concept_id}', 'mag': concept_id,
+                'umls_cui': [f'C{concept_id:07d}'] if rng.random() < 0.2 else None},
+        'ancestors': [{'id': openalex_id('C', int(ancestor_id))}
+                      for ancestor_id in np.unique(rng.integers(1, max(concept_id, 2), num_ancestors))],
+        'counts_by_year': [{'year': 2023 - i, 'works_count': int(rng.poisson(200)),
+                            'cited_by_count': int(rng.poisson(2_000))} for i in range(12)],
+        'related_concepts': [{'id': openalex_id('C', int(related_id)), 'score': round(float(rng.random()) * 10, 3)}
+                             for related_id in np.unique(zipf_ids(rng, NUM_CONCEPTS, rng.poisson(10)))],
+        'updated_date': updated_date,
+    }
+
+
+def make_venue(rng: np.random.Generator, venue_id: int, updated_date: str) -> dict:
+    """
+    A venue JSON with the fields read by flatten_openalex.parse_venue
+    """
+    issn = [f'{venue_id % 10_000:04d}-{rng.integers(0, 10_000):04d}'
+            for _ in range(rng.choice(3, p=[.2, .5, .3]))]
+    return {
+        'id': openalex_id('V', venue_id),
+        'issn_l': issn[0] if len(issn) > 0 else None,
+        'issn': issn or None,
+        'display_name': f'Source {venue_id}',
+        'type': rng.choice(['journal', 'repository', 'conference'], p=[.9, .05, .05]),
+        'publisher': f'Publisher {zipf_ids(rng, 200, 1)[0]}' if rng.random() < 0.8 else None,
+        'works_count': long_tail(rng, mean_log=5.0, sigma=1.5, maximum=1_000_000),
+        'cited_by_count': long_tail(rng, mean_log=7.0, sigma=2.0, maximum=50_000_000, zero_fraction=0.1),
+        'is_oa': bool(rng.random() < 0.3),
+        'is_in_doaj': bool(rng.random() < 0.1),
+        'homepage_url': f'https://source{venue_id}.org' if rng.random() < 0.6 else None,
+        'ids': {'openalex': openalex_id('V', venue_id), 'issn_l': issn[0] if len(issn) > 0 else None,
+                'issn': issn or None, 'mag': venue_id},
+        'counts_by_year': [{'year': 2023 - i, 'works_count': int(rng.poisson(50)),
+                            'cited_by_count': int(rng.poisson(500))} for i in range(rng.integers(1, 12))],
+        'updated_date': updated_date,
+    }
+
+
+def make_institution(rng: np.random.Generator, institution_id: int, updated_date: str) -> dict:
+    """
+    An institution JSON with the fields read by flatten_openalex.parse_institution
+    """
+    country_code = rng.choice(['US', 'CN', 'GB', 'DE', 'JP', 'IN', 'FR', 'BR'], p=[.3, .2, .1, .1, .1, .1, .05, .05])
+    return {
+        'id': openalex_id('I', institution_id),
+        'ror': f'https://ror.org/0{institution_id:08d}',
+        'display_name': f'Institution {institution_id}',
+        'country_code': country_code,
+        'type': rng.choice(['education', 'healthcare', 'company', 'government', 'facility'],
+                           p=[.5, .2, .15, .1, .05]),
+        'homepage_url': f'https://institution{institution_id}.edu' if rng.random() < 0.8 else None,
+        'display_name_acroynyms': [f'I{institution_id}'] if rng.random() < 0.4 else [],
+        'display_name_alternatives': [],
+        'works_count': long_tail(rng, mean_log=6.0, sigma=2.0, maximum=5_000_000),
+        'cited_by_count': long_tail(rng, mean_log=8.0, sigma=2.0, maximum=100_000_000, zero_fraction=0.05),
+        'ids': {'openalex': openalex_id('I', institution_id), 'ror': f'https://ror.org/0{institution_id:08d}',
+                'grid': f'grid.{institution_id}.1' if rng.random() < 0.7 else None, 'mag': institution_id},
+        'geo': {'city': f'City {institution_id % 500}', 'geonames_city_id': str(institution_id % 500),
+                'region': None, 'country_code': country_code, 'country': f'Country {country_code}',
+                'latitude': round(float(rng.uniform(-60, 70)), 4),
+                'longitude': round(float(rng.uniform(-180, 180)), 4)},
+        'associated_institutions': [
+            {'id': openalex_id('I', int(associated_id)), 'relationship': rng.choice(['parent', 'child', 'related'])}
+            for associated_id in np.unique(zipf_ids(rng, NUM_INSTITUTIONS, rng.poisson(1)))
+        ],
+        'counts_by_year': [{'year': 2023 - i, 'works_count': int(rng.poisson(100)),
+                            'cited_by_count': int(rng.poisson(1_000))} for i in range(12)],
+        'updated_date': updated_date,
+    }
+
+
+def write_partitions(entity: str, snapshot_dir: Path, num_records: int, num_partitions: int, make_record,
+                     start_date: np.datetime64) -> list:
+    """
+    Write num_records records made by make_record(id_, updated_date) into num_partitions updated_date partitions
+    of one part each, with fewer records in the older partitions like in the snapshot.
+    Returns the manifest entries.
+    """
+    weights = np.arange(1, num_partitions + 1, dtype=float)
+    counts = np.diff(np.round(np.concatenate([[0], np.cumsum(weights / weights.sum())]) * num_records).astype(int))
+
+    entries, first_id = [], 1
+    for partition, count in enumerate(counts):
+        updated_date = str(start_date + np.timedelta64(partition, 'D'))
+        path = snapshot_dir / 'data' / entity / f'updated_date={updated_date}' / 'part_000.gz'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, 'wb') as writer:
+            for id_ in range(first_id, first_id + count):
+                writer.write(orjson.dumps(make_record(id_, updated_date), option=orjson.OPT_SERIALIZE_NUMPY) + b'\n')
+        first_id += count
+        entries.append({'url': f's3://openalex/data/{entity}/updated_date={updated_date}/part_000.gz',
+                        'meta': {'content_length': path.stat().st_size, 'record_count': int(count)}})
+
+    manifest = {'entries': entries, 'meta': {'content_length': sum(entry['meta']['content_length']
+                                                                   for entry in entries),
+                                             'record_count': int(counts.sum())}}
+    (snapshot_dir / 'data' / entity / 'manifest').write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    return entries
+
+
+def write_merged_ids(entity: str, snapshot_dir: Path, rng: np.random.Generator, num_records: int,
+                     merged_fraction: float, merge_date: str):
+    prefix = {'works': 'W', 'authors': 'A'}[entity]
+    merged_ids = rng.choice(np.arange(1, num_records + 1), size=int(num_records * merged_fraction), replace=False)
+    path = snapshot_dir / 'data' / 'merged_ids' / entity / f'{merge_date}.csv.gz'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, 'wt') as writer:
+        writer.write('merge_date,id,merge_into_id\n')
+        writer.writelines(f'{merge_date},{prefix}{id_},{prefix}{rng.integers(1, num_records + 1)}\n'
+                          for id_ in merged_ids)
+    return
+
+
+def generate_snapshot(snapshot_dir, num_works: int = 10_000, num_authors: Optional[int] = None,
+                      num_partitions: int = 4, merged_fraction: float = 0.01, seed: int = 0) -> Box:
+    """
+    Write a synthetic snapshot of num_works works and num_authors authors (a third of the works by default),
+    along with the NUM_CONCEPTS concepts, NUM_SOURCES venues and NUM_INSTITUTIONS institutions they refer to, in
+    num_partitions updated_date partitions each, and merged_ids files listing merged_fraction of the work and
+    author IDs.
+    The same seed always writes the same snapshot.
+    Returns the manifest entries of each entity.
+    """
+    snapshot_dir = Path(snapshot_dir)
+    num_authors = num_authors or max(num_works // 3, 1)
+    rng = np.random.default_rng(seed)
+    start_date = np.datetime64('2023-01-01')
+
+    entries = Box({
+        'works': write_partitions(
+            'works', snapshot_dir, num_records=num_works, num_partitions=num_partitions, start_date=start_date,
+            make_record=lambda id_, updated_date: make_work(rng, id_, num_authors=num_authors,
+                                                            updated_date=updated_date)),
+        'authors': write_partitions(
+            'authors', snapshot_dir, num_records=num_authors, num_partitions=num_partitions, start_date=start_date,
+            make_record=lambda id_, updated_date: make_author(rng, id_, updated_date=updated_date)),
+    })
+    for entity, num_records, make_record in [('concepts', NUM_CONCEPTS, make_concept),
+                                             ('venues', NUM_SOURCES, make_venue),
+                                             ('institutions', NUM_INSTITUTIONS, make_institution)]:
+        entries[entity] = write_partitions(
+            entity, snapshot_dir, num_records=num_records, num_partitions=num_partitions, start_date=start_date,
+            make_record=lambda id_, updated_date, make_record=make_record: make_record(rng, id_, updated_date))
+    merge_date = str(start_date + np.timedelta64(num_partitions, 'D'))
+    write_merged_ids('works', snapshot_dir, rng, num_works, merged_fraction=merged_fraction, merge_date=merge_date)
+    write_merged_ids('authors', snapshot_dir, rng, num_authors, merged_fraction=merged_fraction, merge_date=merge_date)
+    return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic OpenAlex snapshot')
+    parser.add_argument('snapshot_dir', type=Path)
+    parser.add_argument('--works', type=int, default=10_000)
+    parser.add_argument('--authors', type=int, help='a third of the works by default')
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--merged-fraction', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    cli_args = parser.parse_args()
+
+    generate_snapshot(cli_args.snapshot_dir, num_works=cli_args.works, num_authors=cli_args.authors,
+                      num_partitions=cli_args.partitions, merged_fraction=cli_args.merged_fraction,
+                      seed=cli_args.seed)
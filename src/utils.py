@@ -1,8 +1,41 @@
+import csv
+import gzip
+import io
+import os
 import pickle
-from datetime import datetime
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import chain
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import ujson as json
 from box import Box
 from multiprocessing import Pool
+from pathlib import Path
+from typing import Optional, Union
+
+_shared_state = {}  # read-only state handed to every pool worker once, see parallel_largest_first
+
+# the fastest zlib-compatible gzip module installed, all of them have the same open() as gzip
+try:
+    from isal import igzip as gzip_backend  # pip install isal
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as gzip_backend  # pip install zlib-ng
+    except ImportError:
+        gzip_backend = gzip
+
+READ_BLOCK_SIZE = 4 << 20  # bytes of decompressed JSON lines handed over by the reader thread at a time
+READ_AHEAD_BLOCKS = 4  # blocks the reader thread decompresses ahead of the parser
+_END_OF_FILE = object()
+
+CSV_CODECS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}  # codecs of AsyncCSVWriter and the suffixes of their files
+CSV_BATCH_ROWS = 10_000  # rows encoded and compressed at a time by AsyncCSVWriter
+CSV_PENDING_BATCHES = 8  # batches AsyncCSVWriter holds before writerow waits for the writer thread
 
 
 def load_pickle(path):
@@ -15,6 +48,201 @@ def dump_pickle(obj, path):
         pickle.dump(obj, writer)
 
 
+def _read_line_blocks(jsonl_file_name, blocks: queue.Queue, stop: threading.Event, block_size: int,
+                      stats: Optional[dict]):
+    """
+    Decompress a gzipped file into blocks of whole lines and put them on blocks, followed by _END_OF_FILE or the
+    exception that stopped the reading. The inflate calls release the GIL, so they run alongside the parser.
+    stats: gets the wall and CPU time spent reading and inflating, and the number of decompressed bytes
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        wall_time, cpu_time, num_bytes = 0.0, 0.0, 0
+        with gzip_backend.open(jsonl_file_name, 'rb') as jsonl:
+            tail = b''
+            while not stop.is_set():
+                start_wall, start_cpu = time.perf_counter(), time.thread_time()
+                block = jsonl.read(block_size)
+                wall_time += time.perf_counter() - start_wall
+                cpu_time += time.thread_time() - start_cpu
+                num_bytes += len(block)
+                if not block:
+                    break
+                lines = (tail + block).split(b'\n')
+                tail = lines.pop()  # the last line continues in the next block
+                put(lines)
+            if tail:
+                put([tail])
+        if stats is not None:
+            stats.update(wall_s=wall_time, cpu_s=cpu_time, bytes=num_bytes)
+        put(_END_OF_FILE)
+    except BaseException as e:
+        put(e)
+    return
+
+
+def iter_jsonl_line_blocks(jsonl_file_name, block_size: int = READ_BLOCK_SIZE, read_ahead: int = READ_AHEAD_BLOCKS,
+                           stats: Optional[dict] = None):
+    """
+    Yield lists of the lines of a gzipped JSON lines file, without their newlines, decompressed on a background
+    thread with the fastest gzip backend installed and at most read_ahead blocks of about block_size bytes ahead
+    of the consumer, so parsing overlaps with reading and inflating the file.
+    Errors of the reader thread are raised here, and closing the generator early stops the thread.
+    stats: dict that gets wall_s, cpu_s and bytes of the decompression once the whole file is read
+    """
+    blocks, stop = queue.Queue(maxsize=read_ahead), threading.Event()
+    reader = threading.Thread(target=_read_line_blocks, args=(jsonl_file_name, blocks, stop, block_size, stats),
+                              name=f'read-{Path(jsonl_file_name).name}', daemon=True)
+    reader.start()
+    try:
+        while (lines := blocks.get()) is not _END_OF_FILE:
+            if isinstance(lines, BaseException):
+                raise lines
+            yield lines
+    finally:
+        stop.set()
+        reader.join()
+
+
+def iter_jsonl_lines(jsonl_file_name):
+    """
+    Lazily yield the non-empty lines of a gzipped JSON lines file, read ahead by iter_jsonl_line_blocks so only a
+    few blocks of lines are in memory at a time
+    """
+    for lines in iter_jsonl_line_blocks(jsonl_file_name):
+        for line in lines:
+            if line.strip():
+                yield line
+
+
+def get_csv_path(filename, codec: str = 'gzip') -> Path:
+    """
+    Path of a .csv.gz file of csv_files written with codec instead, eg authors.csv.zst for zstd
+    """
+    filename = Path(filename)
+    if filename.suffix == '.gz':
+        filename = filename.with_suffix('')
+    return filename.with_name(filename.name + CSV_CODECS[codec])
+
+
+class AsyncCSVWriter:
+    """
+    Stand-in for a csv.DictWriter over a compressed file that moves the encoding and compression off the calling
+    thread. The rows are turned into lists right away and handed over in batches of batch_size to threads encoding
+    and compressing them, a writer thread appends the results to the file in order. At most max_pending batches are
+    in flight, after that writerow waits for the writer, so the parser overlaps with the compression without running
+    ahead of it.
+    Every batch is compressed on its own into a gzip member or a zstd frame, which the gzip and zstd readers read back
+    as one stream. The Arrow codecs release the GIL, so threads > 1 compresses several batches of the file at once.
+    codec: one of CSV_CODECS, level: its compression level, the codec default if None
+    Errors of the threads are raised by the next writerow, flush or close.
+    """
+    def __init__(self, filename, fieldnames: list, mode: str = 'w', extrasaction: str = 'raise', codec: str = 'gzip',
+                 level: Optional[int] = None, threads: int = 1, batch_size: int = CSV_BATCH_ROWS,
+                 max_pending: int = CSV_PENDING_BATCHES):
+        assert codec in CSV_CODECS, f'Unknown codec {codec!r}, choose from {list(CSV_CODECS)}'
+        assert extrasaction in ('raise', 'ignore'), f'extrasaction must be raise or ignore, not {extrasaction!r}'
+        self.filename = str(filename)
+        self.fieldnames = list(fieldnames)
+        self.extrasaction = extrasaction
+        self.batch_size = batch_size
+        self.codec = pa.Codec(codec, compression_level=level) if codec != 'none' else None
+        self.rows = []
+        self.error = None
+
+        self.file = open(self.filename, mode.replace('t', '').rstrip('b') + 'b')
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f'compress-{Path(filename).name}')
+        self.pending = queue.Queue(maxsize=max_pending)  # futures of the compressed batches, in order
+        self.writer = threading.Thread(target=self._write_batches, name=f'write-{Path(filename).name}', daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _compress(self, rows: list) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        return self.codec.compress(data, asbytes=True) if self.codec is not None else data
+
+    def _write_batches(self):
+        while (batch := self.pending.get()) is not _END_OF_FILE:
+            try:
+                if self.error is None:  # keep draining after an error, so put never blocks for good
+                    self.file.write(batch.result())
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+        self.pending.task_done()
+        return
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        return
+
+    def _put_rows(self):
+        if len(self.rows) > 0:
+            self.pending.put(self.pool.submit(self._compress, self.rows))
+            self.rows = []
+        self._check()
+        return
+
+    def writeheader(self):
+        self.rows.append(self.fieldnames)
+        return
+
+    def writerow(self, row: dict):
+        if self.extrasaction == 'raise':
+            wrong_fields = row.keys() - self.fieldnames
+            if wrong_fields:
+                raise ValueError('dict contains fields not in fieldnames: ' + ', '.join(map(repr, wrong_fields)))
+        self.rows.append([row.get(key, '') for key in self.fieldnames])
+        if len(self.rows) >= self.batch_size:
+            self._put_rows()
+        return
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+        return
+
+    def flush(self):
+        """
+        Wait until every row so far is in the file
+        """
+        self._put_rows()
+        self.pending.join()
+        self.file.flush()
+        self._check()
+        return
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self._put_rows()
+        finally:
+            self.pending.put(_END_OF_FILE)
+            self.writer.join()
+            self.pool.shutdown()
+            self.file.close()
+        self._check()
+        return
+
+
 def convert_openalex_id_to_int(openalex_id):
     if not openalex_id:
         return None
@@ -26,6 +254,128 @@ def convert_openalex_id_to_int(openalex_id):
     return id_
 
 
+OPENALEX_URL = 'https://openalex.org/'
+
+
+def _convert_openalex_ids_to_int_slow(openalex_ids: pa.Array) -> tuple:
+    """
+    Arrow compute version of convert_openalex_id_to_int for IDs that do not look like OPENALEX_URL + letter + digits
+    """
+    openalex_ids = pc.replace_substring(pc.utf8_trim_whitespace(openalex_ids), OPENALEX_URL, '')
+    digits = pc.utf8_slice_codeunits(openalex_ids, start=1)  # drop the W, A, I, ... prefix
+    valid = pc.fill_null(pc.match_substring_regex(digits, r'^[+-]?[0-9]{1,18}$'), False)
+
+    digits = pc.replace_substring_regex(digits, r'^\+', '')  # int() takes a leading +, the Arrow cast does not
+    ids = pc.if_else(valid, digits, None).cast(pa.int64()).fill_null(0).to_numpy()
+    return ids, ~valid.to_numpy(zero_copy_only=False)
+
+
+def convert_openalex_ids_to_int(openalex_ids) -> tuple:
+    """
+    Vectorized convert_openalex_id_to_int for a whole column of IDs like https://openalex.org/W123 or W123
+    openalex_ids: Arrow array, NumPy array, pandas Series or list of strings
+    Returns an int64 NumPy array of the IDs and a boolean null mask, True where the ID is missing or malformed.
+    The IDs under the mask are 0.
+    The digits of the usual https://openalex.org/W123 IDs are read straight out of the Arrow string buffer,
+    one digit position at a time for the whole column, everything else goes through the slower Arrow compute path.
+    """
+    if isinstance(openalex_ids, pa.ChunkedArray):
+        openalex_ids = openalex_ids.combine_chunks()
+    if not isinstance(openalex_ids, pa.Array):
+        openalex_ids = pa.array(openalex_ids, type=pa.string(), from_pandas=True)
+    openalex_ids = openalex_ids.cast(pa.string())
+
+    num_ids = len(openalex_ids)
+    ids, null_mask = np.zeros(num_ids, dtype=np.int64), np.zeros(num_ids, dtype=bool)
+    if num_ids == 0:
+        return ids, null_mask
+
+    _, offsets_buffer, data_buffer = openalex_ids.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int32)[openalex_ids.offset: openalex_ids.offset + num_ids + 1]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.zeros(1, dtype=np.uint8)
+
+    ends = offsets[1:]
+    lengths = ends - offsets[:-1] - len(OPENALEX_URL) - 1  # digits after the URL and the W, A, I, ... prefix
+    fast = pc.fill_null(pc.starts_with(openalex_ids, OPENALEX_URL), False).to_numpy(zero_copy_only=False)
+    fast &= (lengths >= 1) & (lengths <= 18)
+
+    rows = np.flatnonzero(fast)
+    ends, lengths = ends[rows], lengths[rows]
+    values = np.zeros(len(rows), dtype=np.int64)
+    not_digit = np.zeros(len(rows), dtype=bool)
+    for position in range(lengths.max(initial=0)):  # digit positions counted from the right
+        has_digit = position < lengths
+        digits = data[ends - 1 - position] - np.uint8(ord('0'))  # wraps around for bytes below '0'
+        not_digit |= has_digit & (digits > 9)
+        values += np.where(has_digit, digits, 0).astype(np.int64) * 10 ** position
+    fast[rows[not_digit]] = False  # left to the slow path
+    ids[rows] = values
+
+    if not fast.all():
+        slow = ~fast
+        ids[slow], null_mask[slow] = _convert_openalex_ids_to_int_slow(openalex_ids.filter(pa.array(slow)))
+    return ids, null_mask
+
+
+class IdFilter:
+    """
+    Compact set of int IDs, kept as a sorted int64 array that can be memory-mapped from a .npy file.
+    Single IDs are tested with `id_ in id_filter` like a set, whole columns with contains().
+    Pickling a memory-mapped filter only sends its path, so pool workers map the same file instead of each getting
+    a copy of the IDs.
+    """
+    def __init__(self, ids: np.ndarray, path: Optional[Path] = None):
+        self.ids = ids
+        self.path = path
+
+    @classmethod
+    def from_ids(cls, ids) -> 'IdFilter':
+        return cls(np.unique(np.asarray(ids, dtype=np.int64)))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'IdFilter':
+        return cls(np.load(path, mmap_mode='r'), path=Path(path))
+
+    def save(self, path: Union[str, Path]):
+        """
+        Write the IDs to path as a .npy file, through a temporary file so that readers never see a partial one
+        """
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as writer:
+            np.save(writer, self.ids)
+        os.replace(temp_path, path)
+        return
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_) -> bool:
+        if id_ is None or len(self.ids) == 0:
+            return False
+        i = np.searchsorted(self.ids, id_)
+        return i < len(self.ids) and self.ids[i] == id_
+
+    def contains(self, ids) -> np.ndarray:
+        """
+        Vectorized membership test, a boolean array of the same length as ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(len(ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return self.ids[positions] == ids
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'path': self.path}
+        return {'ids': self.ids, 'path': None}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.ids = np.load(self.path, mmap_mode='r') if self.path is not None else state['ids']
+
+
 def parallel_async(func, args, num_workers: int):
     def update_result(result):
         return result
@@ -46,6 +396,59 @@ def parallel_async(func, args, num_workers: int):
     return results
 
 
+def _init_shared_state(state: dict):
+    _shared_state.update(state)
+
+
+def get_shared_state(key: str):
+    """
+    Read a value shared with the pool workers by parallel_largest_first
+    """
+    return _shared_state[key]
+
+
+def _run_task(packed):
+    i, func, arg = packed
+    start_time = time.perf_counter()
+    result = func(*arg)
+    return i, time.perf_counter() - start_time, result
+
+
+def parallel_largest_first(func, args: list, sizes: list, num_workers: int, names: Optional[list] = None,
+                           shared_state: Optional[dict] = None, unit: str = 'records'):
+    """
+    Run func(*arg) for each arg on a pool of num_workers processes, starting with the largest sizes.
+    Each idle worker pulls the next task from the queue, so the biggest files never start last and the run does not
+    end waiting on a handful of them.
+    shared_state is handed to each worker once when the pool starts (inherited without copying where the pool forks)
+    instead of being pickled along with every task, read it inside func with get_shared_state.
+    Prints the throughput of each finished task along with the overall throughput and an ETA.
+    Returns the results in the order of args.
+    """
+    names = names if names is not None else [str(arg) for arg in args]
+    order = sorted(range(len(args)), key=lambda i: sizes[i], reverse=True)
+    total_size, done_size = sum(sizes), 0
+
+    _init_shared_state(shared_state or {})  # also visible to func when running in this process
+    results = [None] * len(args)
+    start_time = time.perf_counter()
+
+    with Pool(num_workers, initializer=_init_shared_state, initargs=(shared_state or {},)) as pool:
+        tasks = ((i, func, args[i]) for i in order)
+        for done, (i, elapsed, result) in enumerate(pool.imap_unordered(_run_task, tasks, chunksize=1), start=1):
+            results[i] = result
+            done_size += sizes[i]
+
+            wall_time = time.perf_counter() - start_time
+            rate = done_size / wall_time
+            eta = timedelta(seconds=round((total_size - done_size) / rate)) if rate > 0 else 'unknown'
+            print(f'[{done}/{len(args)}] {names[i]}: {sizes[i]:,} {unit} in {elapsed:,.1f}s '
+                  f'({sizes[i] / max(elapsed, 1e-9):,.0f} {unit}/s) | overall {rate:,.0f} {unit}/s, '
+                  f'{done_size:,}/{total_size:,} {unit}, ETA {eta}', flush=True)
+
+    return results
+
+
 def reconstruct_abstract(inv_abstract_st):
     if inv_abstract_st is None:
         return ''
@@ -66,6 +469,53 @@ def reconstruct_abstract(inv_abstract_st):
     return abstract
 
 
+def reconstruct_abstracts(inv_abstracts) -> list:
+    """
+    Batched reconstruct_abstract. The words of each abstract are placed into a list preallocated for all of its
+    positions instead of sorting a {position: word} dict.
+    Same output as reconstruct_abstract: gaps in the positions are skipped, the last word wins a duplicate position,
+    JSON strings and bytes are parsed, and missing or malformed inverted indexes give ''.
+    """
+    abstracts = []
+    for inv_abstract in inv_abstracts:
+        if inv_abstract is None:
+            abstracts.append('')
+            continue
+        try:
+            if isinstance(inv_abstract, bytes):
+                inv_abstract = inv_abstract.decode('utf-8', errors='replace')
+            if isinstance(inv_abstract, str):
+                inv_abstract = json.loads(inv_abstract)
+
+            if min(chain.from_iterable(inv_abstract.values()), default=0) < 0:  # sorted before the rest
+                abstracts.append(reconstruct_abstract(inv_abstract))
+                continue
+
+            # without gaps the positions are 0 .. number of positions - 1, otherwise size it by the largest one
+            words = [None] * sum(map(len, inv_abstract.values()))
+            try:
+                for word, locs in inv_abstract.items():  # invert the inversion
+                    for loc in locs:
+                        words[loc] = word
+            except IndexError:
+                words = [None] * (max(chain.from_iterable(inv_abstract.values())) + 1)
+                for word, locs in inv_abstract.items():
+                    for loc in locs:
+                        words[loc] = word
+        except (TypeError, ValueError, AttributeError):  # positions that are not ints, or not JSON
+            try:
+                abstracts.append(reconstruct_abstract(inv_abstract))
+            except (TypeError, ValueError, AttributeError):
+                abstracts.append('')
+            continue
+
+        try:
+            abstracts.append(' '.join(words))
+        except TypeError:  # gaps or duplicates in the positions
+            abstracts.append(' '.join([word for word in words if word is not None]))
+    return abstracts
+
+
 def read_manifest(kind: str, snapshot_dir) -> Box:
     manifest_path = snapshot_dir / kind / 'manifest'
     create_date = datetime.fromtimestamp(manifest_path.stat().st_ctime).strftime("%a, %b %d %Y")
@@ -80,6 +530,7 @@ def read_manifest(kind: str, snapshot_dir) -> Box:
         filename = snapshot_dir / raw_entry.url.replace('s3://openalex/data/', '')
         entry = Box({'filename': filename, 'kind': kind,
                      'count': raw_entry.meta.record_count,
+                     'content_length': raw_entry.meta.get('content_length'),
                      'updated_date': '_'.join(filename.parts[-2:]).replace('.gz', '')})
         entries.append(entry)
 